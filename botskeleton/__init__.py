@@ -1,3 +1,4 @@
 """Skeleton for twitter bots. Spooky."""
 from botskeleton.botskeleton import BotSkeleton, BotSkeletonException, rate_limited, \
     set_up_logging, random_line
+from botskeleton.outputs.output_registry import register_output
@@ -1,63 +1,144 @@
 """Skeleton for twitter bots. Spooky."""
+import atexit
 import json
 import pkg_resources
+import threading
 import time
-from datetime import datetime
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from datetime import datetime, timedelta
+from functools import lru_cache, partial
 from logging import Logger
 from os import path
 from shutil import copyfile
-from typing import Any, Callable, Dict, List
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
 
 import drewtilities as util
 from clint.textui import progress
 
-from .outputs.output_birdsite import BirdsiteSkeleton, TweetRecord
-from .outputs.output_mastodon import MastodonSkeleton, TootRecord
-from .outputs.output_utils import OutputSkeleton, OutputRecord
+from .metrics import Metrics
+from .pacing import Pacer
+from .outbox import Outbox
+from .outputs.output_dryrun import DryRunSkeleton
+from .outputs.output_registry import OutputEntry, discover_outputs
+from .outputs.output_utils import OutputRecord, SkippedRecord, TimedOutRecord
+from .profiling import IterationProfiler, profiled
+from .records import SlottedRecord, json_default, record_from_dict
+from .shared_history import SharedHistory
+from .scheduling import AdaptiveDelay
+from .simulation import Clock, LatencyModel, SimulatedClock
+from .streaming import EventStream
+from .circuit import CircuitBreaker
 from .error import BotSkeletonException
+from .fingerprints import FingerprintStore
+from .history_index import HistoryIndex, Timestamp
+from .history import HistoryView, corrupt_history_errors, is_migrated, iter_archive, \
+    parse_timestamp, read_history, replace_durably, uncompressed_filename, write_archive_segment, \
+    write_history
+
+# what to do with a post that duplicates a recent one.
+DUPLICATE_POLICIES = ("skip", "regenerate", "force")
+
+# calls to one output at once, with iteration_deadline.
+CALL_WORKERS = 4
 
 # Record of one round of media uploads.
-class IterationRecord:
+class IterationRecord(SlottedRecord):
     """Record of one iteration. Includes records of all outputs."""
+    # fingerprint is only stored for posts remembered for duplicate detection.
+    __slots__ = ("_version", "_type", "timestamp", "extra_keys", "output_records", "fingerprint")
+
     def __init__(self, extra_keys: Dict[str, Any]={}) -> None:
-        self._version = pkg_resources.require(__package__)[0].version
+        super().__init__()
+        self._version = _package_version()
         self._type = self.__class__.__name__
         self.timestamp = datetime.now().isoformat()
-        self.extra_keys = extra_keys
-        self.output_records: Dict[str, OutputRecord] = {}
 
-    def __str__(self) -> str:
-        """Print object."""
-        return str(self.__dict__)
+        # our own copy, so later changes to the bot's extra keys don't rewrite old records.
+        self.extra_keys = dict(extra_keys)
+        self.output_records: Dict[str, Any] = {}
+        self.fingerprint: Optional[str] = None
 
-    def __repr__(self) -> str:
-        """repr object."""
-        return str(self)
+    def to_dict(self) -> Dict[str, Any]:
+        """
+        Get record as a dict, ready for JSON,
+        with output records converted to dicts as well.
 
-    def __eq__(self, other:Any) -> bool:
-        """Equality."""
-        if isinstance(other, IterationRecord):
-            for key, value in self.__dict__.items():
-                if value != other.__dict__[key]:
-                    return False
+        :returns: dict of record.
+        """
+        obj_dict = super().to_dict()
+        if obj_dict.get("fingerprint") is None:
+            obj_dict.pop("fingerprint", None)
+
+        output_records: Dict[str, Any] = {}
+        for key, sub_item in self.output_records.items():
+            if isinstance(sub_item, list):
+                output_records[key] = [
+                    record.to_dict() if isinstance(record, SlottedRecord) else record
+                    for record in sub_item
+                ]
+            elif isinstance(sub_item, SlottedRecord):
+                output_records[key] = sub_item.to_dict()
+            else:
+                output_records[key] = sub_item
 
-                return True
-        return False
+        obj_dict["output_records"] = output_records
+        return obj_dict
 
     @classmethod
-    def from_dict(cls, obj_dict: Dict[str, Any]) -> "IterationRecord":
-        """Get object back from dict."""
-        obj = cls()
-        for key, item in obj_dict.items():
-            obj.__dict__[key] = item
+    def from_dict(
+            cls,
+            obj_dict: Dict[str, Any],
+            *,
+            defaults: bool=True,
+    ) -> "IterationRecord":
+        """
+        Get object back from dict,
+        with output records as record objects too,
+        for outputs whose record classes have been imported.
+
+        :param obj_dict: dict as produced by to_dict.
+        :param defaults: whether fields missing from obj_dict get a new record's defaults.
+        :returns: new record.
+        """
+        obj = super().from_dict(obj_dict, defaults=defaults)
+
+        output_records = {}
+        for key, sub_item in obj.output_records.items():
+            if isinstance(sub_item, list):
+                output_records[key] = [
+                    record_from_dict(record) if isinstance(record, dict) else record
+                    for record in sub_item
+                ]
+            elif isinstance(sub_item, dict):
+                output_records[key] = record_from_dict(sub_item)
+            else:
+                output_records[key] = sub_item
 
+        obj.output_records = output_records
         return obj
 
 
 # Main class - handles sending and history management and such.
 class BotSkeleton():
     def __init__(self, secrets_dir:str=None, log_filename:str=None, history_filename:str=None,
-                 bot_name:str="A bot", delay:int=3600) -> None:
+                 bot_name:str="A bot", delay:int=3600, metrics_filename:str=None,
+                 metrics_port:int=None, profile:bool=False, profile_sample_rate:float=1.0,
+                 profile_keep:int=20, history_max_records:int=None,
+                 history_max_age:int=None, history_window_records:int=None,
+                 history_window_age:int=None, history_window_batch:int=100,
+                 history_commit_interval:float=None, outbox:bool=False,
+                 outbox_max_attempts:int=5, outbox_retry_delay:float=60.0,
+                 dry_run:bool=False, dry_run_outputs:List[str]=None,
+                 dry_run_latencies:Dict[str, Any]=None, dry_run_failure_rate:float=0.0,
+                 dry_run_seed:Any=None, dry_run_start:datetime=None,
+                 shared_history:bool=False, shared_history_compact:int=100,
+                 duplicate_window:int=None, duplicate_policy:str="skip",
+                 duplicate_regenerate:Callable[..., Dict[str, Any]]=None,
+                 duplicate_regenerate_attempts:int=3, defer_clients:bool=False,
+                 adaptive_delay:bool=False, min_delay:float=None, max_delay:float=None,
+                 delay_jitter:float=0.1, circuit_breaker_threshold:int=None,
+                 circuit_breaker_cooldown:float=300.0, output_timeout:float=None,
+                 iteration_deadline:float=None) -> None:
         """Set up generic skeleton stuff."""
 
         if secrets_dir is None:
@@ -71,6 +152,28 @@ class BotSkeleton():
         self.bot_name = bot_name
         self.delay = delay
 
+        # in dry-run mode outputs are simulated, and so is time:
+        # latencies and naps pass instantly on a simulated clock,
+        # so months of bot activity can be run through in minutes.
+        self.dry_run = dry_run
+        self.dry_run_outputs = dry_run_outputs
+        self.dry_run_failure_rate = dry_run_failure_rate
+        self.dry_run_seed = dry_run_seed
+        self.clock = SimulatedClock(start=dry_run_start) if dry_run else Clock()
+        self.latency_model = LatencyModel(dry_run_latencies, seed=dry_run_seed) if dry_run \
+            else None
+
+        # with adaptive_delay, naps stretch and shrink around delay
+        # with errors, outbox backlog and rate limits, and are jittered.
+        self.scheduler: Optional[AdaptiveDelay] = None
+        if adaptive_delay:
+            self.scheduler = AdaptiveDelay(delay=delay, min_delay=min_delay, max_delay=max_delay,
+                                           jitter=delay_jitter, seed=dry_run_seed,
+                                           clock=self.clock)
+        self._outcomes = {"posts": 0, "errors": 0}
+        self._outcomes_lock = threading.Lock()
+        self._woke = self.clock.perf_counter()
+
         if log_filename is None:
             log_filename = path.join(self.secrets_dir, "log")
         self.log_filename = log_filename
@@ -83,25 +186,164 @@ class BotSkeleton():
             history_filename = path.join(self.secrets_dir, f"{self.bot_name}-history.json")
         self.history_filename = history_filename
 
-        self.extra_keys: Dict[str, Any] = {}
-        self.history = self.load_history()
+        # retention policy for the live history file.
+        # older records are moved into compressed archive segments next to it.
+        self.history_max_records = history_max_records
+        self.history_max_age = history_max_age
+
+        # how much history to keep in memory, for long-running bots.
+        # records outside the window are archived in batches of at least history_window_batch,
+        # and are still available through full_history.
+        self.history_window_records = history_window_records
+        self.history_window_age = history_window_age
+        self.history_window_batch = history_window_batch
+
+        # group commit: write history at most once per interval (seconds),
+        # instead of after every iteration.
+        # pending records are written by a timer, by flush_history, or at exit.
+        self.history_commit_interval = history_commit_interval
+        self._last_history_write = float("-inf")
+        self._commit_timer: Optional[threading.Timer] = None
+
+        # the bot can be used from several threads.
+        # _history_lock is only held to change history in memory,
+        # and _history_write_lock while writing it out,
+        # so callers' network calls overlap and one write can cover several callers' records.
+        # _history_appended and _history_written count records, to know what's on disk.
+        self._history_lock = threading.RLock()
+        self._history_write_lock = threading.RLock()
+        self._history_appended = 0
+        self._history_written = 0
+        self._extra_keys_lock = threading.Lock()
+        if self.history_commit_interval is not None:
+            atexit.register(self.flush_history)
+
+        # counters and latencies for us and all our outputs.
+        # optionally written out for Prometheus after every iteration, or served over HTTP.
+        self.metrics = Metrics(clock=self.clock)
+        self.metrics_filename = metrics_filename
+        if metrics_port is not None:
+            self.metrics.serve(port=metrics_port)
+
+        # profile send methods and batch reply, if asked.
+        self.profiler: Optional[IterationProfiler] = None
+        if profile:
+            self.profiler = IterationProfiler(
+                directory=path.join(self.secrets_dir, "profiles"),
+                sample_rate=profile_sample_rate,
+                keep=profile_keep,
+                log=self.log,
+            )
 
-        self.outputs = {
-            "birdsite": {
-                "active": False,
-                "obj": BirdsiteSkeleton()
-            },
-            "mastodon": {
+        # with shared history, several processes (a posting bot and a reply bot, say)
+        # can use the same history file.
+        # records go to a journal beside it, under a cross-process lock,
+        # each process picking up the others' records from the journal as it goes.
+        # every shared_history_compact journal records, the history file is rewritten.
+        self.shared_history: Optional[SharedHistory] = None
+        self.shared_history_compact = shared_history_compact
+        if shared_history:
+            self.shared_history = SharedHistory(self.history_filename)
+
+        # outputs are only imported and constructed once we know they're active.
+        # with defer_clients, their API clients are only built when first used.
+        self.defer_clients = defer_clients
+        # seconds any one request to an output may take.
+        self.output_timeout = output_timeout
+        self.output_entries: Dict[str, OutputEntry] = discover_outputs()
+        self.outputs: Dict[str, Dict[str, Any]] = {
+            key: {
                 "active": False,
-                "obj": MastodonSkeleton()
-            },
+                "obj": None,
+            }
+            for key in self.output_entries
         }
 
         self._setup_all_outputs()
 
+        # after outputs are set up, so their records load as record objects.
+        self.extra_keys: Dict[str, Any] = {}
+        self.history = self.load_history()
+
+        # everything, archived or not, read lazily.
+        self.full_history = HistoryView(
+            history_filename=self.history_filename,
+            live=lambda: self.history,
+            from_dict=IterationRecord.from_dict,
+        )
+
+        # kept up to date with history as it grows, for query_history.
+        self.history_index = HistoryIndex()
+
+        # with duplicate_window (seconds), posts are checked against recent ones before
+        # anything is uploaded or posted.
+        # duplicates are skipped (recorded with SkippedRecords),
+        # regenerated by calling duplicate_regenerate with the post's arguments,
+        # which returns replacements for some of them,
+        # or posted anyway (force).
+        if duplicate_policy not in DUPLICATE_POLICIES:
+            raise BotSkeletonException(desc=(f"Duplicate policy should be one of "
+                                             f"{DUPLICATE_POLICIES}, not {duplicate_policy!r}."))
+        if duplicate_policy == "regenerate" and duplicate_regenerate is None:
+            raise BotSkeletonException(desc=("Duplicate policy regenerate needs a "
+                                             "duplicate_regenerate callback."))
+        self.duplicate_policy = duplicate_policy
+        self.duplicate_regenerate = duplicate_regenerate
+        self.duplicate_regenerate_attempts = duplicate_regenerate_attempts
+        self.fingerprints: Optional[FingerprintStore] = None
+        if duplicate_window is not None:
+            self.fingerprints = FingerprintStore(window=duplicate_window, clock=self.clock)
+            for item in self.history:
+                fingerprint = getattr(item, "fingerprint", None)
+                when = parse_timestamp(item.timestamp)
+                if fingerprint is not None and when is not None:
+                    self.fingerprints.add(fingerprint, when)
+
+        # with iteration_deadline, outputs are called concurrently, each on its own workers,
+        # and those still going when it passes are recorded with a TimedOutRecord and left behind.
+        # an output with a call left behind is skipped until it finishes.
+        self.iteration_deadline = iteration_deadline
+        self._call_executors: Dict[str, ThreadPoolExecutor] = {}
+        self._calls_left_behind: Dict[str, Future] = {}
+        self._call_executor_lock = threading.Lock()
+
+        # with circuit_breaker_threshold, an output failing that many calls in a row
+        # is skipped for circuit_breaker_cooldown seconds, then probed before it's used again.
+        self.breakers: Dict[str, CircuitBreaker] = {}
+        if circuit_breaker_threshold is not None:
+            self.breakers = {
+                key: CircuitBreaker(failure_threshold=circuit_breaker_threshold,
+                                    cooldown=circuit_breaker_cooldown, clock=self.clock)
+                for key, output in self.outputs.items() if output["active"]
+            }
+
+        # newest mention each output has replied to, by output key.
+        self.mention_since_ids: Dict[str, Any] = self._read_mention_since_ids()
+
+        # event streams replying in real time, by output key.
+        self.streams: Dict[str, EventStream] = {}
+
+        # with an outbox, send methods queue posts on disk and return straight away.
+        # a background worker delivers them, retrying outputs that fail,
+        # and adds the iteration to history once every output is done.
+        self.outbox: Optional[Outbox] = None
+        self._queued: Dict[str, IterationRecord] = {}
+        self._queued_lock = threading.Lock()
+        if outbox:
+            self.outbox = Outbox(
+                directory=path.join(self.secrets_dir, "outbox"),
+                deliver=self._deliver_queued,
+                max_attempts=outbox_max_attempts,
+                retry_delay=outbox_retry_delay,
+                log=self.log,
+            )
+            self.outbox.start()
+            atexit.register(self.outbox.stop)
+
     ###############################################################################################
     ####        PUBLIC API METHODS                                                             ####
     ###############################################################################################
+    @profiled
     def send(
             self,
             *args: str,
@@ -126,22 +368,9 @@ class BotSkeleton():
                 final_text = args[0]
 
         # TODO there could be some annotation stuff here.
-        record = IterationRecord(extra_keys=self.extra_keys)
-        for key, output in self.outputs.items():
-            if output["active"]:
-                self.log.info(f"Output {key} is active, calling send on it.")
-                entry: Any = output["obj"]
-                output_result = entry.send(text=final_text)
-                record.output_records[key] = output_result
-
-            else:
-                self.log.info(f"Output {key} is inactive. Not sending.")
-
-        self.history.append(record)
-        self.update_history()
-
-        return record
+        return self._fan_out("send", text=final_text)
 
+    @profiled
     def send_with_one_media(
             self,
             *args: str,
@@ -193,23 +422,10 @@ class BotSkeleton():
         else:
             captions = [final_caption]
 
-        record = IterationRecord(extra_keys=self.extra_keys)
-        for key, output in self.outputs.items():
-            if output["active"]:
-                self.log.info(f"Output {key} is active, calling media send on it.")
-                entry: Any = output["obj"]
-                output_result = entry.send_with_media(text=final_text,
-                                                      files=[final_file],
-                                                      captions=captions)
-                record.output_records[key] = output_result
-            else:
-                self.log.info(f"Output {key} is inactive. Not sending with media.")
-
-        self.history.append(record)
-        self.update_history()
-
-        return record
+        return self._fan_out("send_with_media", text=final_text, files=[final_file],
+                             captions=captions)
 
+    @profiled
     def send_with_many_media(
             self,
             *args: str,
@@ -254,23 +470,84 @@ class BotSkeleton():
         # (kind of backed myself into that)
         # so they just get defaulted and it's fine.
 
-        record = IterationRecord(extra_keys=self.extra_keys)
-        for key, output in self.outputs.items():
-            if output["active"]:
-                self.log.info(f"Output {key} is active, calling media send on it.")
-                entry: Any = output["obj"]
-                output_result = entry.send_with_media(text=final_text,
-                                                      files=final_files,
-                                                      captions=captions)
-                record.output_records[key] = output_result
-            else:
-                self.log.info(f"Output {key} is inactive. Not sending with media.")
+        return self._fan_out("send_with_media", text=final_text, files=final_files,
+                             captions=captions)
+
+    @profiled
+    def send_batch(
+            self,
+            posts: List[Dict[str, Any]],
+            *,
+            concurrency: int=4,
+            pace: Dict[str, float]=None,
+            history_group: int=None,
+    ) -> List[IterationRecord]:
+        """
+        Post many items to all outputs,
+        much faster than calling send methods in a loop.
+        Output calls run concurrently,
+        started in order and paced per output,
+        and history is written once per group of posts instead of once per post.
+
+        :param posts: posts, as dicts of text,
+            and files and captions for posts with media.
+            captions without files are dropped.
+        :param concurrency: most output calls in flight at once.
+            with 1, posts go out strictly in order.
+        :param pace: seconds between calls to each output, by output key (optional).
+        :param history_group: posts to write history after (default all of them, once).
+        :returns: records of iterations, one per post, in order.
+        """
+        calls = [self._batch_call(post) for post in posts]
+        if self.outbox is not None:
+            return [self._fan_out(method, **kwargs) for method, kwargs in calls]
+
+        active = [key for key, output in self.outputs.items() if output["active"]]
+        pacer = Pacer(pace, clock=self.clock)
+        group = history_group if history_group else max(1, len(posts))
+
+        records: List[IterationRecord] = []
+        with ThreadPoolExecutor(max_workers=max(1, concurrency),
+                                thread_name_prefix="botskeleton-batch") as executor:
+            for start in range(0, len(posts), group):
+                group_records: List[IterationRecord] = []
+                sent = []
+                futures = []
+                for method, kwargs in calls[start:start + group]:
+                    kwargs, fingerprint, duplicate = self._check_duplicate(kwargs)
+                    if duplicate:
+                        group_records.append(self._skipped(reason="duplicate",
+                                                           fingerprint=fingerprint))
+                        continue
+
+                    # reserved straight away, so duplicates within the batch are caught.
+                    record = self._new_record()
+                    group_records.append(record)
+                    sent.append((record, fingerprint))
+                    for key in active:
+                        future = executor.submit(self._paced_call, pacer, key, method, kwargs)
+                        futures.append((record, key, future))
+
+                for record, key, future in futures:
+                    record.output_records[key] = future.result()
+
+                for record, fingerprint in sent:
+                    if fingerprint is None:
+                        continue
+
+                    if _posted(record):
+                        record.fingerprint = fingerprint
+                    else:
+                        fingerprints: Any = self.fingerprints
+                        fingerprints.discard(fingerprint)
 
-        self.history.append(record)
-        self.update_history()
+                self.log.info(f"Sent batch posts {start} to {start + len(group_records) - 1}.")
+                self._finish_iterations(group_records)
+                records.extend(group_records)
 
-        return record
+        return records
 
+    @profiled
     def perform_batch_reply(
             self,
             *,
@@ -318,7 +595,8 @@ class BotSkeleton():
         if (lookback_dict is None):
             lookback_dict = {}
 
-        record = IterationRecord(extra_keys=self.extra_keys)
+        record = self._new_record()
+        calls: Dict[str, Tuple[str, Dict[str, Any]]] = {}
         for key, output in self.outputs.items():
             if key not in lookback_dict:
                 lookback_dict[key] = lookback_limit
@@ -331,27 +609,196 @@ class BotSkeleton():
 
             elif output["active"]:
                 self.log.info(f"Output {key} is active, calling batch reply on it.")
-                entry: Any = output["obj"]
-                output_result = entry.perform_batch_reply(callback=callback,
-                                                          target_handle=target_handles[key],
-                                                          lookback_limit=lookback_dict[key],
-                                                          )
-                record.output_records[key] = output_result
+                calls[key] = ("perform_batch_reply", {
+                    "callback": callback,
+                    "target_handle": target_handles[key],
+                    "lookback_limit": lookback_dict[key],
+                })
+
+        self._call_outputs(calls, record=record)
+        self._finish_iteration(record)
+
+        return record
+
+    @profiled
+    def perform_mention_replies(
+            self,
+            *,
+            callback: Callable[..., str]=None,
+            limit: int=40,
+            concurrency: int=4,
+    ) -> IterationRecord:
+        """
+        Replies to everyone who mentioned the bot since the last call.
+        Each output fetches its mentions since the newest one it handled before
+        (remembered across restarts in HISTORY.mentions),
+        applies the callback,
+        and replies with
+        what the callback generates.
+        With nothing new, that is one request per output.
+
+        :param callback: a callback taking a message id,
+            message contents,
+            and optional extra keys,
+            and returning a message string.
+        :param limit: mentions to fetch per request.
+        :param concurrency: most replies in flight at once, per output.
+        :returns: new record of iteration
+        :raises BotSkeletonException: if no callback is provided.
+        """
+        if callback is None:
+            raise BotSkeletonException(desc="Callback must be provided.")
+
+        record = self._new_record()
+        calls: Dict[str, Tuple[str, Dict[str, Any]]] = {}
+        for key, output in self.outputs.items():
+            obj = output["obj"]
+            if not output["active"]:
+                self.log.info(f"Output {key} is inactive. Not replying to mentions.")
+
+            elif not hasattr(obj, "perform_mention_replies"):
+                self.log.info(f"Output {key} can't reply to mentions, skipping this output.")
 
-        self.history.append(record)
-        self.update_history()
+            else:
+                self.log.info(f"Output {key} is active, replying to mentions on it.")
+                # the output's own is newer, if a call left behind at a deadline finished since.
+                if obj.mention_since_id is None:
+                    obj.mention_since_id = self.mention_since_ids.get(key)
+                calls[key] = ("perform_mention_replies", {
+                    "callback": callback,
+                    "since_id": obj.mention_since_id,
+                    "limit": limit,
+                    "concurrency": concurrency,
+                })
+
+        self._call_outputs(calls, record=record)
+
+        changed = False
+        for key in calls:
+            since_id = self.outputs[key]["obj"].mention_since_id
+            if since_id != self.mention_since_ids.get(key):
+                self.mention_since_ids[key] = since_id
+                changed = True
+        if changed:
+            self._write_mention_since_ids()
+
+        self._finish_iteration(record)
 
         return record
 
+    @profiled
+    def start_streaming_replies(
+            self,
+            *,
+            callback: Callable[..., str]=None,
+            target_handles: Dict[str, List[str]]=None,
+            mentions: bool=True,
+            backoff: float=1.0,
+            max_backoff: float=300.0,
+    ) -> Dict[str, EventStream]:
+        """
+        Reply in real time, on outputs that can stream,
+        rather than polling with perform_batch_reply.
+        Mentions, and posts by target accounts, are replied to as they arrive,
+        each reply becoming an iteration in history.
+        Streams reconnect by themselves,
+        catching up on what they missed.
+
+        :param callback: a callback taking a message id,
+            message contents,
+            and optional extra keys,
+            and returning a message string.
+        :param target_handles: a dictionary of service names to lists of target handles,
+            to reply to every post of (optional).
+        :param mentions: whether to reply to mentions.
+        :param backoff: seconds before the first reconnection, doubling after that.
+        :param max_backoff: most seconds between reconnections.
+        :returns: dictionary of output keys to their started streams.
+        :raises BotSkeletonException: if no callback is provided.
+        """
+        if callback is None:
+            raise BotSkeletonException(desc="Callback must be provided.")
+
+        target_handles = target_handles or {}
+        for key, output in self.outputs.items():
+            obj = output["obj"]
+            if not output["active"] or key in self.streams:
+                continue
+
+            if not hasattr(obj, "stream_replies"):
+                self.log.info(f"Output {key} can't stream, not streaming replies on it.")
+                continue
+
+            def on_record(output_record: OutputRecord, key: str=key) -> None:
+                self._count_output_records(key, [output_record])
+                record = self._new_record()
+                record.output_records[key] = [output_record]
+                self._finish_iteration(record)
+
+            self.log.info(f"Output {key} is active, streaming replies on it.")
+            self.streams[key] = obj.stream_replies(callback=callback, on_record=on_record,
+                                                   target_handles=target_handles.get(key),
+                                                   mentions=mentions, backoff=backoff,
+                                                   max_backoff=max_backoff)
+
+        return dict(self.streams)
+
+    def stop_streaming_replies(self, timeout: float=None) -> None:
+        """
+        Stop every stream started by start_streaming_replies.
+
+        :param timeout: seconds to wait for each stream to stop (optional).
+        :returns: None
+        """
+        streams, self.streams = self.streams, {}
+        for stream in streams.values():
+            stream.stop(timeout)
+
     def nap(self) -> None:
         """
-        Go to sleep for the duration of self.delay.
+        Go to sleep for the duration of self.delay,
+        or what the scheduler makes of it with adaptive_delay.
 
         :returns: None
         """
-        self.log.info(f"Sleeping for {self.delay} seconds.")
-        for _ in progress.bar(range(self.delay)):
-            time.sleep(1)
+        delay = self.next_delay()
+        self.log.info(f"Sleeping for {delay} seconds.")
+        if self.dry_run:
+            self.clock.sleep(delay)
+        else:
+            for _ in progress.bar(range(int(delay))):
+                time.sleep(1)
+            time.sleep(delay - int(delay))
+
+        self._woke = self.clock.perf_counter()
+
+    def next_delay(self) -> float:
+        """
+        Work out how long the next nap is,
+        from what happened since the last one.
+        Without adaptive_delay that's always self.delay.
+
+        :returns: seconds to nap.
+        """
+        with self._outcomes_lock:
+            outcomes = dict(self._outcomes)
+            self._outcomes = {"posts": 0, "errors": 0}
+
+        if self.scheduler is None:
+            return self.delay
+
+        rate_limits = {key: output["obj"].rate_limit()
+                       for key, output in self.outputs.items()
+                       if output["active"] and hasattr(output["obj"], "rate_limit")}
+        delay = self.scheduler.next_delay(
+            elapsed=self.clock.perf_counter() - self._woke,
+            posts=outcomes["posts"],
+            errors=outcomes["errors"],
+            backlog=len(self.outbox.pending()) if self.outbox is not None else 0,
+            rate_limits=rate_limits,
+        )
+        self.metrics.observe("nap_seconds", delay)
+        return delay
 
     def store_extra_info(self, key: str, value: Any) -> None:
         """
@@ -361,7 +808,8 @@ class BotSkeleton():
         :param value: value of dictionary entry to add.
         :returns: None
         """
-        self.extra_keys[key] = value
+        with self._extra_keys_lock:
+            self.extra_keys[key] = value
 
     def store_extra_keys(self, d: Dict[str, Any]) -> None:
         """
@@ -370,78 +818,279 @@ class BotSkeleton():
         :param d: dictionary entry to merge with current self.extra_keys.
         :returns: None
         """
-        new_dict = dict(self.extra_keys, **d)
-        self.extra_keys = new_dict.copy()
+        with self._extra_keys_lock:
+            new_dict = dict(self.extra_keys, **d)
+            self.extra_keys = new_dict.copy()
 
-    def update_history(self) -> None:
+    def flush_outbox(self, timeout: float=None) -> bool:
         """
-        Update messaging history on disk.
+        Wait for every queued post to be delivered (or given up on),
+        retries included.
 
-        :returns: None
+        :param timeout: seconds to wait at most (optional).
+        :returns: whether the outbox is empty.
         """
+        if self.outbox is None:
+            return True
 
-        jsons = []
-        for item in self.history:
-            json_item = item.__dict__
+        return self.outbox.drain(timeout)
 
-            # Convert sub-entries into JSON as well.
-            json_item["output_records"] = self._parse_output_records(item)
+    def aggregate_timings(self, *, output: str=None) -> Dict[str, Dict[str, float]]:
+        """
+        Summarize the per-phase timings stored in history records.
 
-            jsons.append(json_item)
+        :param output: only consider records from this output (optional).
+        :returns: dict of phase name (like "media_upload" or "total")
+            to a summary with count, mean, p50, p95, max and total seconds.
+        """
+        with self._history_lock:
+            history = list(self.history)
 
-        if not path.isfile(self.history_filename):
-            open(self.history_filename, "a+").close()
+        samples: Dict[str, List[float]] = {}
+        for item in history:
+            for key, output_records in item.output_records.items():
+                if output is not None and key != output:
+                    continue
 
-        with open(self.history_filename, "w") as f:
-            json.dump(jsons, f, default=lambda x: x.__dict__.copy(), sort_keys=True, indent=4)
-            f.write("\n") # add trailing new line dump skips.
+                if not isinstance(output_records, list):
+                    output_records = [output_records]
 
-    def load_history(self) -> List["IterationRecord"]:
+                for output_record in output_records:
+                    if isinstance(output_record, dict):
+                        timings = output_record.get("timings")
+                    else:
+                        timings = getattr(output_record, "timings", None)
+
+                    for phase, value in (timings or {}).items():
+                        values = value if isinstance(value, list) else [value]
+                        samples.setdefault(phase, []).extend(values)
+
+        return {phase: _summarize(values) for phase, values in samples.items()}
+
+    def query_history(
+            self,
+            *,
+            post_id: Any=None,
+            in_reply_to_id: Any=None,
+            output: str=None,
+            since: Timestamp=None,
+            until: Timestamp=None,
+            error_code: Any=None,
+            extra_keys: Dict[str, Any]=None,
+    ) -> List[IterationRecord]:
         """
-        Load messaging history from disk to self.
+        Find iteration records in (live, not archived) history matching all given conditions.
+        Backed by indexes that are extended as history grows,
+        so this is cheap to call often.
+
+        :param post_id: id of a post made by an output (tweet id, toot id, etc).
+        :param in_reply_to_id: id of a post an output replied to.
+        :param output: output key, like "birdsite".
+            narrows the id and error conditions to that output.
+        :param since: only records at or after this time (datetime or isoformat string).
+        :param until: only records before this time (datetime or isoformat string).
+        :param error_code: only records with an output error with this code.
+            errors without a code have code "unknown".
+        :param extra_keys: dict of extra_keys entries records must have.
+        :returns: list of matching records, oldest first.
+        """
+        self.sync_history()
+
+        with self._history_lock:
+            history = self.history
+
+        return self.history_index.query(
+            history,
+            post_id=post_id,
+            in_reply_to_id=in_reply_to_id,
+            output=output,
+            since=since,
+            until=until,
+            error_code=error_code,
+            extra_keys=extra_keys,
+        )
 
-        :returns: List of iteration records comprising history.
+    def archive_history(self) -> int:
         """
-        if path.isfile(self.history_filename):
-            with open(self.history_filename, "r") as f:
-                try:
-                    dicts = json.load(f)
-
-                except json.decoder.JSONDecodeError as e:
-                    self.log.error(f"Got error \n{e}\n decoding JSON history, overwriting it.\n"
-                                   f"Former history available in {self.history_filename}.bak")
-                    copyfile(self.history_filename, f"{self.history_filename}.bak")
-                    return []
-
-                history: List[IterationRecord] = []
-                for hdict_pre in dicts:
-
-                    if "_type" in hdict_pre and hdict_pre["_type"] == IterationRecord.__name__:
-                        # repair any corrupted entries
-                        hdict = _repair(hdict_pre)
-                        record = IterationRecord.from_dict(hdict)
-                        history.append(record)
-
-                    # Be sure to handle legacy tweetrecord-only histories.
-                    # Assume anything without our new _type (which should have been there from the
-                    # start, whoops) is a legacy history.
-                    else:
-                        item = IterationRecord()
+        Move records outside the retention policy (history_max_records, history_max_age)
+        out of the live history and into a new compressed archive segment.
+        Records outside the in-memory window (history_window_records, history_window_age)
+        are moved too,
+        once there are at least history_window_batch of them.
+        Done automatically by update_history.
+        With shared history,
+        archiving is only done while rewriting the history file under the lock,
+        so this does that.
+
+        :returns: number of records archived.
+        """
+        if self.shared_history is not None:
+            with self._history_write_lock:
+                return self._compact_shared_history()
 
-                        # Lift extra keys up to upper record (if they exist).
-                        extra_keys = hdict_pre.pop("extra_keys", {})
-                        item.extra_keys = extra_keys
+        return self._archive_outside()
 
-                        hdict_obj = TweetRecord.from_dict(hdict_pre)
+    def sync_history(self) -> int:
+        """
+        Pick up records other processes added to shared history since we last looked.
+        Only reads what's new.
+        Done automatically by query_history and whenever this process adds a record.
+        Does nothing without shared_history.
+
+        :returns: number of records picked up.
+        """
+        shared_history = self.shared_history
+        if shared_history is None:
+            return 0
+
+        with self._history_write_lock:
+            with shared_history.locked(exclusive=False):
+                return self._apply_shared_changes(shared_history.catch_up())
+
+    def _archive_outside(self) -> int:
+        """Archive records outside the retention policy or in-memory window, see archive_history."""
+        now = self.clock.now()
+        with self._history_lock:
+            count = _outside(self.history, self.history_max_records, self.history_max_age, now)
+
+            window_count = _outside(self.history, self.history_window_records,
+                                    self.history_window_age, now)
+            if window_count >= max(1, self.history_window_batch):
+                count = max(count, window_count)
+
+            if count == 0:
+                return 0
+
+            self.history = self._archive(self.history, count)
+            self.history_index.trim(count, self.history)
+            if self.shared_history is not None:
+                self.shared_history.start += count
+            return count
+
+    def iter_full_history(self) -> Iterator[IterationRecord]:
+        """
+        Iterate over the entire history,
+        archived records first,
+        without loading all archive segments at once.
+
+        :returns: iterator of iteration records, oldest first.
+        """
+        for hdict in iter_archive(self.history_filename):
+            yield IterationRecord.from_dict(hdict)
+
+        with self._history_lock:
+            history = list(self.history)
+
+        yield from history
 
-                        # Lift timestamp up to upper record.
-                        item.timestamp = hdict_obj.timestamp
+    def update_history(self) -> None:
+        """
+        Update messaging history on disk.
+        Archives records outside the retention policy first, if there is one.
+        The file is replaced atomically and flushed to disk,
+        so a crash never leaves a partial history behind.
+        With shared history,
+        this folds the journal into the history file, under the lock.
+
+        :returns: None
+        """
+        with self._history_write_lock:
+            if self.shared_history is not None:
+                self._compact_shared_history()
+                return
 
-                        item.output_records["birdsite"] = hdict_obj
+            with self._history_lock:
+                if self._has_archive_policy():
+                    self._archive_outside()
 
-                        history.append(item)
+                history = list(self.history)
+                appended = self._history_appended
 
-                return history
+            # compressed if the filename says so, and written out one record at a time.
+            # records aren't changed by serializing them,
+            # so other threads can keep adding to history meanwhile.
+            jsons = (item.to_dict() for item in history)
+            write_history(self.history_filename, jsons, default=json_default, migrated=True)
+
+            with self._history_lock:
+                self._history_written = max(self._history_written, appended)
+                self._last_history_write = self.clock.perf_counter()
+
+    def flush_history(self) -> None:
+        """
+        Write any iterations still waiting for a group commit to disk now.
+        Does nothing without history_commit_interval,
+        where every iteration is written straight away.
+
+        :returns: None
+        """
+        with self._history_lock:
+            if self._commit_timer is not None:
+                self._commit_timer.cancel()
+                self._commit_timer = None
+
+            appended = self._history_appended
+
+        self._write_history_through(appended)
+
+    def load_history(self) -> List["IterationRecord"]:
+        """
+        Load messaging history from disk to self.
+        Compressed history files are detected automatically.
+        If history_filename is compressed (.gz, .zst) but doesn't exist yet,
+        an existing uncompressed history with the same name is loaded instead,
+        and the next update_history writes it out compressed.
+        With an in-memory window,
+        records outside it are archived as they're read,
+        so loading a large history doesn't need memory for all of it.
+
+        :returns: List of iteration records comprising history.
+        """
+        if self.shared_history is not None:
+            # everything in the history file and journal.
+            # windows apply the next time the history file is rewritten.
+            self.shared_history.reset()
+            with self.shared_history.locked(exclusive=False):
+                _, hdicts = self.shared_history.catch_up()
+            return [upgrade_record(hdict) for hdict in hdicts]
+
+        source_filename = self.history_filename
+        if not path.isfile(source_filename):
+            source_filename = uncompressed_filename(self.history_filename)
+            if source_filename != self.history_filename and path.isfile(source_filename):
+                self.log.info(f"Loading uncompressed history {source_filename}, "
+                              f"it will be saved compressed to {self.history_filename}.")
+
+        if path.isfile(source_filename):
+            history: List[IterationRecord] = []
+            archived = 0
+            windowed = self.history_window_records is not None \
+                or self.history_window_age is not None
+            try:
+                # files we (or botskeleton-migrate) wrote need no upgrading or repair.
+                upgrade = IterationRecord.from_dict if is_migrated(source_filename) \
+                    else upgrade_record
+                for hdict_pre in read_history(source_filename, stream=windowed):
+                    history.append(upgrade(hdict_pre))
+
+                    window_count = _outside(history, self.history_window_records,
+                                            self.history_window_age, self.clock.now())
+                    if window_count >= max(1, self.history_window_batch):
+                        history = self._archive(history, window_count)
+                        archived += window_count
+
+            except corrupt_history_errors() as e:
+                self.log.error(f"Got error \n{e}\n decoding JSON history, overwriting it.\n"
+                               f"Former history available in {source_filename}.bak")
+                copyfile(source_filename, f"{source_filename}.bak")
+                return []
+
+            # don't leave archived records in the live file too.
+            if archived > 0:
+                write_history(self.history_filename, (item.to_dict() for item in history),
+                              default=json_default, migrated=True)
+
+            return history
 
         else:
             return []
@@ -451,11 +1100,16 @@ class BotSkeleton():
     ###############################################################################################
     def _setup_all_outputs(self) -> None:
         """Set up all output methods. Provide them credentials and anything else they need."""
+        if self.dry_run:
+            self._setup_dry_run_outputs()
+            return
 
         # The way this is gonna work is that we assume an output should be set up iff it has a
         # credentials_ directory under our secrets dir.
-        for key in self.outputs.keys():
-            credentials_dir = path.join(self.secrets_dir, f"credentials_{key}")
+        # Outputs without one are never imported.
+        credentials_dirs: Dict[str, str] = {}
+        for key, entry in self.output_entries.items():
+            credentials_dir = path.join(self.secrets_dir, entry.credentials_dir)
 
             # special-case birdsite for historical reasons.
             if key == "birdsite" and not path.isdir(credentials_dir) \
@@ -463,27 +1117,593 @@ class BotSkeleton():
                 credentials_dir = self.secrets_dir
 
             if path.isdir(credentials_dir):
-                output_skeleton = self.outputs[key]
+                credentials_dirs[key] = credentials_dir
 
-                output_skeleton["active"] = True
+        # outputs are set up at the same time,
+        # so startup takes as long as the slowest one rather than all of them together.
+        with ThreadPoolExecutor(max_workers=max(1, len(credentials_dirs)),
+                                thread_name_prefix="botskeleton-setup") as executor:
+            futures = {key: executor.submit(self._setup_output, key, credentials_dir)
+                       for key, credentials_dir in credentials_dirs.items()}
 
-                obj: Any = output_skeleton["obj"]
-                obj.cred_init(secrets_dir=credentials_dir, log=self.log, bot_name=self.bot_name)
+        for key, future in futures.items():
+            output_skeleton = self.outputs[key]
 
-                output_skeleton["obj"] = obj
+            output_skeleton["active"] = True
+            output_skeleton["obj"] = future.result()
 
-                self.outputs[key] = output_skeleton
+            self.outputs[key] = output_skeleton
 
-    def _parse_output_records(self, item: IterationRecord) -> Dict[str, Any]:
-        """Parse output records into dicts ready for JSON."""
-        output_records = {}
-        for key, sub_item in item.output_records.items():
-            if isinstance(sub_item, dict) or isinstance(sub_item, list):
-                output_records[key] = sub_item
+    def _setup_output(self, key: str, credentials_dir: str) -> Any:
+        """Construct one output and give it its credentials."""
+        with self.metrics.time("output_setup_seconds", output=key):
+            obj: Any = self.output_entries[key].instantiate()
+            obj.metrics = self.metrics
+            obj.clock = self.clock
+            obj.defer_clients = self.defer_clients
+            obj.timeout = self.output_timeout
+            obj.cred_init(secrets_dir=credentials_dir, log=self.log, bot_name=self.bot_name)
+
+        return obj
+
+    def _write_history_through(self, appended: int) -> None:
+        """
+        Make sure history is on disk up to the given count of appended records,
+        writing it unless another thread's write already covered them.
+        """
+        with self._history_write_lock:
+            with self._history_lock:
+                if self._history_written >= appended:
+                    return
+
+            with self.metrics.time("history_write_seconds"):
+                self.update_history()
+
+    def _setup_dry_run_outputs(self) -> None:
+        """
+        Set up simulated outputs,
+        for dry_run_outputs or else every output with a credentials dir.
+        Credentials are never read.
+        """
+        keys = self.dry_run_outputs
+        if keys is None:
+            keys = [key for key, entry in self.output_entries.items()
+                    if path.isdir(path.join(self.secrets_dir, entry.credentials_dir))]
+
+        latency_model: Any = self.latency_model
+        for index, key in enumerate(keys):
+            entry = self.output_entries.get(key)
+            credentials_dir = entry.credentials_dir if entry is not None else f"credentials_{key}"
+
+            seed = None if self.dry_run_seed is None else f"{self.dry_run_seed}-{index}"
+            obj = DryRunSkeleton(key=key, latency_model=latency_model,
+                                 failure_rate=self.dry_run_failure_rate, seed=seed)
+            obj.metrics = self.metrics
+            obj.clock = self.clock
+            obj.cred_init(secrets_dir=path.join(self.secrets_dir, credentials_dir), log=self.log,
+                          bot_name=self.bot_name)
+
+            self.outputs[key] = {
+                "active": True,
+                "obj": obj,
+            }
+
+    def _new_record(self) -> IterationRecord:
+        """Start a record of an iteration, with the current extra keys and the bot's clock."""
+        with self._extra_keys_lock:
+            record = IterationRecord(extra_keys=self.extra_keys)
+
+        record.timestamp = self.clock.now().isoformat()
+        return record
+
+    def _batch_call(self, post: Dict[str, Any]) -> Tuple[str, Dict[str, Any]]:
+        """
+        Get the send method for a send_batch post, and its arguments.
+        Captions only go with files,
+        so a post with captions but no files is sent as text, without them.
+
+        :param post: post, as a dict of text, and files and captions for posts with media.
+        :returns: output method to call and its arguments.
+        """
+        if post.get("files"):
+            return "send_with_media", dict(post)
+
+        if post.get("captions"):
+            self.log.warning(f"Batch post {post.get('text')!r} has captions but no files, "
+                             "sending it without them.")
+
+        return "send", {key: value for key, value in post.items()
+                        if key not in ("files", "captions")}
+
+    def _fan_out(self, method: str, **kwargs: Any) -> IterationRecord:
+        """
+        Post to all active outputs (or queue the post in the outbox),
+        unless it duplicates a recent post.
+
+        :param method: output method to call, "send" or "send_with_media".
+        :param kwargs: arguments for output method.
+        :returns: new record of iteration.
+        """
+        kwargs, fingerprint, duplicate = self._check_duplicate(kwargs)
+        if duplicate:
+            record = self._skipped(reason="duplicate", fingerprint=fingerprint)
+            self._finish_iteration(record)
+            return record
+
+        if self.outbox is not None:
+            # delivery is at least once, so the post counts as made and stays reserved.
+            return self._enqueue(method, fingerprint=fingerprint, **kwargs)
+
+        action = "send" if method == "send" else "media send"
+        not_action = "sending" if method == "send" else "sending with media"
+
+        record = self._new_record()
+        calls: Dict[str, Tuple[str, Dict[str, Any]]] = {}
+        for key, output in self.outputs.items():
+            if output["active"]:
+                self.log.info(f"Output {key} is active, calling {action} on it.")
+                calls[key] = (method, kwargs)
             else:
-                output_records[key] = sub_item.__dict__
+                self.log.info(f"Output {key} is inactive. Not {not_action}.")
 
-        return output_records
+        self._call_outputs(calls, record=record, fingerprint=fingerprint)
+
+        # kept if it went out anywhere, otherwise given up so the post can be tried again.
+        # under the history lock, like a call left behind finishing.
+        if fingerprint is not None:
+            with self._history_lock:
+                if _posted(record):
+                    record.fingerprint = fingerprint
+                else:
+                    fingerprints: Any = self.fingerprints
+                    fingerprints.discard(fingerprint)
+
+        self._finish_iteration(record)
+
+        return record
+
+    def _paced_call(self, pacer: Pacer, key: str, method: str,
+                    kwargs: Dict[str, Any]) -> List[OutputRecord]:
+        """Call an output once the pacer allows it."""
+        pacer.wait(key)
+        return self._call_output(key, method, **kwargs)
+
+    def _check_duplicate(
+            self,
+            kwargs: Dict[str, Any],
+    ) -> Tuple[Dict[str, Any], Optional[str], bool]:
+        """
+        Check a post against recent posts, before any network call,
+        regenerating it if the duplicate policy says to.
+        A post that isn't skipped has its fingerprint reserved,
+        so another thread making the same post meanwhile is caught;
+        discard it if the post fails everywhere.
+
+        :param kwargs: arguments for output method (text, files, captions).
+        :returns: arguments to post with (regenerated, maybe),
+            fingerprint of the post (None without duplicate detection),
+            and whether to skip it.
+        """
+        fingerprints = self.fingerprints
+        if fingerprints is None:
+            return kwargs, None, False
+
+        attempts = 0
+        while True:
+            fingerprint = fingerprints.fingerprint(text=kwargs.get("text"),
+                                                   files=kwargs.get("files"))
+            if fingerprints.reserve(fingerprint):
+                return kwargs, fingerprint, False
+
+            self.metrics.inc("duplicates_total")
+            if self.duplicate_policy == "force":
+                self.log.info("Post duplicates a recent one, posting anyway.")
+                fingerprints.add(fingerprint)
+                return kwargs, fingerprint, False
+
+            regenerate = self.duplicate_regenerate
+            if self.duplicate_policy == "regenerate" and regenerate is not None \
+                    and attempts < self.duplicate_regenerate_attempts:
+                attempts += 1
+                self.log.info(f"Post duplicates a recent one, regenerating (attempt {attempts}).")
+                kwargs = dict(kwargs, **regenerate(**kwargs))
+                continue
+
+            self.log.info("Post duplicates a recent one, skipping it.")
+            return kwargs, fingerprint, True
+
+    def _skipped(self, *, reason: str, fingerprint: str=None) -> IterationRecord:
+        """
+        Record a post that wasn't attempted,
+        with a SkippedRecord for each active output.
+        The record still has to be finished.
+
+        :param reason: why it was skipped, like "duplicate".
+        :param fingerprint: fingerprint of post (optional).
+        :returns: new record of iteration.
+        """
+        record = self._new_record()
+        for key, output in self.outputs.items():
+            if output["active"]:
+                record.output_records[key] = [SkippedRecord(reason=reason,
+                                                            fingerprint=fingerprint)]
+                self.metrics.inc("skipped_total", output=key, reason=reason)
+
+        return record
+
+    def _enqueue(self, method: str, fingerprint: str=None, **kwargs: Any) -> IterationRecord:
+        """
+        Queue a post for all active outputs in the outbox.
+
+        :param method: output method to call, like "send".
+        :param fingerprint: fingerprint of post, if remembered for duplicate detection.
+        :param kwargs: arguments for output method.
+        :returns: record of the iteration,
+            filled in by the outbox worker once delivered.
+        """
+        outbox: Any = self.outbox
+        record = self._new_record()
+        if fingerprint is not None and self.fingerprints is not None:
+            record.fingerprint = fingerprint
+
+        # registered before the worker can look for it.
+        with self._queued_lock:
+            entry_id = outbox.enqueue({
+                "method": method,
+                "kwargs": kwargs,
+                "extra_keys": record.extra_keys,
+                "timestamp": record.timestamp,
+                "outputs": [key for key, output in self.outputs.items() if output["active"]],
+                "output_records": {},
+                "fingerprint": getattr(record, "fingerprint", None),
+            })
+            self._queued[entry_id] = record
+
+        self.log.info(f"Queued {method} as outbox entry {entry_id}.")
+        return record
+
+    def _deliver_queued(self, entry: Dict[str, Any]) -> bool:
+        """
+        Deliver an outbox entry to the outputs it hasn't reached yet.
+        Outputs returning errors are retried on later attempts,
+        until the outbox's last attempt,
+        whose errors are kept in the record.
+
+        :param entry: outbox entry.
+        :returns: whether the entry is finished.
+        """
+        with self._queued_lock:
+            record = self._queued.get(entry["id"])
+            if record is None:
+                # queued by an earlier run.
+                record = IterationRecord(extra_keys=entry["extra_keys"])
+                record.timestamp = entry["timestamp"]
+                record.output_records = dict(entry["output_records"])
+                if entry.get("fingerprint") is not None:
+                    record.fingerprint = entry["fingerprint"]
+                self._queued[entry["id"]] = record
+
+        outbox: Any = self.outbox
+        last_attempt = entry["attempts"] >= outbox.max_attempts
+        for key in list(entry["outputs"]):
+            output = self.outputs.get(key)
+            if output is None or not output["active"]:
+                self.log.info(f"Output {key} is no longer active, not delivering {entry['id']}.")
+                entry["outputs"].remove(key)
+                continue
+
+            if entry["attempts"] > 1:
+                self.metrics.inc("retries_total", output=key)
+
+            output_result = self._call_output(key, entry["method"], **entry["kwargs"])
+            record.output_records[key] = output_result
+            entry["output_records"][key] = [output_record.to_dict()
+                                            for output_record in output_result]
+
+            # skipped while its circuit is open counts as failed, to try again later.
+            failed = any(getattr(output_record, "error", None) is not None
+                         or isinstance(output_record, SkippedRecord)
+                         for output_record in output_result)
+            if not failed or last_attempt:
+                entry["outputs"].remove(key)
+
+        if entry["outputs"]:
+            return False
+
+        self._finish_iteration(record)
+        with self._queued_lock:
+            del self._queued[entry["id"]]
+        return True
+
+    def _archive(self, history: List[IterationRecord], count: int) -> List[IterationRecord]:
+        """Move the oldest count records of a history list into a new archive segment."""
+        dicts = [item.to_dict() for item in history[:count]]
+
+        # archive before trimming,
+        # so a crash in between duplicates records rather than losing them.
+        segment = write_archive_segment(self.history_filename, dicts)
+        self.log.info(f"Archived {count} history records to {segment}.")
+
+        return history[count:]
+
+    def _has_archive_policy(self) -> bool:
+        """Whether there's a retention policy or in-memory window to archive records for."""
+        return any(policy is not None for policy in (self.history_max_records,
+                                                     self.history_max_age,
+                                                     self.history_window_records,
+                                                     self.history_window_age))
+
+    def _apply_shared_changes(self, changes: Tuple[int, List[Dict[str, Any]]]) -> int:
+        """
+        Bring history in memory up to date with what other processes did to shared history:
+        drop records they archived, and add records they appended.
+
+        :param changes: changes, as SharedHistory.catch_up returns them.
+        :returns: number of records added.
+        """
+        drop, hdicts = changes
+        with self._history_lock:
+            if drop > 0:
+                self.history = self.history[drop:]
+                self.history_index.trim(drop, self.history)
+
+            self.history.extend(upgrade_record(hdict) for hdict in hdicts)
+
+        return len(hdicts)
+
+    def _compact_shared_history(self) -> int:
+        """
+        Rewrite the shared history file from memory and start the journal over,
+        archiving first if there's a policy.
+        Must be called holding _history_write_lock.
+
+        :returns: number of records archived.
+        """
+        shared_history: Any = self.shared_history
+        with shared_history.locked(exclusive=True):
+            self._apply_shared_changes(shared_history.catch_up())
+
+            archived = 0
+            with self._history_lock:
+                if self._has_archive_policy():
+                    archived = self._archive_outside()
+
+                history = list(self.history)
+
+            # beside the live history file, which compacted replaces once the state is written.
+            # other processes catch up from where the records from the journal start.
+            jsons = (item.to_dict() for item in history)
+            tail = shared_history.tail(len(history))
+            tail_offset = write_history(shared_history.staged_filename, jsons,
+                                        default=json_default, migrated=True, mark=tail)
+            shared_history.compacted(count=len(history), tail=tail, tail_offset=tail_offset)
+
+        with self._history_lock:
+            self._last_history_write = self.clock.perf_counter()
+
+        return archived
+
+    def _call_output(self, key: str, method: str, **kwargs: Any) -> List[OutputRecord]:
+        """
+        Call a method on an output,
+        timing it and counting the posts and errors it produces.
+
+        :param key: key of output to call.
+        :param method: name of output method, like "send".
+        :param kwargs: arguments for output method.
+        :returns: output records from the output.
+        """
+        breaker = self.breakers.get(key)
+        if breaker is not None and not breaker.allow():
+            self.log.info(f"Circuit for output {key} is open, skipping {method}.")
+            self.metrics.inc("skipped_total", output=key, reason="circuit_open")
+            return [SkippedRecord(reason="circuit_open")]
+
+        entry: Any = self.outputs[key]["obj"]
+        try:
+            with self.metrics.time("call_seconds", output=key, method=method):
+                output_result = getattr(entry, method)(**kwargs)
+        except Exception:
+            if breaker is not None:
+                self._record_failure(key, breaker)
+            raise
+
+        self._count_output_records(key, output_result)
+        if breaker is not None:
+            if any(getattr(output_record, "error", None) is not None
+                   for output_record in output_result):
+                self._record_failure(key, breaker)
+            else:
+                breaker.record_success()
+
+        return output_result
+
+    def _call_outputs(
+            self,
+            calls: Dict[str, Tuple[str, Dict[str, Any]]],
+            *,
+            record: IterationRecord,
+            fingerprint: str=None,
+    ) -> None:
+        """
+        Call several outputs for one iteration,
+        within the iteration deadline if there is one,
+        putting what they return in its record.
+        Outputs still going at the deadline get a TimedOutRecord,
+        replaced with what they return if they finish later,
+        and outputs still going from an earlier iteration are skipped as busy.
+        Both count as failures for circuit breakers.
+
+        :param calls: output method and its arguments, by output key.
+        :param record: record of the iteration.
+        :param fingerprint: fingerprint of the post, if reserved for duplicate detection,
+            remembered again if a call left behind posts it after all.
+        :returns: None
+        """
+        deadline = self.iteration_deadline
+        if deadline is None:
+            for key, (method, kwargs) in calls.items():
+                record.output_records[key] = self._call_output(key, method, **kwargs)
+            return
+
+        futures: Dict[str, Future] = {}
+        with self._call_executor_lock:
+            for key, (method, kwargs) in calls.items():
+                if key in self._calls_left_behind:
+                    self.log.warning(f"Output {key} is still busy with a call left behind "
+                                     f"at a deadline, skipping {method}.")
+                    self.metrics.inc("skipped_total", output=key, reason="busy")
+                    record.output_records[key] = [SkippedRecord(reason="busy")]
+                    self._record_deadline_failure(key)
+                    continue
+
+                # its own workers, so an output that hangs can't hold up the others.
+                executor = self._call_executors.get(key)
+                if executor is None:
+                    executor = ThreadPoolExecutor(max_workers=CALL_WORKERS,
+                                                  thread_name_prefix=f"botskeleton-call-{key}")
+                    self._call_executors[key] = executor
+
+                futures[key] = executor.submit(self._call_output, key, method, **kwargs)
+
+        wait(futures.values(), timeout=deadline)
+
+        for key, future in futures.items():
+            if future.done():
+                record.output_records[key] = future.result()
+                continue
+
+            method = calls[key][0]
+            self.log.warning(f"Output {key} didn't finish {method} within {deadline} seconds, "
+                             f"recording what finished without it.")
+            self.metrics.inc("deadline_exceeded_total", output=key)
+            record.output_records[key] = [TimedOutRecord(method=method, deadline=deadline)]
+            self._record_deadline_failure(key)
+
+            with self._call_executor_lock:
+                self._calls_left_behind[key] = future
+            future.add_done_callback(partial(self._finish_late_call, key, method,
+                                             record=record, fingerprint=fingerprint))
+
+    def _finish_late_call(self, key: str, method: str, future: Future, *,
+                          record: IterationRecord, fingerprint: Optional[str]) -> None:
+        """Put what a call left behind at a deadline returned in its record, once it finishes."""
+        with self._call_executor_lock:
+            self._calls_left_behind.pop(key, None)
+
+        try:
+            output_records = future.result()
+        except Exception as e:
+            self.log.warning(f"Output {key} failed {method} after the deadline: {e}")
+            return
+
+        self.log.info(f"Output {key} finished {method} after the deadline, "
+                      f"updating its iteration record.")
+        with self._history_lock:
+            record.output_records[key] = output_records
+            self.history_index.invalidate()
+
+            # so a retry doesn't make the post again.
+            if fingerprint is not None and self.fingerprints is not None and _posted(record):
+                self.fingerprints.add(fingerprint)
+                record.fingerprint = fingerprint
+
+    def _record_deadline_failure(self, key: str) -> None:
+        """Count a missed deadline against an output's circuit breaker, if it has one."""
+        breaker = self.breakers.get(key)
+        if breaker is not None:
+            self._record_failure(key, breaker)
+
+    def _record_failure(self, key: str, breaker: CircuitBreaker) -> None:
+        """Count a failed call against an output's circuit breaker."""
+        if breaker.record_failure():
+            self.log.warning(f"Circuit for output {key} opened after {breaker.failures} "
+                             f"failures, skipping it for {breaker.cooldown} seconds.")
+            self.metrics.inc("circuit_opened_total", output=key)
+
+    def _read_mention_since_ids(self) -> Dict[str, Any]:
+        """Read the newest mention each output has replied to."""
+        filename = f"{self.history_filename}.mentions"
+        if not path.isfile(filename):
+            return {}
+
+        with open(filename) as f:
+            since_ids: Dict[str, Any] = json.load(f)
+
+        return since_ids
+
+    def _write_mention_since_ids(self) -> None:
+        """Save the newest mention each output has replied to, durably."""
+        filename = f"{self.history_filename}.mentions"
+        temp_filename = f"{filename}.tmp"
+        with open(temp_filename, "w") as f:
+            json.dump(self.mention_since_ids, f, sort_keys=True, default=json_default)
+        replace_durably(temp_filename, filename)
+
+    def _count_output_records(self, key: str, output_records: List[OutputRecord]) -> None:
+        """Count the posts and errors an output produced."""
+        for output_record in output_records:
+            if getattr(output_record, "error", None) is None:
+                self.metrics.inc("posts_total", output=key)
+                outcome = "posts"
+            else:
+                code = getattr(output_record, "error_code", "unknown")
+                self.metrics.inc("errors_total", output=key, code=code)
+                outcome = "errors"
+
+            with self._outcomes_lock:
+                self._outcomes[outcome] += 1
+
+    def _finish_iteration(self, record: IterationRecord) -> None:
+        """Add a finished iteration to history, and save history and metrics."""
+        self._finish_iterations([record])
+
+    def _finish_iterations(self, records: List[IterationRecord]) -> None:
+        """Add finished iterations to history, and save history and metrics, once for all."""
+        self.metrics.inc("iterations_total", len(records))
+
+        shared_history = self.shared_history
+        if shared_history is not None:
+            # on disk in the journal straight away,
+            # after whatever other processes added before them.
+            with self._history_write_lock:
+                for record in records:
+                    changes = shared_history.append(record.to_dict())
+                    self._apply_shared_changes(changes)
+                    with self._history_lock:
+                        self.history.append(record)
+
+                if shared_history.journal_records >= self.shared_history_compact:
+                    with self.metrics.time("history_write_seconds"):
+                        self._compact_shared_history()
+
+            if self.metrics_filename is not None:
+                self.metrics.write_prometheus(self.metrics_filename)
+            return
+
+        with self._history_lock:
+            self.history.extend(records)
+            self._history_appended += len(records)
+            appended = self._history_appended
+
+            write_now = True
+            if self.history_commit_interval is not None:
+                # write now if the last write was long enough ago,
+                # otherwise leave it to the timer, batching up whatever else comes in meanwhile.
+                wait = self._last_history_write + self.history_commit_interval \
+                    - self.clock.perf_counter()
+                if wait > 0:
+                    write_now = False
+                    if self._commit_timer is None:
+                        self._commit_timer = threading.Timer(wait, self.flush_history)
+                        self._commit_timer.daemon = True
+                        self._commit_timer.start()
+
+        if write_now:
+            self._write_history_through(appended)
+
+        if self.metrics_filename is not None:
+            self.metrics.write_prometheus(self.metrics_filename)
 
 
 ###################################################################################################
@@ -504,9 +1724,92 @@ def random_line(file_path: str) -> str:
     return util.random_line(file_path=file_path)
 
 
+def upgrade_record(hdict_pre: Dict[str, Any]) -> IterationRecord:
+    """
+    Get an iteration record from its dict in a history file,
+    upgrading legacy TweetRecords and repairing corrupted records.
+
+    :param hdict_pre: record dict, as read from a history file.
+    :returns: iteration record.
+    """
+    if "_type" in hdict_pre and hdict_pre["_type"] == IterationRecord.__name__:
+        # repair any corrupted entries
+        hdict = _repair(hdict_pre)
+        return IterationRecord.from_dict(hdict)
+
+    # Be sure to handle legacy tweetrecord-only histories.
+    # Assume anything without our new _type (which should have been there from the
+    # start, whoops) is a legacy history.
+    from .outputs.output_birdsite import TweetRecord
+
+    item = IterationRecord()
+
+    # Lift extra keys up to upper record (if they exist).
+    extra_keys = hdict_pre.pop("extra_keys", {})
+    item.extra_keys = extra_keys
+
+    hdict_obj = TweetRecord.from_dict(hdict_pre)
+
+    # legacy records predate id, which is always the tweet id.
+    hdict_obj.id = hdict_obj.tweet_id
+
+    # Lift timestamp up to upper record.
+    item.timestamp = hdict_obj.timestamp
+
+    item.output_records["birdsite"] = hdict_obj
+
+    return item
+
+
 ###################################################################################################
 ####      "PRIVATE" MODULE METHODS, NOT INTENDED FOR PUBLIC USE                                ####
 ###################################################################################################
+@lru_cache(maxsize=None)
+def _package_version() -> str:
+    """Get our version, once. Looking it up per record made loading history slow."""
+    return pkg_resources.require(__package__)[0].version
+
+
+def _outside(history: List[IterationRecord], max_records: Optional[int],
+             max_age: Optional[int], now: datetime) -> int:
+    """Count records at the start of a history list outside a record count and/or age limit."""
+    count = 0
+    if max_records is not None:
+        count = max(0, len(history) - max_records)
+
+    if max_age is not None:
+        cutoff = now - timedelta(seconds=max_age)
+        while count < len(history):
+            timestamp = parse_timestamp(history[count].timestamp)
+            if timestamp is None or timestamp >= cutoff:
+                break
+            count += 1
+
+    return count
+
+
+def _summarize(values: List[float]) -> Dict[str, float]:
+    """Summarize a list of durations."""
+    ordered = sorted(values)
+    count = len(ordered)
+    return {
+        "count": count,
+        "mean": sum(ordered) / count,
+        "p50": ordered[int(0.50 * (count - 1))],
+        "p95": ordered[int(0.95 * (count - 1))],
+        "max": ordered[-1],
+        "total": sum(ordered),
+    }
+
+
+def _posted(record: IterationRecord) -> bool:
+    """Whether an iteration went out to any output without an error."""
+    return any(getattr(output_record, "error", None) is None
+               and not isinstance(output_record, SkippedRecord)
+               for output_result in record.output_records.values()
+               for output_record in output_result)
+
+
 def _repair(record: Dict[str, Any]) -> Dict[str, Any]:
     """Repair a corrupted IterationRecord with a specific known issue."""
     output_records = record.get("output_records")
@@ -533,7 +1836,7 @@ def _repair(record: Dict[str, Any]) -> Dict[str, Any]:
                 return record
 
             # add type
-            birdsite_record["_type"] = TweetRecord.__name__
+            birdsite_record["_type"] = "TweetRecord"
 
             # lift extra keys, just in case
             if "extra_keys" in birdsite_record:
@@ -0,0 +1,89 @@
+"""Circuit breakers, so an output that keeps failing is left alone for a while."""
+import threading
+
+from .simulation import Clock
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitBreaker:
+    """
+    Tracks consecutive failures of one output.
+
+    Closed, calls go through.
+    After failure_threshold failures in a row it opens,
+    and calls are refused without trying for cooldown seconds.
+    Then it's half-open:
+    one call at a time goes through as a probe,
+    closing the breaker if it succeeds and opening it again if it fails.
+    Safe to use from several threads.
+    """
+    def __init__(self, *, failure_threshold: int=5, cooldown: float=300.0,
+                 clock: Clock=None) -> None:
+        """
+        Create breaker, closed.
+
+        :param failure_threshold: failures in a row that open the breaker.
+        :param cooldown: seconds to refuse calls for once open.
+        :param clock: clock to tell the time with (default real time).
+        """
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.clock = clock if clock is not None else Clock()
+
+        self.state = CLOSED
+        self.failures = 0
+
+        self._opened_at = 0.0
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        """
+        Ask to make a call.
+        Every allowed call must be followed by record_success or record_failure.
+
+        :returns: whether to make it.
+        """
+        with self._lock:
+            if self.state == OPEN:
+                if self.clock.perf_counter() - self._opened_at < self.cooldown:
+                    return False
+                self.state = HALF_OPEN
+
+            if self.state == HALF_OPEN:
+                if self._probing:
+                    return False
+                self._probing = True
+
+            return True
+
+    def record_success(self) -> None:
+        """
+        Record an allowed call that worked, closing the breaker.
+
+        :returns: None
+        """
+        with self._lock:
+            self.state = CLOSED
+            self.failures = 0
+            self._probing = False
+
+    def record_failure(self) -> bool:
+        """
+        Record an allowed call that failed.
+
+        :returns: whether this opened the breaker.
+        """
+        with self._lock:
+            self.failures += 1
+            was_probe = self._probing
+            self._probing = False
+            if was_probe or (self.state == CLOSED and self.failures >= self.failure_threshold):
+                self.state = OPEN
+                self._opened_at = self.clock.perf_counter()
+                return True
+
+            return False
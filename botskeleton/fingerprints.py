@@ -0,0 +1,165 @@
+"""Fingerprints of recent posts, for catching duplicates before they're sent."""
+import hashlib
+import os
+import re
+import threading
+import unicodedata
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Tuple
+
+from .simulation import Clock
+
+WHITESPACE = re.compile(r"\s+")
+
+# read media in chunks of this many bytes when hashing.
+CHUNK_SIZE = 1 << 16
+
+# media hashes remembered, so reposting the same files doesn't reread them.
+MAX_MEDIA_HASHES = 1024
+
+
+def normalize_text(text: str) -> str:
+    """
+    Get text in the form duplicates are compared in:
+    unicode-normalized, case-folded, with runs of whitespace collapsed.
+
+    :param text: text of post.
+    :returns: normalized text.
+    """
+    text = unicodedata.normalize("NFKC", text)
+    return WHITESPACE.sub(" ", text.casefold()).strip()
+
+
+class FingerprintStore:
+    """
+    Fingerprints of posts made within a time window.
+    A fingerprint covers a post's normalized text and the contents of its media,
+    so the same text with different images is a different post.
+
+    Fingerprints older than the window are dropped as new ones come in,
+    so the store holds about as many entries as posts in the window.
+    Safe to use from several threads.
+    """
+    def __init__(self, *, window: float, clock: Clock=None) -> None:
+        """
+        Create store.
+
+        :param window: seconds a post counts as recent for.
+        :param clock: clock to tell the time with (default real time).
+        """
+        self.window = window
+        self.clock = clock if clock is not None else Clock()
+
+        self._lock = threading.Lock()
+        self._seen: "OrderedDict[str, datetime]" = OrderedDict()
+        self._media_hashes: Dict[Tuple[str, int, int], str] = {}
+
+    def fingerprint(self, *, text: str=None, files: List[str]=None) -> str:
+        """
+        Get the fingerprint of a post.
+
+        :param text: text of post.
+        :param files: media files of post.
+        :returns: hex fingerprint.
+        """
+        digest = hashlib.sha256(normalize_text(text or "").encode("utf-8"))
+        for file in files or []:
+            digest.update(b"\0")
+            digest.update(self._media_hash(file).encode("ascii"))
+
+        return digest.hexdigest()
+
+    def add(self, fingerprint: str, when: datetime=None) -> None:
+        """
+        Remember a post.
+
+        :param fingerprint: fingerprint of post.
+        :param when: when it was posted (default now).
+        :returns: None
+        """
+        when = when if when is not None else self.clock.now()
+        with self._lock:
+            self._seen.pop(fingerprint, None)
+            newest = self._seen[next(reversed(self._seen))] if self._seen else None
+            self._seen[fingerprint] = when
+
+            # normally added in time order, but history can have records out of order.
+            if newest is not None and when < newest:
+                self._seen = OrderedDict(sorted(self._seen.items(), key=lambda item: item[1]))
+
+            self._expire()
+
+    def reserve(self, fingerprint: str) -> bool:
+        """
+        Remember a post about to be made, unless one like it was made within the window.
+        Checking and remembering are one step,
+        so of several threads making the same post at once, only one gets to.
+
+        :param fingerprint: fingerprint of post.
+        :returns: whether it was reserved, rather than a recent duplicate.
+        """
+        with self._lock:
+            self._expire()
+            if fingerprint in self._seen:
+                return False
+
+            self._seen[fingerprint] = self.clock.now()
+            return True
+
+    def discard(self, fingerprint: str) -> None:
+        """
+        Forget a post, if it's remembered.
+        For posts reserved before sending that then failed everywhere.
+
+        :param fingerprint: fingerprint of post.
+        :returns: None
+        """
+        with self._lock:
+            self._seen.pop(fingerprint, None)
+
+    def __contains__(self, fingerprint: Any) -> bool:
+        """Whether a post with this fingerprint was made within the window."""
+        with self._lock:
+            self._expire()
+            return fingerprint in self._seen
+
+    def __len__(self) -> int:
+        """Number of posts within the window."""
+        with self._lock:
+            self._expire()
+            return len(self._seen)
+
+    def _expire(self) -> None:
+        """Drop fingerprints older than the window. Must be called with the lock held."""
+        cutoff = self.clock.now() - timedelta(seconds=self.window)
+        while self._seen:
+            fingerprint, when = next(iter(self._seen.items()))
+            if when >= cutoff:
+                break
+            del self._seen[fingerprint]
+
+    def _media_hash(self, file: str) -> str:
+        """Hash a media file's contents, remembering it until the file changes."""
+        try:
+            stat = os.stat(file)
+        except OSError:
+            # not a local file (or gone). go by name.
+            return hashlib.sha256(file.encode("utf-8")).hexdigest()
+
+        key = (os.path.abspath(file), stat.st_size, stat.st_mtime_ns)
+        with self._lock:
+            cached = self._media_hashes.get(key)
+        if cached is not None:
+            return cached
+
+        digest = hashlib.sha256()
+        with open(file, "rb") as f:
+            for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+                digest.update(chunk)
+
+        with self._lock:
+            if len(self._media_hashes) >= MAX_MEDIA_HASHES:
+                self._media_hashes.clear()
+            self._media_hashes[key] = digest.hexdigest()
+        return digest.hexdigest()
@@ -0,0 +1,739 @@
+"""Storage helpers for bot history."""
+import glob
+import gzip
+import io
+import json
+import os
+import re
+import sys
+import zlib
+from contextlib import contextmanager
+from json.encoder import encode_basestring_ascii  # type: ignore
+from datetime import datetime
+from typing import IO, Any, Callable, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple, \
+    Type, Union
+
+from .error import BotSkeletonException
+from .records import json_default
+
+# orjson, if installed, is used to decode history.
+# it is never used to encode - nothing else writes exactly what the json module does,
+# and history files shouldn't change just because a library got installed.
+orjson: Optional[Any]
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# history files are compressed based on their extension,
+# and recognized by their magic bytes when reading.
+COMPRESSION_EXTENSIONS = {
+    ".gz": "gzip",
+    ".zst": "zstd",
+}
+MAGIC_BYTES = {
+    b"\x1f\x8b": "gzip",
+    b"\x28\xb5\x2f\xfd": "zstd",
+}
+
+READ_CHUNK_SIZE = 64 * 1024
+
+INDENT = "    "
+INFINITY = float("inf")
+
+# files up to this size (on disk) are decoded in one go when orjson is around.
+# bigger ones are streamed.
+FAST_READ_LIMIT = 64 * 1024 * 1024
+
+# history files whose records are all modern (upgraded from legacy TweetRecords and repaired)
+# say so in a marker file next to them, FILENAME.format,
+# which also holds the size, mtime and inode the history file had when it was written,
+# so a history file changed by anything else isn't trusted.
+HISTORY_FORMAT = 2
+
+# archived records live next to the history file, in numbered, compressed, read-only segments:
+# foobot-history.json.archive-00001.json.gz, foobot-history.json.archive-00002.json.gz, ...
+ARCHIVE_PATTERN = re.compile(r"\.archive-(\d+)\.json\.gz$")
+
+
+def archive_filenames(history_filename: str) -> List[str]:
+    """
+    Get archive segments of a history file, oldest first.
+
+    :param history_filename: history file the segments belong to.
+    :returns: list of segment paths.
+    """
+    candidates = glob.glob(f"{glob.escape(history_filename)}.archive-*.json.gz")
+    segments = []
+    for candidate in candidates:
+        match = ARCHIVE_PATTERN.search(candidate)
+        if match is not None:
+            segments.append((int(match.group(1)), candidate))
+
+    return [segment for _, segment in sorted(segments)]
+
+
+def write_archive_segment(history_filename: str, records: List[Dict[str, Any]]) -> str:
+    """
+    Write records to a new archive segment.
+    The segment is written to a temporary file first and made read-only once complete,
+    so a segment that exists is always whole and never changes.
+
+    :param history_filename: history file the segment belongs to.
+    :param records: records to archive, as dicts, oldest first.
+    :returns: path to the new segment.
+    """
+    existing = archive_filenames(history_filename)
+    index = 1
+    if existing:
+        match = ARCHIVE_PATTERN.search(existing[-1])
+        if match is not None:
+            index = int(match.group(1)) + 1
+
+    segment = f"{history_filename}.archive-{index:05d}.json.gz"
+    temp_segment = f"{segment}.tmp"
+    with gzip.open(temp_segment, "wt", encoding="utf-8") as f:
+        json.dump(records, f, sort_keys=True, default=json_default)
+
+    os.chmod(temp_segment, 0o444)
+    replace_durably(temp_segment, segment)
+    return segment
+
+
+def iter_archive(history_filename: str) -> Iterator[Dict[str, Any]]:
+    """
+    Iterate over all archived records of a history file, oldest first.
+    Only one segment is held in memory at a time.
+
+    :param history_filename: history file the segments belong to.
+    :returns: iterator of record dicts.
+    """
+    for segment in archive_filenames(history_filename):
+        yield from read_archive_segment(segment)
+
+
+def read_archive_segment(segment: str) -> List[Dict[str, Any]]:
+    """
+    Read all records of one archive segment.
+
+    :param segment: path to segment.
+    :returns: list of record dicts, oldest first.
+    """
+    with gzip.open(segment, "rt", encoding="utf-8") as f:
+        records: List[Dict[str, Any]] = json_loads(f.read())
+
+    return records
+
+
+class HistoryView(Sequence[Any]):
+    """
+    Read-only view of a whole history,
+    archived records first and then the live ones.
+    Archive segments are only read when a record in them is asked for,
+    and only the most recently used one is kept in memory,
+    so records outside the in-memory window cost nothing until they're needed.
+    """
+    def __init__(
+            self,
+            *,
+            history_filename: str,
+            live: Callable[[], Sequence[Any]],
+            from_dict: Callable[[Dict[str, Any]], Any],
+    ) -> None:
+        """
+        Create view.
+
+        :param history_filename: history file the archive segments belong to.
+        :param live: callable returning the live (in-memory) records.
+        :param from_dict: callable turning an archived record dict into a record.
+        """
+        self.history_filename = history_filename
+        self.live = live
+        self.from_dict = from_dict
+
+        # segments never change once written, so their lengths can be remembered.
+        self._lengths: Dict[str, int] = {}
+        self._segment: Tuple[Optional[str], List[Any]] = (None, [])
+
+    def __len__(self) -> int:
+        return sum(self._length(segment) for segment in archive_filenames(self.history_filename)) \
+            + len(self.live())
+
+    def __getitem__(self, index: Union[int, slice]) -> Any:  # type: ignore
+        if isinstance(index, slice):
+            return [self[position] for position in range(*index.indices(len(self)))]
+
+        if index < 0:
+            index += len(self)
+        if index < 0:
+            raise IndexError("history index out of range")
+
+        for segment in archive_filenames(self.history_filename):
+            length = self._length(segment)
+            if index < length:
+                return self._load(segment)[index]
+            index -= length
+
+        live = self.live()
+        if index >= len(live):
+            raise IndexError("history index out of range")
+
+        return live[index]
+
+    def __iter__(self) -> Iterator[Any]:
+        for segment in archive_filenames(self.history_filename):
+            yield from self._load(segment)
+
+        yield from list(self.live())
+
+    def _length(self, segment: str) -> int:
+        """Get number of records in a segment."""
+        length = self._lengths.get(segment)
+        if length is None:
+            length = len(self._load(segment))
+
+        return length
+
+    def _load(self, segment: str) -> List[Any]:
+        """Get records of a segment, reading it unless it's the one already in memory."""
+        if self._segment[0] != segment:
+            records = [self.from_dict(record) for record in read_archive_segment(segment)]
+            self._lengths[segment] = len(records)
+            self._segment = (segment, records)
+
+        return self._segment[1]
+
+
+def json_loads(text: str) -> Any:
+    """
+    Decode JSON,
+    with orjson if it's installed and can handle the document.
+
+    :param text: JSON text.
+    :returns: decoded object.
+    """
+    if orjson is not None:
+        try:
+            return orjson.loads(text)
+        except orjson.JSONDecodeError:
+            # orjson is stricter (64 bit integers, no NaN), let json have the final word.
+            pass
+
+    return json.loads(text)
+
+
+def compression_for(filename: str) -> Optional[str]:
+    """
+    Get compression to write a history file with, based on its extension.
+
+    :param filename: history filename.
+    :returns: "gzip", "zstd", or None for uncompressed.
+    """
+    for extension, compression in COMPRESSION_EXTENSIONS.items():
+        if filename.endswith(extension):
+            return compression
+
+    return None
+
+
+def uncompressed_filename(filename: str) -> str:
+    """
+    Get the uncompressed equivalent of a compressed history filename.
+
+    :param filename: history filename.
+    :returns: filename without its compression extension, or filename if it has none.
+    """
+    for extension in COMPRESSION_EXTENSIONS:
+        if filename.endswith(extension):
+            return filename[:-len(extension)]
+
+    return filename
+
+
+def detect_compression(filename: str) -> Optional[str]:
+    """
+    Work out how an existing history file is compressed, whatever its name says.
+
+    :param filename: history filename.
+    :returns: "gzip", "zstd", or None for uncompressed.
+    """
+    with open(filename, "rb") as f:
+        start = f.read(4)
+
+    for magic, compression in MAGIC_BYTES.items():
+        if start.startswith(magic):
+            return compression
+
+    return None
+
+
+@contextmanager
+def open_history(
+        filename: str,
+        mode: str,
+        *,
+        compression: Optional[str]=None,
+) -> Iterator[IO[str]]:
+    """
+    Open a history file as text,
+    compressed if needed.
+    Files being read are detected by content,
+    files being written are compressed by extension.
+
+    :param filename: history filename.
+    :param mode: "r" or "w".
+    :param compression: compression to write with,
+        instead of going by the extension (for temporary files).
+    :returns: context manager for text file object.
+    """
+    if mode == "r":
+        compression = detect_compression(filename)
+    elif compression is None:
+        compression = compression_for(filename)
+
+    if compression is None:
+        with open(filename, mode) as f:
+            yield f
+
+    elif compression == "gzip":
+        with gzip.GzipFile(filename, f"{mode}b") as compressed, \
+                io.TextIOWrapper(compressed, encoding="utf-8") as f:
+            yield f
+
+    else:
+        try:
+            import zstandard
+        except ImportError:
+            raise BotSkeletonException(desc=(f"History file {filename} needs zstd, "
+                                             f"but the zstandard package is not installed."))
+
+        with open(filename, f"{mode}b") as raw:
+            if mode == "r":
+                stream = zstandard.ZstdDecompressor().stream_reader(raw)
+            else:
+                stream = zstandard.ZstdCompressor().stream_writer(raw)
+
+            with io.TextIOWrapper(stream, encoding="utf-8") as f:
+                yield f
+
+
+def corrupt_history_errors() -> Tuple[Type[BaseException], ...]:
+    """
+    Get the errors reading a damaged history file can raise,
+    compressed or not.
+
+    :returns: tuple of exception classes, to catch.
+    """
+    errors: List[Type[BaseException]] = [
+        json.decoder.JSONDecodeError,
+        UnicodeDecodeError,
+        EOFError,
+        zlib.error,
+        # a plain OSError before python 3.8.
+        getattr(gzip, "BadGzipFile", OSError),
+    ]
+
+    # zstandard is only imported to read zstd files, so its errors can't come up before it is.
+    zstandard = sys.modules.get("zstandard")
+    if zstandard is not None:
+        errors.append(zstandard.ZstdError)
+
+    return tuple(errors)
+
+
+def read_history(
+        filename: str,
+        *,
+        stream: bool=False,
+        offset: int=0,
+) -> Iterator[Dict[str, Any]]:
+    """
+    Stream records out of a history file.
+    Files small enough are decoded in one go when orjson is installed,
+    which is faster but holds the whole file in memory.
+
+    :param filename: history filename, compressed or not.
+    :param stream: always stream,
+        never holding the whole file in memory.
+    :param offset: where in the uncompressed text to start,
+        as write_history returned it for a record.
+        earlier records aren't decoded at all.
+    :returns: iterator of record dicts.
+    :raises json.decoder.JSONDecodeError: if the file isn't a JSON list.
+        damaged files can raise others too, see corrupt_history_errors.
+    """
+    if offset > 0:
+        with open_history(filename, "r") as f:
+            f.seek(offset)
+            yield from iter_json_array(f, inside=True)
+        return
+
+    if not stream and orjson is not None and os.path.getsize(filename) <= FAST_READ_LIMIT:
+        with open_history(filename, "r") as f:
+            text = f.read()
+
+        try:
+            records = orjson.loads(text)
+        except orjson.JSONDecodeError:
+            records = None
+
+        if isinstance(records, list):
+            yield from records
+            return
+
+    with open_history(filename, "r") as f:
+        yield from iter_json_array(f)
+
+
+def write_history(
+        filename: str,
+        records: Iterable[Any],
+        *,
+        default: Callable[[Any], Any]=None,
+        migrated: bool=False,
+        mark: int=None,
+) -> Optional[int]:
+    """
+    Stream records into a history file.
+    Output is byte-for-byte what json.dump(records, f, sort_keys=True, indent=4) produces,
+    plus a trailing newline,
+    but only one record is encoded at a time.
+    Records are written to a temporary file that replaces the history file once complete,
+    so a crash mid-write leaves the previous history intact.
+    The temporary file is removed if writing fails.
+
+    :param filename: history filename, compressed by extension.
+    :param records: records to write.
+    :param default: json default hook for objects json can't encode itself.
+    :param migrated: records are all modern,
+        so mark the file as migrated (see is_migrated).
+    :param mark: index of a record to find in the file (optional).
+    :returns: where record mark starts in the uncompressed text,
+        for reading from there with read_history,
+        or None without mark or if there aren't that many records.
+    """
+    temp_filename = f"{filename}.tmp"
+    offset = None
+    try:
+        with open_history(temp_filename, "w", compression=compression_for(filename)) as f:
+            f.write("[")
+            # encoded records are ascii, so characters written are bytes too.
+            written = 1
+            empty = True
+            for index, record in enumerate(records):
+                if index == mark:
+                    offset = written
+
+                separator = "\n    " if empty else ",\n    "
+                encoded = encode_record(record, default=default, newline="\n    ")
+                f.write(separator)
+                f.write(encoded)
+                written += len(separator) + len(encoded)
+                empty = False
+
+            if not empty:
+                f.write("\n")
+            f.write("]\n")
+
+        replace_durably(temp_filename, filename)
+
+    except BaseException:
+        # don't leave a half-written history lying around.
+        if os.path.isfile(temp_filename):
+            os.remove(temp_filename)
+        raise
+
+    if migrated:
+        mark_migrated(filename)
+    elif os.path.isfile(format_filename(filename)):
+        os.remove(format_filename(filename))
+
+    return offset
+
+
+def format_filename(filename: str) -> str:
+    """
+    Get the marker file saying a history file is migrated.
+
+    :param filename: history filename.
+    :returns: marker filename.
+    """
+    return f"{filename}.format"
+
+
+def mark_migrated(filename: str) -> None:
+    """
+    Mark a history file as holding only modern records,
+    so loading it can skip upgrading and repairing them.
+    The mark only holds until the file changes.
+
+    :param filename: history filename.
+    :returns: None
+    """
+    stat = os.stat(filename)
+    marker = format_filename(filename)
+
+    # no need to be durable, a lost marker only costs a slower load.
+    with open(f"{marker}.tmp", "w") as f:
+        json.dump({"format": HISTORY_FORMAT, "size": stat.st_size, "mtime_ns": stat.st_mtime_ns,
+                   "inode": stat.st_ino}, f, sort_keys=True)
+    os.replace(f"{marker}.tmp", marker)
+
+
+def is_migrated(filename: str) -> bool:
+    """
+    Check whether a history file is marked as holding only modern records,
+    and hasn't changed since.
+
+    :param filename: history filename.
+    :returns: whether the file is migrated.
+    """
+    try:
+        stat = os.stat(filename)
+        with open(format_filename(filename)) as f:
+            marker = json.load(f)
+    except (OSError, ValueError):
+        return False
+
+    return isinstance(marker, dict) and marker.get("format") == HISTORY_FORMAT and \
+        marker.get("size") == stat.st_size and marker.get("mtime_ns") == stat.st_mtime_ns and \
+        marker.get("inode") == stat.st_ino
+
+
+def replace_durably(temp_filename: str, filename: str) -> None:
+    """
+    Replace a file with a finished temporary file,
+    flushing both to disk so the new contents survive a crash or power loss.
+
+    :param temp_filename: complete temporary file.
+    :param filename: file to replace.
+    :returns: None
+    """
+    _fsync(temp_filename, os.O_RDONLY)
+    os.replace(temp_filename, filename)
+
+    # the rename itself lives in the directory.
+    # not every platform can open a directory, and that's ok.
+    if hasattr(os, "O_DIRECTORY"):
+        _fsync(os.path.dirname(os.path.abspath(filename)), os.O_RDONLY | os.O_DIRECTORY)
+
+
+def encode_record(
+        record: Any,
+        *,
+        default: Callable[[Any], Any]=None,
+        newline: str="\n",
+) -> str:
+    """
+    Encode a record exactly like json.dumps(record, sort_keys=True, indent=4),
+    starting at the indentation given by newline.
+    json only uses its C encoder without indent,
+    so this does the same work with less Python in the way.
+
+    :param record: record to encode.
+    :param default: json default hook for objects json can't encode itself.
+    :param newline: newline plus indentation the record starts at.
+    :returns: encoded record.
+    """
+    parts: List[str] = []
+    markers: Dict[int, Any] = {}
+
+    def encode(obj: Any, newline: str) -> None:
+        if isinstance(obj, str):
+            parts.append(encode_basestring_ascii(obj))
+        elif obj is None:
+            parts.append("null")
+        elif obj is True:
+            parts.append("true")
+        elif obj is False:
+            parts.append("false")
+        elif isinstance(obj, int):
+            parts.append(int.__repr__(obj))
+        elif isinstance(obj, float):
+            parts.append(_encode_float(obj))
+        elif isinstance(obj, (list, tuple)):
+            if not obj:
+                parts.append("[]")
+                return
+
+            _mark(markers, obj)
+            inner = newline + INDENT
+            separator = "," + inner
+            parts.append("[")
+            for index, value in enumerate(obj):
+                parts.append(separator if index else inner)
+                encode(value, inner)
+            parts.append(newline + "]")
+            del markers[id(obj)]
+        elif isinstance(obj, dict):
+            if not obj:
+                parts.append("{}")
+                return
+
+            _mark(markers, obj)
+            inner = newline + INDENT
+            separator = "," + inner
+            parts.append("{")
+            for index, (key, value) in enumerate(sorted(obj.items())):
+                parts.append(separator if index else inner)
+                parts.append(encode_basestring_ascii(_encode_key(key)))
+                parts.append(": ")
+                encode(value, inner)
+            parts.append(newline + "}")
+            del markers[id(obj)]
+        else:
+            if default is None:
+                raise TypeError(f"Object of type {obj.__class__.__name__} "
+                                f"is not JSON serializable")
+
+            _mark(markers, obj)
+            encode(default(obj), newline)
+            del markers[id(obj)]
+
+    encode(record, newline)
+    return "".join(parts)
+
+
+def iter_json_array(
+        f: IO[str],
+        chunk_size: int=READ_CHUNK_SIZE,
+        *,
+        inside: bool=False,
+) -> Iterator[Any]:
+    """
+    Incrementally decode a JSON array from a text file,
+    yielding each element as soon as it has been read.
+
+    :param f: text file positioned at the start of the array.
+    :param chunk_size: characters to read at a time.
+    :param inside: f is positioned inside the array instead,
+        just before an element or the separator before it.
+    :returns: iterator of array elements.
+    :raises json.decoder.JSONDecodeError: if the file isn't a JSON array.
+    """
+    decoder = json.JSONDecoder()
+    buffer = ""
+    position = 0
+    eof = False
+    started = inside
+
+    def fill() -> bool:
+        nonlocal buffer, position, eof
+        chunk = f.read(chunk_size)
+        if not chunk:
+            eof = True
+            return False
+
+        buffer = buffer[position:] + chunk
+        position = 0
+        return True
+
+    while True:
+        # skip whitespace and separators.
+        while True:
+            while position < len(buffer) and buffer[position] in " \t\r\n":
+                position += 1
+            if position < len(buffer) or not fill():
+                break
+
+        if position >= len(buffer):
+            raise json.decoder.JSONDecodeError("Expecting value", buffer, position)
+
+        char = buffer[position]
+        if not started:
+            if char != "[":
+                raise json.decoder.JSONDecodeError("Expecting '['", buffer, position)
+            started = True
+            position += 1
+            continue
+
+        if char == "]":
+            return
+
+        if char == ",":
+            position += 1
+            continue
+
+        while True:
+            try:
+                value, end = decoder.raw_decode(buffer, position)
+            except json.decoder.JSONDecodeError:
+                if not fill():
+                    raise
+                continue
+
+            # a number cut off by the end of a chunk decodes fine, but wrong.
+            # only trust a value once we can see what follows it.
+            if not eof and (end == len(buffer) or buffer[end] not in " \t\r\n,]") and fill():
+                continue
+
+            break
+
+        position = end
+        yield value
+
+
+def _fsync(filename: str, flags: int) -> None:
+    """Flush a file or directory to disk."""
+    fd = os.open(filename, flags)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _mark(markers: Dict[int, Any], obj: Any) -> None:
+    """Catch circular references, like json does."""
+    if id(obj) in markers:
+        raise ValueError("Circular reference detected")
+    markers[id(obj)] = obj
+
+
+def _encode_key(key: Any) -> str:
+    """Turn a dict key into a string, like json does."""
+    if isinstance(key, str):
+        return key
+    elif key is True:
+        return "true"
+    elif key is False:
+        return "false"
+    elif key is None:
+        return "null"
+    elif isinstance(key, float):
+        return _encode_float(key)
+    elif isinstance(key, int):
+        return int.__repr__(key)
+
+    raise TypeError(f"keys must be str, int, float, bool or None, "
+                    f"not {key.__class__.__name__}")
+
+
+def _encode_float(value: float) -> str:
+    """Encode a float, like json does."""
+    if value != value:
+        return "NaN"
+    elif value == INFINITY:
+        return "Infinity"
+    elif value == -INFINITY:
+        return "-Infinity"
+
+    return float.__repr__(value)
+
+
+def parse_timestamp(timestamp: Any) -> Optional[datetime]:
+    """
+    Parse a record timestamp, as written by datetime.isoformat.
+
+    :param timestamp: timestamp string.
+    :returns: datetime, or None if the timestamp can't be understood.
+    """
+    if not isinstance(timestamp, str):
+        return None
+
+    for timestamp_format in ("%Y-%m-%dT%H:%M:%S.%f", "%Y-%m-%dT%H:%M:%S"):
+        try:
+            return datetime.strptime(timestamp, timestamp_format)
+        except ValueError:
+            continue
+
+    return None
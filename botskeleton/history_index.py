@@ -0,0 +1,277 @@
+"""Indexes over bot history, so lookups don't scan every record."""
+import bisect
+import threading
+from datetime import datetime
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple, Union
+
+# older records only have their output's own id field.
+ID_FIELDS = ("id", "tweet_id", "toot_id", "post_id")
+
+Key = Tuple[str, str]
+Timestamp = Union[datetime, str]
+
+
+class HistoryIndex:
+    """
+    Indexes over a history list,
+    by post id, in_reply_to_id, output key, error code, timestamp and extra_keys value.
+
+    Records are numbered by their position in history plus how many records have been
+    trimmed off the front (see trim),
+    so records appended to history are indexed incrementally on the next lookup,
+    and nothing already indexed is revisited.
+    Replacing the history list outright causes a full rebuild.
+    """
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+
+        # history list being indexed, and the sequence numbers of its first record
+        # and of the record after the last one indexed.
+        self._source: Optional[List[Any]] = None
+        self._base = 0
+        self._indexed = 0
+
+        self._outputs: Set[str] = set()
+        self._by_id: Dict[Key, List[int]] = {}
+        self._by_reply: Dict[Key, List[int]] = {}
+        self._by_error: Dict[Key, List[int]] = {}
+        self._by_output: Dict[str, List[int]] = {}
+        self._by_extra: Dict[str, Dict[Any, List[int]]] = {}
+        self._unhashable_extra: Dict[str, List[int]] = {}
+        self._timestamps: List[Tuple[str, int]] = []
+
+    def query(
+            self,
+            history: List[Any],
+            *,
+            post_id: Any=None,
+            in_reply_to_id: Any=None,
+            output: str=None,
+            since: Timestamp=None,
+            until: Timestamp=None,
+            error_code: Any=None,
+            extra_keys: Dict[str, Any]=None,
+    ) -> List[Any]:
+        """
+        Find records in history matching all of the given conditions.
+
+        :param history: history list to search,
+            the one this index is kept for.
+        :param post_id: id of a post made by an output (tweet id, toot id, etc).
+            compared as a string, so 123 and "123" are the same.
+        :param in_reply_to_id: id of a post an output replied to.
+        :param output: output key, like "birdsite".
+            narrows the id and error conditions to that output.
+        :param since: only records at or after this time.
+            datetime or isoformat string.
+        :param until: only records before this time.
+            datetime or isoformat string.
+        :param error_code: only records with an output error with this code.
+            errors without a code have code "unknown".
+        :param extra_keys: dict of extra_keys entries records must have.
+        :returns: list of matching records, oldest first.
+        """
+        with self._lock:
+            self._sync(history)
+
+            candidates: List[Set[int]] = []
+            outputs = [output] if output is not None else sorted(self._outputs)
+
+            if output is not None:
+                candidates.append(set(self._by_output.get(output, [])))
+
+            for index, value in ((self._by_id, post_id),
+                                 (self._by_reply, in_reply_to_id),
+                                 (self._by_error, error_code)):
+                if value is not None:
+                    candidates.append(_union(index.get((key, str(value)), [])
+                                             for key in outputs))
+
+            if since is not None or until is not None:
+                candidates.append(self._time_range(since, until))
+
+            for name, value in (extra_keys or {}).items():
+                candidates.append(self._extra_matches(history, name, value))
+
+            if not candidates:
+                return list(history)
+
+            candidates.sort(key=len)
+            matches = candidates[0].intersection(*candidates[1:])
+            return [history[seq - self._base] for seq in sorted(matches)]
+
+    def invalidate(self) -> None:
+        """
+        Forget everything, so the next lookup indexes history from scratch.
+        For when records already indexed change.
+
+        :returns: None
+        """
+        with self._lock:
+            self._clear(None)
+
+    def trim(self, count: int, history: List[Any]) -> None:
+        """
+        Note that count records were removed from the front of history,
+        like archive_history does.
+
+        :param count: number of records removed.
+        :param history: history list after removal.
+        :returns: None
+        """
+        with self._lock:
+            if self._source is None or self._indexed - self._base < count:
+                self._clear(history)
+                return
+
+            self._base += count
+            self._source = history
+
+            for index in (self._by_id, self._by_reply, self._by_error, self._by_output):
+                _prune(index, self._base)
+            for values in self._by_extra.values():
+                _prune(values, self._base)
+            _prune(self._unhashable_extra, self._base)
+
+            self._timestamps = [entry for entry in self._timestamps if entry[1] >= self._base]
+
+    def _clear(self, history: Optional[List[Any]]) -> None:
+        """Forget everything, starting over for a history list."""
+        self._source = history
+        self._base = 0
+        self._indexed = 0
+
+        self._outputs = set()
+        self._by_id = {}
+        self._by_reply = {}
+        self._by_error = {}
+        self._by_output = {}
+        self._by_extra = {}
+        self._unhashable_extra = {}
+        self._timestamps = []
+
+    def _sync(self, history: List[Any]) -> None:
+        """Index records appended to history since last time, or rebuild if it was replaced."""
+        if history is not self._source or len(history) < self._indexed - self._base:
+            self._clear(history)
+
+        for position in range(self._indexed - self._base, len(history)):
+            self._add(history[position], self._base + position)
+
+        self._indexed = self._base + len(history)
+
+    def _add(self, record: Any, seq: int) -> None:
+        """Add one record to all indexes."""
+        timestamp = _field(record, "timestamp")
+        if timestamp is not None:
+            entry = (str(timestamp), seq)
+            if not self._timestamps or self._timestamps[-1] <= entry:
+                self._timestamps.append(entry)
+            else:
+                bisect.insort(self._timestamps, entry)
+
+        for name, value in (_field(record, "extra_keys") or {}).items():
+            try:
+                _append(self._by_extra.setdefault(name, {}), value, seq)
+            except TypeError:
+                _append(self._unhashable_extra, name, seq)
+
+        for key, output_records in (_field(record, "output_records") or {}).items():
+            self._outputs.add(key)
+            _append(self._by_output, key, seq)
+
+            if not isinstance(output_records, list):
+                output_records = [output_records]
+
+            for output_record in output_records:
+                post_id = _post_id(output_record)
+                if post_id is not None:
+                    _append(self._by_id, (key, str(post_id)), seq)
+
+                in_reply_to_id = _field(output_record, "in_reply_to_id")
+                if in_reply_to_id is not None:
+                    _append(self._by_reply, (key, str(in_reply_to_id)), seq)
+
+                if _field(output_record, "error") is not None:
+                    code = _field(output_record, "error_code")
+                    code = "unknown" if code is None else code
+                    _append(self._by_error, (key, str(code)), seq)
+
+    def _time_range(self, since: Optional[Timestamp], until: Optional[Timestamp]) -> Set[int]:
+        """Get records in a time range."""
+        start = 0
+        if since is not None:
+            start = bisect.bisect_left(self._timestamps, (_isoformat(since), -1))
+
+        end = len(self._timestamps)
+        if until is not None:
+            end = bisect.bisect_left(self._timestamps, (_isoformat(until), -1))
+
+        return {seq for _, seq in self._timestamps[start:end]}
+
+    def _extra_matches(self, history: List[Any], name: str, value: Any) -> Set[int]:
+        """Get records with an extra key set to a value."""
+        try:
+            matches = set(self._by_extra.get(name, {}).get(value, []))
+        except TypeError:
+            matches = set()
+
+        # unhashable values (lists, dicts) can't be keys, so check those records directly.
+        for seq in self._unhashable_extra.get(name, []):
+            if (_field(history[seq - self._base], "extra_keys") or {}).get(name) == value:
+                matches.add(seq)
+
+        return matches
+
+
+def _field(record: Any, name: str) -> Any:
+    """Get a field from a record, or from a record still in dict form."""
+    if isinstance(record, dict):
+        return record.get(name)
+
+    return getattr(record, name, None)
+
+
+def _post_id(output_record: Any) -> Any:
+    """Get the id of the post an output record is for."""
+    for name in ID_FIELDS:
+        post_id = _field(output_record, name)
+        if post_id is not None:
+            return post_id
+
+    return None
+
+
+def _append(index: Dict[Any, List[int]], key: Any, seq: int) -> None:
+    """Add a record to an index entry, once."""
+    seqs = index.setdefault(key, [])
+    if not seqs or seqs[-1] != seq:
+        seqs.append(seq)
+
+
+def _prune(index: Dict[Any, List[int]], base: int) -> None:
+    """Drop records before base from an index."""
+    for key in list(index):
+        seqs = index[key]
+        start = bisect.bisect_left(seqs, base)
+        if start == len(seqs):
+            del index[key]
+        elif start > 0:
+            index[key] = seqs[start:]
+
+
+def _union(seq_lists: Iterable[List[int]]) -> Set[int]:
+    """Union of several index entries."""
+    union: Set[int] = set()
+    for seqs in seq_lists:
+        union.update(seqs)
+
+    return union
+
+
+def _isoformat(timestamp: Timestamp) -> str:
+    """Get timestamp in the form records store it, which sorts correctly as a string."""
+    if isinstance(timestamp, datetime):
+        return timestamp.isoformat()
+
+    return timestamp
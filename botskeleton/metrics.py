@@ -0,0 +1,288 @@
+"""Counters and latency histograms for bots and their outputs."""
+import bisect
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from types import TracebackType
+from typing import Any, Dict, List, Optional, Sequence, Tuple, Type
+
+from .simulation import Clock
+
+# seconds. covers everything from a local loopback call to a very sad upload.
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+class Histogram:
+    """Bucketed distribution of observed values."""
+    def __init__(self, buckets: Sequence[float]=DEFAULT_BUCKETS) -> None:
+        self.buckets = sorted(buckets)
+        self.bucket_counts = [0] * len(self.buckets)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float) -> None:
+        """
+        Add a value to the histogram.
+
+        :param value: value to add.
+        :returns: None
+        """
+        index = bisect.bisect_left(self.buckets, value)
+        if index < len(self.bucket_counts):
+            self.bucket_counts[index] += 1
+
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def cumulative_counts(self) -> List[int]:
+        """Get count of values less than or equal to each bucket bound."""
+        total = 0
+        counts = []
+        for bucket_count in self.bucket_counts:
+            total += bucket_count
+            counts.append(total)
+
+        return counts
+
+    def to_dict(self) -> Dict[str, Any]:
+        """Get plain dict copy of histogram."""
+        return {
+            "buckets": dict(zip(self.buckets, self.cumulative_counts())),
+            "count": self.count,
+            "sum": self.sum,
+            "max": self.max,
+            "mean": self.sum / self.count if self.count else 0.0,
+        }
+
+
+class Timer:
+    """Context manager timing a block into a histogram."""
+    def __init__(self, metrics: "Metrics", name: str, labels: Dict[str, Any]) -> None:
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+        self.start = 0.0
+        self.elapsed = 0.0
+
+    def __enter__(self) -> "Timer":
+        self.start = self.metrics.clock.perf_counter()
+        return self
+
+    def __exit__(
+            self,
+            exc_type: Optional[Type[BaseException]],
+            exc_value: Optional[BaseException],
+            traceback: Optional[TracebackType],
+    ) -> None:
+        self.elapsed = self.metrics.clock.perf_counter() - self.start
+        self.metrics.observe(self.name, self.elapsed, **self.labels)
+
+
+class Metrics:
+    """
+    In-process store of counters and histograms.
+    Safe to use from several threads.
+    """
+    def __init__(self, *, prefix: str="botskeleton",
+                 buckets: Sequence[float]=DEFAULT_BUCKETS, clock: Clock=None) -> None:
+        self.prefix = prefix
+        self.buckets = buckets
+
+        # what durations are measured with (simulated in dry-run mode).
+        self.clock = clock if clock is not None else Clock()
+
+        self._counters: Dict[str, Dict[Labels, float]] = {}
+        self._histograms: Dict[str, Dict[Labels, Histogram]] = {}
+        self._lock = threading.Lock()
+        self._server: Optional[HTTPServer] = None
+
+    def inc(self, name: str, amount: float=1, **labels: Any) -> None:
+        """
+        Increment a counter.
+
+        :param name: name of counter, like posts_total.
+        :param amount: amount to increment by.
+        :param labels: labels to split the counter by, like output="birdsite".
+        :returns: None
+        """
+        key = _labels(labels)
+        with self._lock:
+            counter = self._counters.setdefault(name, {})
+            counter[key] = counter.get(key, 0) + amount
+
+    def observe(self, name: str, value: float, **labels: Any) -> None:
+        """
+        Add a value to a histogram.
+
+        :param name: name of histogram, like operation_seconds.
+        :param value: value to add.
+        :param labels: labels to split the histogram by.
+        :returns: None
+        """
+        key = _labels(labels)
+        with self._lock:
+            histograms = self._histograms.setdefault(name, {})
+            histogram = histograms.get(key)
+            if histogram is None:
+                histogram = Histogram(self.buckets)
+                histograms[key] = histogram
+
+            histogram.observe(value)
+
+    def time(self, name: str, **labels: Any) -> Timer:
+        """
+        Time a block of code into a histogram.
+        The Timer keeps the elapsed time around after the block ends.
+
+        :param name: name of histogram.
+        :param labels: labels to split the histogram by.
+        :returns: Timer context manager.
+        """
+        return Timer(self, name, labels)
+
+    def counter(self, name: str, **labels: Any) -> float:
+        """
+        Get current value of a counter.
+
+        :param name: name of counter.
+        :param labels: labels of counter.
+        :returns: value of counter, 0 if never incremented.
+        """
+        with self._lock:
+            return self._counters.get(name, {}).get(_labels(labels), 0)
+
+    def histogram(self, name: str, **labels: Any) -> Optional[Dict[str, Any]]:
+        """
+        Get current state of a histogram.
+
+        :param name: name of histogram.
+        :param labels: labels of histogram.
+        :returns: dict of histogram state, None if never observed.
+        """
+        with self._lock:
+            histogram = self._histograms.get(name, {}).get(_labels(labels))
+            return histogram.to_dict() if histogram is not None else None
+
+    def snapshot(self) -> Dict[str, Any]:
+        """
+        Get a copy of everything recorded so far.
+
+        :returns: dict with "counters" and "histograms",
+            each mapping names to lists of {"labels": ..., "value"/"histogram": ...} entries.
+        """
+        with self._lock:
+            return {
+                "counters": {
+                    name: [{"labels": dict(key), "value": value}
+                           for key, value in sorted(series.items())]
+                    for name, series in self._counters.items()
+                },
+                "histograms": {
+                    name: [{"labels": dict(key), "histogram": histogram.to_dict()}
+                           for key, histogram in sorted(series.items())]
+                    for name, series in self._histograms.items()
+                },
+            }
+
+    def render_prometheus(self) -> str:
+        """
+        Render everything in the Prometheus text exposition format.
+
+        :returns: metrics text.
+        """
+        lines = []
+        with self._lock:
+            for name, series in sorted(self._counters.items()):
+                full_name = f"{self.prefix}_{name}"
+                lines.append(f"# TYPE {full_name} counter")
+                for key, value in sorted(series.items()):
+                    lines.append(f"{full_name}{_render_labels(key)} {value}")
+
+            for name, histograms in sorted(self._histograms.items()):
+                full_name = f"{self.prefix}_{name}"
+                lines.append(f"# TYPE {full_name} histogram")
+                for key, histogram in sorted(histograms.items()):
+                    for bound, count in zip(histogram.buckets, histogram.cumulative_counts()):
+                        bucket_key = key + (("le", str(bound)),)
+                        lines.append(f"{full_name}_bucket{_render_labels(bucket_key)} {count}")
+
+                    inf_key = key + (("le", "+Inf"),)
+                    lines.append(f"{full_name}_bucket{_render_labels(inf_key)} "
+                                 f"{histogram.count}")
+                    lines.append(f"{full_name}_sum{_render_labels(key)} {histogram.sum}")
+                    lines.append(f"{full_name}_count{_render_labels(key)} {histogram.count}")
+
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, filename: str) -> None:
+        """
+        Write metrics to a file in Prometheus text format,
+        for something like the node exporter textfile collector to pick up.
+        The file is replaced atomically so readers never see a partial write.
+
+        :param filename: file to write.
+        :returns: None
+        """
+        # several threads may write at once, so each gets its own temporary file.
+        temp_filename = f"{filename}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temp_filename, "w") as f:
+            f.write(self.render_prometheus())
+
+        os.replace(temp_filename, filename)
+
+    def serve(self, *, port: int, host: str="127.0.0.1") -> HTTPServer:
+        """
+        Serve metrics over HTTP from a background thread.
+
+        :param port: port to listen on.
+        :param host: host to listen on.
+            defaults to localhost only.
+        :returns: the server, in case the caller wants to shut it down.
+        """
+        metrics = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self) -> None:
+                body = metrics.render_prometheus().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format: str, *args: Any) -> None:
+                # scrapes are not interesting enough to log.
+                pass
+
+        self._server = _ThreadingHTTPServer((host, port), MetricsHandler)
+        thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        thread.start()
+        return self._server
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def _labels(labels: Dict[str, Any]) -> Labels:
+    """Turn label kwargs into a hashable, ordered key."""
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+def _render_labels(key: Labels) -> str:
+    """Render labels in Prometheus format."""
+    if not key:
+        return ""
+
+    rendered = ",".join(f'{name}="{_escape(value)}"' for name, value in key)
+    return f"{{{rendered}}}"
+
+
+def _escape(value: str) -> str:
+    """Escape a label value for Prometheus."""
+    return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
@@ -0,0 +1,122 @@
+"""Offline migration of history files to the modern format, so loading them is quicker."""
+import argparse
+import multiprocessing
+import os
+from itertools import islice
+from shutil import copyfile
+from typing import Any, Dict, Iterable, Iterator, List, Sequence
+
+from .botskeleton import upgrade_record
+from .history import is_migrated, read_history, write_history
+from .records import json_default
+
+# records handed to a worker process at a time.
+CHUNK_SIZE = 1000
+
+
+def migrate_history(
+        source: str,
+        *,
+        destination: str=None,
+        workers: int=None,
+        chunk_size: int=CHUNK_SIZE,
+        backup: bool=True,
+) -> int:
+    """
+    Upgrade and repair every record of a history file,
+    writing a file marked as migrated,
+    which load_history reads without upgrading or repairing anything.
+    The file is streamed,
+    and records are upgraded by several processes in chunks,
+    so huge histories don't need memory for all of them at once.
+
+    :param source: history file to migrate, compressed or not.
+    :param destination: file to write (default replacing source).
+        compressed by extension.
+    :param workers: processes to upgrade records with (default one per CPU).
+        1 does everything in this process.
+    :param chunk_size: records handed to a worker at a time.
+    :param backup: when replacing source,
+        copy it to SOURCE.bak first.
+    :returns: number of records migrated.
+    """
+    if destination is None:
+        destination = source
+        if backup:
+            copyfile(source, f"{source}.bak")
+
+    chunks = _chunks(read_history(source, stream=True), chunk_size)
+    count = 0
+
+    def records(upgraded: Iterable[List[Dict[str, Any]]]) -> Iterator[Dict[str, Any]]:
+        nonlocal count
+        for chunk in upgraded:
+            count += len(chunk)
+            yield from chunk
+
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    # a single worker process would only add pickling overhead.
+    if workers <= 1:
+        write_history(destination, records(map(_upgrade_chunk, chunks)), default=json_default,
+                      migrated=True)
+    else:
+        with multiprocessing.Pool(workers) as pool:
+            # imap keeps chunks in order, and only a few ahead of the writer.
+            write_history(destination, records(pool.imap(_upgrade_chunk, chunks)),
+                          default=json_default, migrated=True)
+
+    return count
+
+
+def main(argv: Sequence[str]=None) -> None:
+    """
+    Command-line entry point, botskeleton-migrate.
+
+    :param argv: arguments (default sys.argv).
+    :returns: None
+    """
+    parser = argparse.ArgumentParser(
+        prog="botskeleton-migrate",
+        description="Upgrade and repair a botskeleton history file once, "
+                    "so bots don't repeat the work every time they start.",
+    )
+    parser.add_argument("history", help="history file to migrate")
+    parser.add_argument("-o", "--output",
+                        help="file to write the migrated history to (default: in place)")
+    parser.add_argument("-j", "--workers", type=int, default=None,
+                        help="processes to use (default: one per CPU)")
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE,
+                        help=f"records per worker task (default: {CHUNK_SIZE})")
+    parser.add_argument("--no-backup", action="store_true",
+                        help="don't keep HISTORY.bak when migrating in place")
+    parser.add_argument("--force", action="store_true",
+                        help="migrate even if the file is already migrated")
+    args = parser.parse_args(argv)
+
+    if args.output is None and is_migrated(args.history) and not args.force:
+        print(f"{args.history} is already migrated.")
+        return
+
+    count = migrate_history(args.history, destination=args.output, workers=args.workers,
+                            chunk_size=args.chunk_size, backup=not args.no_backup)
+    print(f"Migrated {count} records from {args.history} to {args.output or args.history}.")
+
+
+def _chunks(items: Iterator[Dict[str, Any]], size: int) -> Iterator[List[Dict[str, Any]]]:
+    """Split records into lists of up to size."""
+    while True:
+        chunk = list(islice(items, max(1, size)))
+        if not chunk:
+            return
+        yield chunk
+
+
+def _upgrade_chunk(chunk: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Upgrade and repair a chunk of record dicts. Runs in worker processes."""
+    return [upgrade_record(hdict).to_dict() for hdict in chunk]
+
+
+if __name__ == "__main__":
+    main()
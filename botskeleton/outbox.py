@@ -0,0 +1,258 @@
+"""Durable queue of posts waiting to be delivered to outputs."""
+import json
+import os
+import threading
+import time
+from logging import Logger
+from os import path
+from typing import Any, Callable, Dict, List, Optional
+
+from .history import replace_durably
+from .records import json_default
+
+
+class Outbox:
+    """
+    Queue of posts kept on disk,
+    one JSON file per post,
+    delivered by a background worker.
+
+    The worker hands each entry to a deliver callback.
+    The callback may change the entry (to note which outputs are done, for example),
+    and returns True once the entry is finished.
+    Otherwise the entry is saved and retried later, with exponential backoff.
+    Entries that still fail after max_attempts,
+    or whose callback keeps raising,
+    are set aside as ENTRY.json.failed.
+
+    Delivery is at least once:
+    a crash between posting and saving the entry means posting again after a restart.
+    """
+    def __init__(
+            self,
+            *,
+            directory: str,
+            deliver: Callable[[Dict[str, Any]], bool],
+            max_attempts: int=5,
+            retry_delay: float=60.0,
+            log: Logger=None,
+    ) -> None:
+        """
+        Create outbox, picking up entries left from earlier runs.
+
+        :param directory: directory to keep entries in.
+            created if it doesn't exist.
+        :param deliver: callback delivering an entry,
+            returning whether it's finished.
+        :param max_attempts: attempts before an entry is given up on.
+        :param retry_delay: seconds before the first retry,
+            doubling with every attempt after that.
+        :param log: logger to use (optional).
+        """
+        self.directory = directory
+        self.deliver = deliver
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.log = log
+
+        self._condition = threading.Condition()
+        self._counter = 0
+        self._busy = False
+        self._stopping = False
+        self._thread: Optional[threading.Thread] = None
+
+        os.makedirs(self.directory, exist_ok=True)
+
+        self._entries: Dict[str, Dict[str, Any]] = {}
+        for file in sorted(os.listdir(self.directory)):
+            if file.endswith(".json"):
+                with open(path.join(self.directory, file)) as f:
+                    entry = json.load(f)
+                self._entries[entry["id"]] = entry
+
+    def enqueue(self, entry: Dict[str, Any]) -> str:
+        """
+        Add an entry to the outbox,
+        on disk before this returns.
+
+        :param entry: JSON-compatible dict describing what to deliver.
+        :returns: id of entry.
+        """
+        with self._condition:
+            self._counter += 1
+            entry_id = f"{int(time.time() * 1000000):016d}-{os.getpid()}-{self._counter:06d}"
+
+        entry = dict(entry, id=entry_id, attempts=0, not_before=0.0)
+        self._save(entry)
+
+        with self._condition:
+            self._entries[entry_id] = entry
+            self._condition.notify_all()
+
+        return entry_id
+
+    def pending(self) -> List[Dict[str, Any]]:
+        """
+        Get entries not yet delivered, oldest first.
+
+        :returns: list of entries.
+        """
+        with self._condition:
+            return [dict(self._entries[entry_id]) for entry_id in sorted(self._entries)]
+
+    def start(self) -> None:
+        """
+        Start delivering in a background thread.
+
+        :returns: None
+        """
+        with self._condition:
+            if self._thread is not None:
+                return
+
+            self._stopping = False
+            self._thread = threading.Thread(target=self._work, name="botskeleton-outbox",
+                                            daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout: float=None) -> None:
+        """
+        Stop the background worker,
+        letting a delivery in progress finish.
+        Undelivered entries stay on disk.
+
+        :param timeout: seconds to wait for the worker (optional).
+        :returns: None
+        """
+        with self._condition:
+            thread = self._thread
+            self._stopping = True
+            self._condition.notify_all()
+
+        if thread is not None:
+            thread.join(timeout)
+
+        with self._condition:
+            self._thread = None
+
+    def drain(self, timeout: float=None) -> bool:
+        """
+        Wait for the outbox to empty,
+        retries included.
+
+        :param timeout: seconds to wait at most (optional).
+        :returns: whether the outbox is empty.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._condition:
+            while self._entries or self._busy:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+
+                self._condition.wait(remaining)
+
+        return True
+
+    def run_pending(self) -> int:
+        """
+        Deliver every entry that is due, in this thread.
+
+        :returns: number of entries attempted.
+        """
+        attempted = 0
+        while True:
+            with self._condition:
+                entry = self._next_due()
+                if entry is None:
+                    return attempted
+                self._busy = True
+
+            self._attempt(entry)
+            attempted += 1
+
+    def _work(self) -> None:
+        """Deliver entries as they become due, until stopped."""
+        while True:
+            with self._condition:
+                entry = None
+                while entry is None and not self._stopping:
+                    entry = self._next_due()
+                    if entry is None:
+                        self._condition.wait(self._next_wait())
+
+                # only stopping gets us here without an entry.
+                if entry is None:
+                    return
+
+                self._busy = True
+
+            self._attempt(entry)
+
+    def _attempt(self, entry: Dict[str, Any]) -> None:
+        """Try to deliver an entry once. Must be called with _busy set."""
+        entry["attempts"] += 1
+        try:
+            done = self.deliver(entry)
+        except Exception:
+            done = False
+            if self.log is not None:
+                self.log.exception(f"Delivering outbox entry {entry['id']} failed.")
+
+        with self._condition:
+            try:
+                if done:
+                    os.remove(self._filename(entry))
+                    del self._entries[entry["id"]]
+
+                elif entry["attempts"] >= self.max_attempts:
+                    if self.log is not None:
+                        self.log.error(f"Giving up on outbox entry {entry['id']} after "
+                                       f"{entry['attempts']} attempts.")
+                    self._save(entry)
+                    os.replace(self._filename(entry), f"{self._filename(entry)}.failed")
+                    del self._entries[entry["id"]]
+
+                else:
+                    delay = self.retry_delay * 2 ** (entry["attempts"] - 1)
+                    entry["not_before"] = time.time() + delay
+                    self._save(entry)
+
+            finally:
+                self._busy = False
+                self._condition.notify_all()
+
+    def _next_due(self) -> Optional[Dict[str, Any]]:
+        """Get the oldest entry due for delivery. Must be called with the lock held."""
+        # one delivery at a time, so outputs see posts in order.
+        if self._busy:
+            return None
+
+        now = time.time()
+        for entry_id in sorted(self._entries):
+            entry = self._entries[entry_id]
+            if entry["not_before"] <= now:
+                return entry
+
+        return None
+
+    def _next_wait(self) -> Optional[float]:
+        """Get seconds until the next entry is due. Must be called with the lock held."""
+        if self._busy or not self._entries:
+            return None
+
+        soonest = min(entry["not_before"] for entry in self._entries.values())
+        return max(0.0, soonest - time.time())
+
+    def _save(self, entry: Dict[str, Any]) -> None:
+        """Write an entry to disk, atomically."""
+        filename = self._filename(entry)
+        temp_filename = f"{filename}.tmp"
+        with open(temp_filename, "w") as f:
+            json.dump(entry, f, sort_keys=True, default=json_default)
+
+        replace_durably(temp_filename, filename)
+
+    def _filename(self, entry: Dict[str, Any]) -> str:
+        """Get the file an entry is kept in."""
+        return path.join(self.directory, f"{entry['id']}.json")
@@ -1,2 +1,17 @@
 """Output exports."""
-from .output_birdsite import BirdsiteSkeleton, TweetRecord
+import sys
+from typing import Any
+
+# outputs are imported lazily where the language allows,
+# so importing botskeleton doesn't import every client library.
+if sys.version_info < (3, 7):
+    from .output_birdsite import BirdsiteSkeleton, TweetRecord
+
+else:
+    def __getattr__(name: str) -> Any:
+        """Import birdsite exports on first use."""
+        if name in ("BirdsiteSkeleton", "TweetRecord"):
+            from . import output_birdsite
+            return getattr(output_birdsite, name)
+
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
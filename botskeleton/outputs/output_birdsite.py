@@ -2,12 +2,13 @@
 import html
 import json
 from logging import Logger
-from os import path
 from typing import Any, Callable, Dict, List, Optional, Tuple
 
 import tweepy
 
-from .output_utils import OutputRecord, OutputSkeleton
+from ..scheduling import RateLimit
+from ..sos import SosNotifier
+from .output_utils import OutputRecord, OutputSkeleton, PhaseTimings
 
 
 class BirdsiteSkeleton(OutputSkeleton):
@@ -15,6 +16,9 @@ class BirdsiteSkeleton(OutputSkeleton):
         """Set up birdsite skeleton stuff."""
         self.name = "BIRDSITE"
 
+        # newest mention seen by perform_mention_replies.
+        self.mention_since_id: Any = None
+
         self.handled_errors = {
             187: self.default_duplicate_handler,
         }
@@ -38,35 +42,24 @@ class BirdsiteSkeleton(OutputSkeleton):
         """
         super().__init__(secrets_dir=secrets_dir, log=log, bot_name=bot_name)
 
-        self.ldebug("Retrieving CONSUMER_KEY...")
-        with open(path.join(self.secrets_dir, "CONSUMER_KEY")) as f:
-            CONSUMER_KEY = f.read().strip()
-
-        self.ldebug("Retrieving CONSUMER_SECRET...")
-        with open(path.join(self.secrets_dir, "CONSUMER_SECRET")) as f:
-            CONSUMER_SECRET = f.read().strip()
-
-        self.ldebug("Retrieving ACCESS_TOKEN...")
-        with open(path.join(self.secrets_dir, "ACCESS_TOKEN")) as f:
-            ACCESS_TOKEN = f.read().strip()
-
-        self.ldebug("Retrieving ACCESS_SECRET...")
-        with open(path.join(self.secrets_dir, "ACCESS_SECRET")) as f:
-            ACCESS_SECRET = f.read().strip()
+        CONSUMER_KEY = self.read_credential("CONSUMER_KEY")
+        CONSUMER_SECRET = self.read_credential("CONSUMER_SECRET")
+        ACCESS_TOKEN = self.read_credential("ACCESS_TOKEN")
+        ACCESS_SECRET = self.read_credential("ACCESS_SECRET")
 
-        self.ldebug("Looking for OWNER_HANDLE...")
-        owner_handle_path = path.join(self.secrets_dir, "OWNER_HANDLE")
-        if path.isfile(owner_handle_path):
-            with open(owner_handle_path) as f:
-                self.owner_handle = f.read().strip()
-        else:
+        owner_handle = self.read_credential("OWNER_HANDLE", required=False)
+        if owner_handle is None:
             self.ldebug("Couldn't find OWNER_HANDLE, unable to DM...")
-            self.owner_handle = ""
+            owner_handle = ""
+        self.owner_handle = owner_handle
+        self.owner_id: Any = None
+        self.sos = SosNotifier(send=self._send_sos, log=self.log)
 
         self.auth = tweepy.OAuthHandler(CONSUMER_KEY, CONSUMER_SECRET)
         self.auth.set_access_token(ACCESS_TOKEN, ACCESS_SECRET)
 
-        self.api = tweepy.API(self.auth)
+        kwargs = {"timeout": self.timeout} if self.timeout is not None else {}
+        self.set_api_factory(lambda: tweepy.API(self.auth, **kwargs))
 
     def send(
             self,
@@ -81,15 +74,23 @@ class BirdsiteSkeleton(OutputSkeleton):
             each corresponding to either a single post,
             or an error.
         """
+        timings = self.phase_timings()
         try:
-            status = self.api.update_status(text)
-            return [TweetRecord(record_data={"tweet_id": status._json["id"], "text": text})]
+            with timings.phase("status_post"):
+                status = self.api.update_status(text)
+            return [TweetRecord(record_data={
+                "tweet_id": status._json["id"],
+                "text": text,
+                "timings": timings.to_dict(),
+            })]
 
         except tweepy.TweepError as e:
-            return [self.handle_error(
+            error_record = self.handle_error(
                 message=(f"Bot {self.bot_name} encountered an error when "
                  f"sending post {text} without media:\n{e}\n"),
-                error=e)]
+                error=e)
+            error_record.timings = timings.to_dict()
+            return [error_record]
 
     def send_with_media(
             self,
@@ -111,35 +112,47 @@ class BirdsiteSkeleton(OutputSkeleton):
             or an error.
         """
 
+        timings = self.phase_timings()
+
         # upload media
         media_ids = None
         try:
             self.ldebug(f"Uploading files {files}.")
-            media_ids = [self.api.media_upload(file).media_id_string for file in files]
+            media_ids = []
+            for file in files:
+                with timings.phase("media_upload"):
+                    media_ids.append(self.api.media_upload(file).media_id_string)
+                self.count_upload(file)
         except tweepy.TweepError as e:
-            return [self.handle_error(
+            error_record = self.handle_error(
                 message=f"Bot {self.bot_name} encountered an error when uploading {files}:\n{e}\n",
-                error=e)]
+                error=e)
+            error_record.timings = timings.to_dict()
+            return [error_record]
 
         # apply captions, if present
-        self._handle_caption_upload(media_ids=media_ids, captions=captions)
+        self._handle_caption_upload(media_ids=media_ids, captions=captions, timings=timings)
 
         # send status
         try:
-            status = self.api.update_status(status=text, media_ids=media_ids)
+            with timings.phase("status_post"):
+                status = self.api.update_status(status=text, media_ids=media_ids)
             return [TweetRecord(record_data={
                 "tweet_id": status._json["id"],
                 "text": text,
                 "media_ids": media_ids,
                 "captions": captions,
-                "files": files
+                "files": files,
+                "timings": timings.to_dict(),
             })]
 
         except tweepy.TweepError as e:
-            return [self.handle_error(
+            error_record = self.handle_error(
                 message=(f"Bot {self.bot_name} encountered an error when "
                  f"sending post {text} with media ids {media_ids}:\n{e}\n"),
-                error=e)]
+                error=e)
+            error_record.timings = timings.to_dict()
+            return [error_record]
 
     def perform_batch_reply(
             self,
@@ -173,7 +186,9 @@ class BirdsiteSkeleton(OutputSkeleton):
             base_target_handle = target_handle
 
         records: List[OutputRecord] = []
-        statuses = self.api.user_timeline(screen_name=base_target_handle, count=lookback_limit)
+        with self.timed("timeline_fetch"):
+            statuses = self.api.user_timeline(screen_name=base_target_handle,
+                                              count=lookback_limit)
         self.log.debug(f"Retrieved {len(statuses)} statuses.")
         for i, status in enumerate(statuses):
             self.log.debug(f"Processing status {i} of {len(statuses)}")
@@ -182,80 +197,188 @@ class BirdsiteSkeleton(OutputSkeleton):
             # find possible replies we've made.
             # the 10 * lookback_limit is a guess,
             # might not be enough and I'm not sure we can guarantee it is.
-            our_statuses = self.api.user_timeline(since_id=status_id,
-                                                  count=lookback_limit * 10)
+            with self.timed("timeline_fetch"):
+                our_statuses = self.api.user_timeline(since_id=status_id,
+                                                      count=lookback_limit * 10)
             in_reply_to_ids = list(map(lambda x: x.in_reply_to_status_id, our_statuses))
 
             if status_id not in in_reply_to_ids:
                 # the twitter API and tweepy will attempt to give us the truncated text of the
                 # message if we don't do this roundabout thing.
-                encoded_status_text = self.api.get_status(status_id,
-                                                  tweet_mode="extended")._json["full_text"]
-
-                status_text = html.unescape(encoded_status_text)
-                message = callback(message_id=status_id, message=status_text, extra_keys={})
-
-                full_message = f"@{base_target_handle} {message}"
-                self.log.info(f"Trying to reply with {message} to status {status_id} "
-                              f"from {target_handle}.")
-                try:
-                    new_status = self.api.update_status(status=full_message,
-                                                        in_reply_to_status_id=status_id)
-
-                    records.append(TweetRecord(record_data={
-                        "tweet_id": new_status.id,
-                        "in_reply_to": f"@{base_target_handle}",
-                        "in_reply_to_id": status_id,
-                        "text": full_message,
-                    }))
-
-                except tweepy.TweepError as e:
-                    records.append(self.handle_error(
-                        message=(f"Bot {self.bot_name} encountered an error when "
-                         f"trying to reply to {status_id} with {message}:\n{e}\n"),
-                        error=e))
+                with self.timed("status_fetch"):
+                    encoded_status_text = self.api.get_status(
+                        status_id, tweet_mode="extended")._json["full_text"]
+
+                records.append(self._reply(callback=callback, status_id=status_id,
+                                           status_text=encoded_status_text,
+                                           handle=base_target_handle))
             else:
                 self.log.info(f"Not replying to status {status_id} from {target_handle} "
                               f"- we already replied.")
 
         return records
 
+    def perform_mention_replies(
+            self,
+            *,
+            callback: Callable[..., str],
+            since_id: Any=None,
+            limit: int=40,
+            concurrency: int=1,
+    ) -> List[OutputRecord]:
+        """
+        Reply to everyone who mentioned us since since_id.
+        Pages back through the mentions timeline only while pages come back full,
+        so a poll with nothing new, or less than a page, costs one request.
+        The newest mention handled is left in mention_since_id for the next poll.
+
+        :param callback: a callback taking a message id,
+            message contents,
+            and optional extra keys,
+            and returning a message string.
+        :param since_id: id of the newest mention already handled.
+            without one, only the latest page of mentions is replied to.
+        :param limit: mentions to fetch per request.
+        :param concurrency: most replies in flight at once.
+        :returns: list of output records,
+            each corresponding to either a single post,
+            or an error.
+        """
+        self.log.info(f"Looking for birdsite mentions since {since_id}")
+
+        mentions: List[Any] = []
+        max_id = None
+        while True:
+            kwargs: Dict[str, Any] = {"count": limit, "tweet_mode": "extended"}
+            if since_id is not None:
+                kwargs["since_id"] = since_id
+            if max_id is not None:
+                kwargs["max_id"] = max_id
+
+            with self.timed("timeline_fetch"):
+                page = self.api.mentions_timeline(**kwargs)
+            mentions.extend(page)
+
+            if since_id is None or len(page) < limit:
+                break
+            max_id = min(status.id for status in page) - 1
+
+        self.log.debug(f"Retrieved {len(mentions)} mentions.")
+
+        # oldest first, so replies come out in the order people asked.
+        mentions.sort(key=lambda status: status.id)
+        return self.reply_to_mentions(
+            mentions,
+            lambda status: self._reply(callback=callback, status_id=status.id,
+                                       status_text=status.full_text,
+                                       handle=status.user.screen_name),
+            mention_id=lambda status: status.id,
+            concurrency=concurrency)
+
+    def rate_limit(self) -> Optional[RateLimit]:
+        """
+        Get what the API said was left of our rate limit, on the latest call.
+
+        :returns: latest rate limit, or None if unknown.
+        """
+        response = getattr(self._api, "last_response", None)
+        headers = getattr(response, "headers", None) or {}
+        try:
+            return RateLimit(remaining=int(headers["x-rate-limit-remaining"]),
+                             limit=int(headers["x-rate-limit-limit"]),
+                             reset=float(headers["x-rate-limit-reset"]))
+        except (KeyError, TypeError, ValueError):
+            return None
+
     ## Helpful methods for this output.
-    def send_dm_sos(self, message: str) -> None:
+    def _reply(
+            self,
+            *,
+            callback: Callable[..., str],
+            status_id: Any,
+            status_text: str,
+            handle: str,
+    ) -> OutputRecord:
+        """Reply to a status with what the callback makes of it."""
+        status_text = html.unescape(status_text)
+        message = callback(message_id=status_id, message=status_text, extra_keys={})
+
+        full_message = f"@{handle} {message}"
+        self.log.info(f"Trying to reply with {message} to status {status_id} from @{handle}.")
+        timings = self.phase_timings()
+        try:
+            with timings.phase("status_post"):
+                new_status = self.api.update_status(status=full_message,
+                                                    in_reply_to_status_id=status_id)
+
+            return TweetRecord(record_data={
+                "tweet_id": new_status.id,
+                "in_reply_to": f"@{handle}",
+                "in_reply_to_id": status_id,
+                "text": full_message,
+                "timings": timings.to_dict(),
+            })
+
+        except tweepy.TweepError as e:
+            error_record = self.handle_error(
+                message=(f"Bot {self.bot_name} encountered an error when "
+                         f"trying to reply to {status_id} with {message}:\n{e}\n"),
+                error=e)
+            error_record.timings = timings.to_dict()
+            return error_record
+
+    def send_dm_sos(self, message: str, *, signature: str=None) -> None:
         """
         Send DM to owner if something happens.
+        Returns straight away: DMs are sent in the background,
+        repeats of an error are only counted for a while,
+        and errors close together are sent as one digest (see SosNotifier).
 
         :param message: message to send to owner.
+        :param signature: what kind of error it is,
+            for recognizing repeats (default the message itself).
         :returns: None.
         """
         if self.owner_handle:
-            try:
-                # twitter changed the DM API and tweepy (as of 2019-03-08)
-                # has not adapted.
-                # fixing with
-                # https://github.com/tweepy/tweepy/issues/1081#issuecomment-423486837
-                owner_id = self.api.get_user(screen_name=self.owner_handle).id
-                event = {
-                    "event": {
-                        "type": "message_create",
-                        "message_create": {
-                            "target": {
-                                "recipient_id": f"{owner_id}",
-                            },
-                            "message_data": {
-                                "text": message
-                            }
+            self.sos.notify(message, signature=signature)
+
+        else:
+            self.lerror("Can't send DM SOS, no owner handle.")
+
+    def _send_sos(self, message: str) -> None:
+        """Send a DM to the owner now. Called by the SOS worker."""
+        try:
+            # twitter changed the DM API and tweepy (as of 2019-03-08)
+            # has not adapted.
+            # fixing with
+            # https://github.com/tweepy/tweepy/issues/1081#issuecomment-423486837
+            owner_id = self._owner_id()
+            event = {
+                "event": {
+                    "type": "message_create",
+                    "message_create": {
+                        "target": {
+                            "recipient_id": f"{owner_id}",
+                        },
+                        "message_data": {
+                            "text": message
                         }
                     }
                 }
+            }
 
-                self._send_direct_message_new(event)
+            self._send_direct_message_new(event)
 
-            except tweepy.TweepError as de:
-                self.lerror(f"Error trying to send DM about error!: {de}")
+        except tweepy.TweepError as de:
+            self.lerror(f"Error trying to send DM about error!: {de}")
 
-        else:
-            self.lerror("Can't send DM SOS, no owner handle.")
+    def _owner_id(self) -> Any:
+        """Look up the owner's user id, once."""
+        if self.owner_id is None:
+            with self.timed("account_lookup"):
+                self.owner_id = self.api.get_user(screen_name=self.owner_handle).id
+
+        return self.owner_id
 
     def handle_error(
             self,
@@ -278,10 +401,10 @@ class BirdsiteSkeleton(OutputSkeleton):
             if code in self.handled_errors:
                 self.handled_errors[code]
             else:
-                self.send_dm_sos(message)
+                self.send_dm_sos(message, signature=_signature(error))
 
         except Exception:
-            self.send_dm_sos(message)
+            self.send_dm_sos(message, signature=_signature(error))
 
         return TweetRecord(error=error)
 
@@ -298,14 +421,19 @@ class BirdsiteSkeleton(OutputSkeleton):
             *,
             media_ids: List[str],
             captions: Optional[List[str]],
+            timings: PhaseTimings=None,
     ) -> None:
         """
         Handle uploading all captions.
 
         :param media_ids: media ids of uploads to attach captions to.
         :param captions: captions to be attached to those media ids.
+        :param timings: timings of the post the captions are for (optional).
         :returns: None.
         """
+        if timings is None:
+            timings = self.phase_timings()
+
         if captions is None:
             captions = []
 
@@ -314,7 +442,8 @@ class BirdsiteSkeleton(OutputSkeleton):
 
         for i, media_id in enumerate(media_ids):
             caption = captions[i]
-            self._upload_caption(media_id=media_id, caption=caption)
+            with timings.phase("caption_upload"):
+                self._upload_caption(media_id=media_id, caption=caption)
 
     # taken from https://github.com/tweepy/tweepy/issues/716#issuecomment-398844271
     def _upload_caption(self, *, media_id: str, caption: str) -> Any:
@@ -352,6 +481,14 @@ class BirdsiteSkeleton(OutputSkeleton):
             require_auth=True,
         )(post_data=post_data, headers=headers)
 
+def _signature(error: Any) -> str:
+    """Get what kind of error this is, for recognizing repeats of it."""
+    code = getattr(error, "api_code", None)
+    if code is not None:
+        return f"{type(error).__name__} {code}"
+
+    return f"{type(error).__name__} {getattr(error, 'reason', error)}"
+
 # taken from
 # https://github.com/do-n-khanh/tweepy/commit/79772c976c64830149095f087c16c181912466ba#diff-ea5dd38a4efd9ff36c96e04ab0597cfb
 def _buildmessageobject(messageobject: Dict[str, Dict]) -> Tuple[Dict[str, str], str]:
@@ -365,6 +502,9 @@ def _buildmessageobject(messageobject: Dict[str, Dict]) -> Tuple[Dict[str, str],
     return headers, body
 
 class TweetRecord(OutputRecord):
+    __slots__ = ("tweet_id", "id", "text", "files", "media_ids", "captions", "in_reply_to",
+                 "in_reply_to_id", "error", "error_code", "error_message")
+
     def __init__(
             self,
             *,
@@ -389,6 +529,8 @@ class TweetRecord(OutputRecord):
         self.timestamp = record_data.get("timestamp", None)
         self.in_reply_to = record_data.get("in_reply_to", None)
         self.in_reply_to_id = record_data.get("in_reply_to_id", None)
+        if "timings" in record_data:
+            self.timings = record_data["timings"]
 
         if error is not None:
             # So Python doesn't get upset when we try to json-dump the record later.
@@ -0,0 +1,109 @@
+"""Skeleton code for simulating a real output in dry-run mode, without the network."""
+import importlib
+from logging import Logger
+from typing import Any, Dict, Optional, Tuple
+
+from ..simulation import LatencyModel
+from .output_loopback import LoopbackError, LoopbackRecord, LoopbackSkeleton
+from .output_utils import OutputRecord, OutputSkeleton
+
+# record class and id field each simulated output produces.
+# anything else gets LoopbackRecords.
+RECORD_CLASSES: Dict[str, Tuple[str, str]] = {
+    "birdsite": ("botskeleton.outputs.output_birdsite:TweetRecord", "tweet_id"),
+    "mastodon": ("botskeleton.outputs.output_mastodon:TootRecord", "toot_id"),
+}
+
+
+class DryRunSkeleton(LoopbackSkeleton):
+    """
+    Stands in for an output in dry-run mode.
+    Posts are kept in memory like the loopback output,
+    but every operation takes a latency drawn from a LatencyModel on the bot's clock,
+    and records are of the type the real output would create.
+    """
+    def __init__(
+            self,
+            *,
+            key: str,
+            latency_model: LatencyModel,
+            failure_rate: float=0.0,
+            seed: Any=None,
+    ) -> None:
+        """
+        Set up dry-run skeleton stuff.
+
+        :param key: key of output being simulated, like "birdsite".
+        :param latency_model: model to draw operation latencies from.
+        :param failure_rate: fraction (0 to 1) of operations that fail.
+        :param seed: random seed for failures, for repeatable runs (optional).
+        """
+        super().__init__()
+        self.name = key.upper()
+        self.key = key
+        self.latency_model = latency_model
+        self.failure_rate = failure_rate
+        self._random.seed(seed)
+
+        self.record_class: Any = LoopbackRecord
+        self.id_field = "post_id"
+
+    ## API implementation methods.
+    def cred_init(
+            self,
+            *,
+            secrets_dir: str,
+            log: Logger,
+            bot_name: str,
+    ) -> None:
+        """
+        Initialize simulated output.
+        Credentials are never read,
+        so bots can be tried out before they have any.
+
+        :param secrets_dir: dir the output's credentials would be in.
+        :param log: logger to use for log output.
+        :param bot_name: name of this bot,
+            used for various kinds of labelling.
+        :returns: none.
+        """
+        OutputSkeleton.__init__(self, secrets_dir=secrets_dir, log=log, bot_name=bot_name)
+
+        self.handle = f"@{bot_name}"
+        self.record_class, self.id_field = self._find_record_class()
+
+    def _find_record_class(self) -> Tuple[Any, str]:
+        """Get the record class the real output uses, if it can be imported."""
+        target: Optional[Tuple[str, str]] = RECORD_CLASSES.get(self.key)
+        if target is None:
+            return LoopbackRecord, "post_id"
+
+        class_path, id_field = target
+        module_name, class_name = class_path.split(":")
+        try:
+            module = importlib.import_module(module_name)
+        except ImportError as e:
+            self.lerror(f"Can't import {module_name} ({e}), dry run of {self.key} "
+                        f"will create LoopbackRecords instead.")
+            return LoopbackRecord, "post_id"
+
+        return getattr(module, class_name), id_field
+
+    def _record(
+            self,
+            *,
+            record_data: Dict[str, Any]={},
+            error: LoopbackError=None,
+    ) -> OutputRecord:
+        """Create a record like the real output would, stamped with simulated time."""
+        record_data = dict(record_data)
+        if "post_id" in record_data:
+            record_data[self.id_field] = record_data.pop("post_id")
+
+        record: OutputRecord = self.record_class(record_data=record_data, error=error)
+        record.timestamp = self.clock.now().isoformat()
+        return record
+
+    def _simulate_latency(self, operation: str) -> None:
+        """Let simulated time pass for an operation."""
+        self.clock.sleep(self.latency_model.sample(operation))
@@ -0,0 +1,413 @@
+"""Skeleton code for sending to an in-memory loopback, for testing bots without a network."""
+import itertools
+import json
+import random
+import re
+import threading
+import time
+from logging import Logger
+from os import path
+from typing import Any, Callable, Dict, List, Optional
+
+from .output_utils import OutputRecord, OutputSkeleton, read_credential
+
+
+class LoopbackError(Exception):
+    """Simulated failure from the loopback output."""
+    def __init__(self, message: str) -> None:
+        super(LoopbackError, self).__init__(message)
+        self.message = message
+
+
+class LoopbackSkeleton(OutputSkeleton):
+    def __init__(self) -> None:
+        """Set up loopback skeleton stuff."""
+        self.name = "LOOPBACK"
+
+        # everything "posted" ends up here.
+        # timelines are keyed by handle, so batch reply has something to read.
+        self.handle = "@loopback"
+        # the handle as a whole word, so @loopbackfan isn't a mention.
+        self._mention_re = re.compile(rf"(?<!\w){re.escape(self.handle)}(?!\w)")
+        self.posts: List[Dict[str, Any]] = []
+        self.timelines: Dict[str, List[Dict[str, Any]]] = {}
+
+        # newest mention seen by perform_mention_replies.
+        self.mention_since_id: Any = None
+
+        self.latency = 0.0
+        self.failure_rate = 0.0
+        self.output_file: Optional[str] = None
+
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self._random = random.Random()
+
+    ## API implementation methods.
+    def cred_init(
+            self,
+            *,
+            secrets_dir: str,
+            log: Logger,
+            bot_name: str,
+    ) -> None:
+        """
+        Initialize loopback settings.
+        No credentials are needed,
+        but the credentials dir can hold optional files tuning the simulation.
+
+        :param secrets_dir: dir to look for settings in.
+        :param log: logger to use for log output.
+        :param bot_name: name of this bot,
+            used for various kinds of labelling.
+        :returns: none.
+        """
+        super().__init__(secrets_dir=secrets_dir, log=log, bot_name=bot_name)
+
+        self.ldebug("Looking for LATENCY...")
+        latency = self._read_setting("LATENCY")
+        if latency is not None:
+            self.latency = float(latency)
+
+        self.ldebug("Looking for FAILURE_RATE...")
+        failure_rate = self._read_setting("FAILURE_RATE")
+        if failure_rate is not None:
+            self.failure_rate = float(failure_rate)
+
+        self.ldebug("Looking for SEED...")
+        seed = self._read_setting("SEED")
+        if seed is not None:
+            self._random.seed(seed)
+
+        self.ldebug("Looking for OUTPUT_FILE...")
+        output_file = self._read_setting("OUTPUT_FILE")
+        if output_file is not None:
+            self.output_file = path.join(self.secrets_dir, output_file)
+
+    def send(
+            self,
+            *,
+            text: str,
+    ) -> List[OutputRecord]:
+        """
+        Send loopback message.
+
+        :param text: text to send in post.
+        :returns: list of output records,
+            each corresponding to either a single post,
+            or an error.
+        """
+        timings = self.phase_timings()
+        try:
+            with timings.phase("status_post"):
+                post = self._post(text=text)
+            return [self._record(record_data={
+                "post_id": post["id"],
+                "text": text,
+                "timings": timings.to_dict(),
+            })]
+
+        except LoopbackError as e:
+            return [self.handle_error(
+                message=(f"Bot {self.bot_name} encountered an error when "
+                         f"sending post {text} without media:\n{e}\n"),
+                error=e)]
+
+    def send_with_media(
+            self,
+            *,
+            text: str,
+            files: List[str],
+            captions: List[str]=[],
+    ) -> List[OutputRecord]:
+        """
+        "Upload" media,
+        and send status and media,
+        and captions if present.
+
+        :param text: post text.
+        :param files: list of files to upload with post.
+        :param captions: list of captions to include as alt-text with files.
+        :returns: list of output records,
+            each corresponding to either a single post,
+            or an error.
+        """
+        if captions is None:
+            captions = []
+
+        # don't extend the caller's list, other outputs see it too.
+        captions = captions + [self.default_caption_message] * (len(files) - len(captions))
+
+        timings = self.phase_timings()
+        try:
+            self.ldebug(f"Uploading files {files}.")
+            media_ids = []
+            for file in files:
+                with timings.phase("media_upload"):
+                    media_ids.append(self._upload(file=file))
+                self.count_upload(file)
+
+        except LoopbackError as e:
+            return [self.handle_error(
+                message=f"Bot {self.bot_name} encountered an error when uploading {files}:\n{e}\n",
+                error=e)]
+
+        try:
+            with timings.phase("status_post"):
+                post = self._post(text=text, media_ids=media_ids)
+            return [self._record(record_data={
+                "post_id": post["id"],
+                "text": text,
+                "media_ids": media_ids,
+                "captions": captions,
+                "files": files,
+                "timings": timings.to_dict(),
+            })]
+
+        except LoopbackError as e:
+            return [self.handle_error(
+                message=(f"Bot {self.bot_name} encountered an error when "
+                         f"sending post {text} with media ids {media_ids}:\n{e}\n"),
+                error=e)]
+
+    def perform_batch_reply(
+            self,
+            *,
+            callback: Callable[..., str],
+            lookback_limit: int,
+            target_handle: str,
+    ) -> List[OutputRecord]:
+        """
+        Performs batch reply on target account.
+        Looks up the recent messages of the target user in the loopback timelines,
+        applies the callback,
+        and replies with
+        what the callback generates.
+
+        :param callback: a callback taking a message id,
+            message contents,
+            and optional extra keys,
+            and returning a message string.
+        :param target: the handle of the target account.
+        :param lookback_limit: a lookback limit of how many messages to consider.
+        :returns: list of output records,
+            each corresponding to either a single post,
+            or an error.
+        """
+        self.log.info(f"Attempting to batch reply to loopback user {target_handle}")
+
+        with self.timed("timeline_fetch"):
+            self._simulate_latency("timeline_fetch")
+            with self._lock:
+                statuses = list(reversed(self.timelines.get(target_handle, [])))[:lookback_limit]
+                replied_to = {post["in_reply_to_id"] for post in self.posts}
+
+        records: List[OutputRecord] = []
+        for status in statuses:
+            status_id = status["id"]
+            if status_id in replied_to:
+                self.log.info(f"Not replying to status {status_id} from {target_handle} "
+                              f"- we already replied.")
+                continue
+
+            records.append(self._reply(callback=callback, status=status))
+
+        return records
+
+    def perform_mention_replies(
+            self,
+            *,
+            callback: Callable[..., str],
+            since_id: Any=None,
+            limit: int=40,
+            concurrency: int=1,
+    ) -> List[OutputRecord]:
+        """
+        Reply to every loopback status mentioning us since since_id.
+        Fetches a page of limit mentions at a time,
+        paging back only while pages come back full.
+        The newest mention handled is left in mention_since_id for the next poll.
+
+        :param callback: a callback taking a message id,
+            message contents,
+            and optional extra keys,
+            and returning a message string.
+        :param since_id: id of the newest mention already handled.
+            without one, only the latest page of mentions is replied to.
+        :param limit: mentions to fetch per request.
+        :param concurrency: most replies in flight at once.
+        :returns: list of output records,
+            each corresponding to either a single post,
+            or an error.
+        """
+        self.log.info(f"Looking for loopback mentions since {since_id}")
+
+        with self._lock:
+            mentions = sorted(
+                (status for handle, timeline in self.timelines.items() if handle != self.handle
+                 for status in timeline
+                 if self._mention_re.search(status["text"])
+                 and (since_id is None or status["id"] > since_id)),
+                key=lambda status: status["id"], reverse=True)
+
+        # one simulated request per page.
+        pages = 1 if since_id is None else len(mentions) // max(1, limit) + 1
+        for _ in range(pages):
+            with self.timed("timeline_fetch"):
+                self._simulate_latency("timeline_fetch")
+        mentions = mentions[:limit] if since_id is None else mentions
+
+        return self.reply_to_mentions(list(reversed(mentions)),
+                                      lambda status: self._reply(callback=callback, status=status),
+                                      mention_id=lambda status: status["id"],
+                                      concurrency=concurrency)
+
+    ## Helpful methods for this output.
+    def add_status(self, *, handle: str, text: str) -> Dict[str, Any]:
+        """
+        Put a status from someone else on the loopback,
+        for batch reply to find.
+
+        :param handle: handle of the account "posting" the status.
+        :param text: text of the status.
+        :returns: the stored status.
+        """
+        with self._lock:
+            status = {"id": next(self._ids), "handle": handle, "text": text,
+                      "in_reply_to_id": None, "media_ids": []}
+            self.timelines.setdefault(handle, []).append(status)
+
+        return status
+
+    def _reply(self, *, callback: Callable[..., str], status: Dict[str, Any]) -> OutputRecord:
+        """Reply to a status with what the callback makes of it."""
+        status_id = status["id"]
+        message = callback(message_id=status_id, message=status["text"], extra_keys={})
+        self.log.info(f"Replying {message} to status {status_id} from {status['handle']}.")
+        timings = self.phase_timings()
+        try:
+            with timings.phase("status_post"):
+                post = self._post(text=message, in_reply_to_id=status_id)
+            return self._record(record_data={
+                "post_id": post["id"],
+                "in_reply_to": status["handle"],
+                "in_reply_to_id": status_id,
+                "text": message,
+                "timings": timings.to_dict(),
+            })
+
+        except LoopbackError as e:
+            return self.handle_error(
+                message=(f"Bot {self.bot_name} encountered an error when "
+                         f"trying to reply to {status_id} with {message}:\n{e}\n"),
+                error=e)
+
+    def handle_error(
+            self,
+            *,
+            message: str,
+            error: LoopbackError,
+    ) -> OutputRecord:
+        """
+        Handle error while trying to do something.
+
+        :param message: message describing the error.
+        :param error: loopback error object.
+        :returns: OutputRecord containing an error.
+        """
+        self.lerror(f"Got an error! {error}")
+        self.ldebug(message)
+
+        return self._record(error=error)
+
+    def _record(
+            self,
+            *,
+            record_data: Dict[str, Any]={},
+            error: LoopbackError=None,
+    ) -> OutputRecord:
+        """Create a record of a post (or error)."""
+        return LoopbackRecord(record_data=record_data, error=error)
+
+    def _simulate_call(self, *, operation: str, action: str) -> None:
+        """Wait out simulated latency, and maybe fail."""
+        if self.timeout is not None and self.latency > self.timeout:
+            time.sleep(self.timeout)
+            raise LoopbackError(f"Simulated timeout during {action}.")
+
+        self._simulate_latency(operation)
+
+        if self.failure_rate > 0 and self._random.random() < self.failure_rate:
+            raise LoopbackError(f"Simulated failure during {action}.")
+
+    def _simulate_latency(self, operation: str) -> None:
+        """Wait out simulated latency of an operation."""
+        if self.latency > 0:
+            time.sleep(self.latency)
+
+    def _upload(self, *, file: str) -> str:
+        """Pretend to upload a file, returning a media id."""
+        self._simulate_call(operation="media_upload", action=f"upload of {file}")
+        return f"media-{next(self._ids)}"
+
+    def _post(
+            self,
+            *,
+            text: str,
+            media_ids: List[str]=None,
+            in_reply_to_id: Any=None,
+    ) -> Dict[str, Any]:
+        """Pretend to post a status, storing it in memory and optionally in the output file."""
+        self._simulate_call(operation="status_post", action="status post")
+
+        with self._lock:
+            post = {"id": next(self._ids), "handle": self.handle, "text": text,
+                    "in_reply_to_id": in_reply_to_id, "media_ids": media_ids or []}
+            self.posts.append(post)
+            self.timelines.setdefault(self.handle, []).append(post)
+
+            if self.output_file is not None:
+                with open(self.output_file, "a") as f:
+                    f.write(json.dumps(post, sort_keys=True))
+                    f.write("\n")
+
+        return post
+
+    def _read_setting(self, name: str) -> Optional[str]:
+        """Read an optional settings file from the credentials dir."""
+        return read_credential(path.join(self.secrets_dir, name))
+
+
+class LoopbackRecord(OutputRecord):
+    __slots__ = ("post_id", "id", "text", "files", "media_ids", "captions", "in_reply_to",
+                 "in_reply_to_id", "error", "error_code", "error_message")
+
+    def __init__(
+            self,
+            *,
+            record_data: Dict[str, Any]={},
+            error: LoopbackError=None,
+    ) -> None:
+        """
+        Create loopback record object.
+
+        :param record_data: data to use to generate a LoopbackRecord.
+        :param error: error encountered while posting,
+            to generate a record with.
+        """
+        super().__init__()
+        self._type = self.__class__.__name__
+        self.post_id = record_data.get("post_id", None)
+        self.id = self.post_id
+        self.text = record_data.get("text", None)
+        self.files = record_data.get("files", [])
+        self.media_ids = record_data.get("media_ids", [])
+        self.captions = record_data.get("captions", [])
+        self.in_reply_to = record_data.get("in_reply_to", None)
+        self.in_reply_to_id = record_data.get("in_reply_to_id", None)
+        if "timings" in record_data:
+            self.timings = record_data["timings"]
+
+        if error is not None:
+            self.error = str(error)
+            self.error_message = error.message
@@ -2,19 +2,31 @@
 import html
 import json
 import re
+import threading
+from collections import OrderedDict
 from logging import Logger
-from os import path
-from typing import Any, Callable, Dict, List, Optional
+from typing import Any, Callable, Dict, List, Optional, Set
 
 import mastodon
 
-from .output_utils import OutputRecord, OutputSkeleton
+from ..scheduling import RateLimit
+from ..streaming import Event, EventStream
+from .output_utils import OutputRecord, OutputSkeleton, newest_id
+
+# statuses replied to while streaming, remembered so none is replied to twice.
+REPLIED_LIMIT = 1000
+
+# notifications perform_mention_replies doesn't need to see.
+NON_MENTION_TYPES = ["follow", "follow_request", "favourite", "reblog", "poll", "status", "update"]
 
 class MastodonSkeleton(OutputSkeleton):
     def __init__(self) -> None:
         """Set up mastodon skeleton stuff."""
         self.name = "MASTODON"
 
+        # newest mention notification seen by perform_mention_replies.
+        self.mention_since_id: Any = None
+
     def cred_init(
             self,
             *,
@@ -25,22 +37,21 @@ class MastodonSkeleton(OutputSkeleton):
         """Initialize what requires credentials/secret files."""
         super().__init__(secrets_dir=secrets_dir, log=log, bot_name=bot_name)
 
-        self.ldebug("Retrieving ACCESS_TOKEN ...")
-        with open(path.join(self.secrets_dir, "ACCESS_TOKEN")) as f:
-            ACCESS_TOKEN = f.read().strip()
+        ACCESS_TOKEN = self.read_credential("ACCESS_TOKEN")
+        self._access_token = ACCESS_TOKEN
 
         # Instance base url optional.
-        self.ldebug("Looking for INSTANCE_BASE_URL ...")
-        instance_base_url_path = path.join(self.secrets_dir, "INSTANCE_BASE_URL")
-        if path.isfile(instance_base_url_path):
-            with open(instance_base_url_path) as f:
-                self.instance_base_url = f.read().strip()
-        else:
+        instance_base_url = self.read_credential("INSTANCE_BASE_URL", required=False)
+        if instance_base_url is None:
             self.ldebug("Couldn't find INSTANCE_BASE_URL, defaulting to mastodon.social.")
-            self.instance_base_url = "https://mastodon.social"
-
-        self.api = mastodon.Mastodon(access_token=ACCESS_TOKEN,
-                                     api_base_url=self.instance_base_url)
+            instance_base_url = "https://mastodon.social"
+        self.instance_base_url = instance_base_url
+
+        # building the client can contact the instance, so it may be deferred.
+        kwargs = {"request_timeout": self.timeout} if self.timeout is not None else {}
+        self.set_api_factory(lambda: mastodon.Mastodon(access_token=ACCESS_TOKEN,
+                                                       api_base_url=self.instance_base_url,
+                                                       **kwargs))
         self.html_re = re.compile("<.*?>")
 
     def send(
@@ -56,18 +67,23 @@ class MastodonSkeleton(OutputSkeleton):
             each corresponding to either a single post,
             or an error.
         """
+        timings = self.phase_timings()
         try:
-            status = self.api.status_post(status=text)
+            with timings.phase("status_post"):
+                status = self.api.status_post(status=text)
 
             return [TootRecord(record_data={
                 "toot_id": status["id"],
-                "text": text
+                "text": text,
+                "timings": timings.to_dict(),
             })]
 
         except mastodon.MastodonError as e:
-            return [self.handle_error((f"Bot {self.bot_name} encountered an error when "
-                                      f"sending post {text} without media:\n{e}\n"),
-                                     e)]
+            error_record = self.handle_error((f"Bot {self.bot_name} encountered an error when "
+                                              f"sending post {text} without media:\n{e}\n"),
+                                             e)
+            error_record.timings = timings.to_dict()
+            return [error_record]
 
     def send_with_media(
             self,
@@ -88,6 +104,7 @@ class MastodonSkeleton(OutputSkeleton):
             each corresponding to either a single post,
             or an error.
         """
+        timings = self.phase_timings()
         try:
             self.ldebug(f"Uploading files {files}.")
             if captions is None:
@@ -99,29 +116,37 @@ class MastodonSkeleton(OutputSkeleton):
             media_dicts = []
             for i, file in enumerate(files):
                 caption = captions[i]
-                media_dicts.append(self.api.media_post(file, description=caption))
+                with timings.phase("media_upload"):
+                    media_dicts.append(self.api.media_post(file, description=caption))
+                self.count_upload(file)
 
             self.ldebug(f"Media ids {media_dicts}")
 
         except mastodon.MastodonError as e:
-            return [self.handle_error(
+            error_record = self.handle_error(
                 f"Bot {self.bot_name} encountered an error when uploading {files}:\n{e}\n", e
-            )]
+            )
+            error_record.timings = timings.to_dict()
+            return [error_record]
 
         try:
-            status = self.api.status_post(status=text, media_ids=media_dicts)
+            with timings.phase("status_post"):
+                status = self.api.status_post(status=text, media_ids=media_dicts)
             return [TootRecord(record_data={
                 "toot_id": status["id"],
                 "text": text,
                 "media_ids": media_dicts,
-                "captions": captions
+                "captions": captions,
+                "timings": timings.to_dict(),
             })]
 
         except mastodon.MastodonError as e:
-            return [self.handle_error((f"Bot {self.bot_name} encountered an error when "
-                                      f"sending post {text} with media dicts {media_dicts}:"
-                                      f"\n{e}\n"),
-                                     e)]
+            error_record = self.handle_error((f"Bot {self.bot_name} encountered an error when "
+                                              f"sending post {text} with media dicts "
+                                              f"{media_dicts}:\n{e}\n"),
+                                             e)
+            error_record.timings = timings.to_dict()
+            return [error_record]
 
     def perform_batch_reply(
             self,
@@ -155,11 +180,13 @@ class MastodonSkeleton(OutputSkeleton):
         target_base_handle = handle_chunks[1]
 
         records: List[OutputRecord] = []
-        our_id = self.api.account_verify_credentials()["id"]
+        with self.timed("account_lookup"):
+            our_id = self.api.account_verify_credentials()["id"]
 
         # be careful here - we're using a search to do this,
         # and if we're not careful we'll pull up people just mentioning the target.
-        possible_accounts = self.api.account_search(target_handle, following=True)
+        with self.timed("account_lookup"):
+            possible_accounts = self.api.account_search(target_handle, following=True)
         their_id = None
         for account in possible_accounts:
             if account["username"] == target_base_handle:
@@ -169,43 +196,303 @@ class MastodonSkeleton(OutputSkeleton):
         if their_id is None:
             return [self.handle_error(f"Could not find target handle {target_handle}!", None)]
 
-        statuses = self.api.account_statuses(their_id, limit=lookback_limit)
+        with self.timed("timeline_fetch"):
+            statuses = self.api.account_statuses(their_id, limit=lookback_limit)
         for status in statuses:
 
             status_id = status.id
 
             # find possible replies we've made.
-            our_statuses = self.api.account_statuses(our_id, since_id=status_id)
+            with self.timed("timeline_fetch"):
+                our_statuses = self.api.account_statuses(our_id, since_id=status_id)
             in_reply_to_ids = list(map(lambda x: x.in_reply_to_id, our_statuses))
             if status_id not in in_reply_to_ids:
 
-                encoded_status_text = re.sub(self.html_re, "", status.content)
-                status_text = html.unescape(encoded_status_text)
-
-                message = callback(message_id=status_id, message=status_text, extra_keys={})
-                self.log.info(f"Replying {message} to status {status_id} from {target_handle}.")
-                try:
-                    new_status = self.api.status_post(status=message, in_reply_to_id=status_id)
-
-                    records.append(TootRecord(record_data={
-                        "toot_id": new_status.id,
-                        "in_reply_to": target_handle,
-                        "in_reply_to_id": status_id,
-                        "text": message,
-                    }))
-
-                except mastodon.MastodonError as e:
-                    records.append(
-                        self.handle_error((f"Bot {self.bot_name} encountered an error when "
-                                           f"sending post {message} during a batch reply "
-                                           f":\n{e}\n"),
-                                          e))
+                records.append(self._reply(callback=callback, status_id=status_id,
+                                           content=status.content, handle=target_handle,
+                                           mode="batch reply"))
             else:
                 self.log.info(f"Not replying to status {status_id} from {target_handle} "
                               f"- we already replied.")
 
         return records
 
+    def perform_mention_replies(
+            self,
+            *,
+            callback: Callable[..., str],
+            since_id: Any=None,
+            limit: int=40,
+            concurrency: int=1,
+    ) -> List[OutputRecord]:
+        """
+        Reply to everyone who mentioned us since since_id.
+        Pages back through mention notifications only while pages come back full,
+        so a poll with nothing new, or less than a page, costs one request.
+        The newest notification handled is left in mention_since_id for the next poll.
+
+        :param callback: a callback taking a message id,
+            message contents,
+            and optional extra keys,
+            and returning a message string.
+        :param since_id: id of the newest notification already handled.
+            without one, only the latest page of mentions is replied to.
+        :param limit: notifications to fetch per request.
+        :param concurrency: most replies in flight at once.
+        :returns: list of output records,
+            each corresponding to either a single post,
+            or an error.
+        """
+        self.log.info(f"Looking for mastodon mentions since {since_id}")
+
+        notifications: List[Any] = []
+        max_id = None
+        while True:
+            with self.timed("timeline_fetch"):
+                page = self.api.notifications(since_id=since_id, max_id=max_id, limit=limit,
+                                              exclude_types=NON_MENTION_TYPES)
+            notifications.extend(page)
+
+            if since_id is None or len(page) < limit:
+                break
+            max_id = page[-1]["id"]
+
+        self.log.debug(f"Retrieved {len(notifications)} notifications.")
+
+        # oldest first, so replies come out in the order people asked.
+        # mention_since_id is a notification id, so other notifications are passed over too.
+        return self.reply_to_mentions(
+            list(reversed(notifications)),
+            lambda notification: self._reply_to_mention(callback=callback,
+                                                        notification=notification),
+            mention_id=lambda notification: notification["id"],
+            concurrency=concurrency)
+
+    def stream_replies(
+            self,
+            *,
+            callback: Callable[..., str],
+            on_record: Callable[[OutputRecord], None],
+            target_handles: List[str]=None,
+            mentions: bool=True,
+            backoff: float=1.0,
+            max_backoff: float=300.0,
+            stream_url: str=None,
+    ) -> EventStream:
+        """
+        Reply to mentions, and to posts by target accounts we follow,
+        as they arrive over the user stream,
+        instead of polling with perform_batch_reply.
+        Dropped connections are retried with exponential backoff,
+        and what was missed meanwhile is fetched on reconnecting.
+        Each status is replied to at most once.
+        A status whose reply fails is tried again when catching up after the next reconnection.
+
+        :param callback: a callback taking a message id,
+            message contents,
+            and optional extra keys,
+            and returning a message string.
+        :param on_record: called with the record of every reply, from the stream's thread.
+        :param target_handles: handles (@user or @user@domain) to reply to every post of.
+            they must be followed to appear in the user stream.
+        :param mentions: whether to reply to mentions.
+        :param backoff: seconds before the first reconnection, doubling after that.
+        :param max_backoff: most seconds between reconnections.
+        :param stream_url: URL of the user stream
+            (default the instance's streaming API).
+        :returns: started EventStream. stop it to stop replying.
+        """
+        targets = {handle.lstrip("@").lower() for handle in target_handles or []}
+
+        # newest ids seen, for catching up: "notifications", and a target's account id.
+        since: Dict[str, Any] = {}
+        # where to catch up from instead, for a feed with a failed reply: just before it.
+        retry: Dict[str, Any] = {}
+        target_ids: Dict[str, Any] = {}
+        # statuses replied to, and statuses being replied to.
+        replied: "OrderedDict[str, None]" = OrderedDict()
+        replying: Set[str] = set()
+        lock = threading.Lock()
+
+        def reply(status: Dict[str, Any], mode: str) -> bool:
+            """Reply to a status once, returning whether it was handled."""
+            status_id = status["id"]
+            with lock:
+                if str(status_id) in replied or str(status_id) in replying:
+                    return True
+                replying.add(str(status_id))
+
+            record = None
+            try:
+                handle = f"@{status['account']['acct']}"
+                record = self._reply(callback=callback, status_id=status_id,
+                                     content=status["content"], handle=handle, mode=mode)
+            except Exception as e:
+                self.lerror(f"Replying to status {status_id} failed, "
+                            f"it will be tried again after reconnecting: {e}")
+            finally:
+                with lock:
+                    replying.discard(str(status_id))
+                    if record is not None and getattr(record, "error", None) is None:
+                        replied[str(status_id)] = None
+                        while len(replied) > REPLIED_LIMIT:
+                            replied.popitem(last=False)
+
+            if record is not None:
+                on_record(record)
+            return record is not None and getattr(record, "error", None) is None
+
+        def advance(feed: str, item_id: Any, *, failed: bool) -> None:
+            """Move a feed's catch-up point past an item, remembering the first failure."""
+            if failed and feed not in retry:
+                retry[feed] = since.get(feed)
+            since[feed] = newest_id(since.get(feed), item_id)
+
+        def handle_notification(notification: Dict[str, Any]) -> None:
+            handled = True
+            if mentions and notification["type"] == "mention":
+                handled = reply(notification["status"], "mention reply")
+            advance("notifications", notification["id"], failed=not handled)
+
+        def handle_update(status: Dict[str, Any]) -> None:
+            acct = status["account"]["acct"].lower()
+            if acct in targets:
+                account_id = status["account"]["id"]
+                target_ids[acct] = account_id
+                advance(account_id, status["id"], failed=not reply(status, "streaming reply"))
+
+        def on_event(event: Event) -> None:
+            try:
+                if event.event == "notification":
+                    handle_notification(json.loads(event.data))
+                elif event.event == "update":
+                    handle_update(json.loads(event.data))
+            except Exception:
+                self.log.exception(f"Couldn't handle streamed {event.event} event.")
+
+        first_connection = True
+
+        def on_connect() -> None:
+            nonlocal first_connection
+            if first_connection:
+                # nothing to catch up on the first time, we don't reply to everything ever posted.
+                # but note the newest notification,
+                # so mentions are caught up on even if this connection drops before any arrive.
+                if mentions:
+                    with self.timed("timeline_fetch"):
+                        latest = self.api.notifications(limit=1)
+                    for notification in latest:
+                        since["notifications"] = newest_id(since.get("notifications"),
+                                                           notification["id"])
+                first_connection = False
+
+            elif mentions:
+                # without a newest notification, there were none before, so everything is new.
+                with self.timed("timeline_fetch"):
+                    missed = self.api.notifications(
+                        since_id=retry.get("notifications", since.get("notifications")))
+                retry.pop("notifications", None)
+                for notification in reversed(missed):
+                    handle_notification(notification)
+
+            for account_id in list(target_ids.values()):
+                with self.timed("timeline_fetch"):
+                    missed = self.api.account_statuses(
+                        account_id, since_id=retry.get(account_id, since[account_id]))
+                retry.pop(account_id, None)
+                for status in reversed(missed):
+                    handle_update(status)
+
+        if stream_url is None:
+            stream_url = self._streaming_base_url() + "/api/v1/streaming/user"
+
+        stream = EventStream(
+            url=stream_url,
+            on_event=on_event,
+            on_connect=on_connect,
+            headers={
+                "Authorization": f"Bearer {self._access_token}",
+                "Accept": "text/event-stream",
+            },
+            backoff=backoff,
+            max_backoff=max_backoff,
+            log=self.log,
+        )
+        stream.start()
+        return stream
+
+    def rate_limit(self) -> Optional[RateLimit]:
+        """
+        Get what the API said was left of our rate limit, on the latest call.
+
+        :returns: latest rate limit, or None if unknown.
+        """
+        try:
+            return RateLimit(remaining=int(self._api.ratelimit_remaining),
+                             limit=int(self._api.ratelimit_limit),
+                             reset=float(self._api.ratelimit_reset))
+        except (AttributeError, TypeError, ValueError):
+            return None
+
+    def _streaming_base_url(self) -> str:
+        """Get where the instance's streaming API is, which may be another host."""
+        try:
+            url = self.api.instance()["urls"]["streaming_api"]
+        except Exception:
+            return self.instance_base_url
+
+        return re.sub("^ws", "http", url).rstrip("/")
+
+    def _reply(
+            self,
+            *,
+            callback: Callable[..., str],
+            status_id: Any,
+            content: str,
+            handle: str,
+            mode: str,
+    ) -> OutputRecord:
+        """Reply to a status with what the callback makes of it."""
+        encoded_status_text = re.sub(self.html_re, "", content)
+        status_text = html.unescape(encoded_status_text)
+
+        message = callback(message_id=status_id, message=status_text, extra_keys={})
+        self.log.info(f"Replying {message} to status {status_id} from {handle}.")
+        timings = self.phase_timings()
+        try:
+            with timings.phase("status_post"):
+                new_status = self.api.status_post(status=message, in_reply_to_id=status_id)
+
+            return TootRecord(record_data={
+                "toot_id": new_status.id,
+                "in_reply_to": handle,
+                "in_reply_to_id": status_id,
+                "text": message,
+                "timings": timings.to_dict(),
+            })
+
+        except mastodon.MastodonError as e:
+            error_record = self.handle_error((f"Bot {self.bot_name} encountered an error when "
+                                              f"sending post {message} during a {mode} "
+                                              f":\n{e}\n"),
+                                             e)
+            error_record.timings = timings.to_dict()
+            return error_record
+
+    def _reply_to_mention(
+            self,
+            *,
+            callback: Callable[..., str],
+            notification: Dict[str, Any],
+    ) -> Optional[OutputRecord]:
+        """Reply to the status a mention notification is for, passing over other notifications."""
+        if notification["type"] != "mention":
+            return None
+
+        status = notification["status"]
+        return self._reply(callback=callback, status_id=status["id"], content=status["content"],
+                           handle=f"@{status['account']['acct']}", mode="mention reply")
+
     # TODO find a replacement/find out how mastodon DMs work.
     # def send_dm_sos(self, message):
     #     """Send DM to owner if something happens."""
@@ -229,6 +516,9 @@ class MastodonSkeleton(OutputSkeleton):
 
 
 class TootRecord(OutputRecord):
+    __slots__ = ("toot_id", "id", "text", "files", "media_ids", "captions", "in_reply_to",
+                 "in_reply_to_id", "error", "error_code", "error_message")
+
     def __init__(
             self,
             *,
@@ -252,6 +542,8 @@ class TootRecord(OutputRecord):
         self.captions = record_data.get("captions", [])
         self.in_reply_to = record_data.get("in_reply_to", None)
         self.in_reply_to_id = record_data.get("in_reply_to_id", None)
+        if "timings" in record_data:
+            self.timings = record_data["timings"]
 
         if error is not None:
             # So Python doesn't get upset when we try to json-dump the record later.
@@ -0,0 +1,160 @@
+"""Registry of outputs, so they can be found without importing their client libraries."""
+import importlib
+from typing import Any, Callable, Dict, List, Optional
+
+import pkg_resources
+
+# outputs in other packages can register themselves under this entry point group, like:
+# entry_points={"botskeleton.outputs": ["myoutput = mypackage.output:MyOutputSkeleton"]}
+ENTRY_POINT_GROUP = "botskeleton.outputs"
+
+
+class OutputEntry:
+    """Description of an output, enough to activate it without importing it."""
+    def __init__(
+            self,
+            *,
+            key: str,
+            target: str,
+            credentials_dir: str=None,
+            loader: Callable[[], Any]=None,
+    ) -> None:
+        """
+        Create output entry.
+
+        :param key: key of the output, used in outputs dict and history records.
+        :param target: "module:Class" path to the OutputSkeleton subclass.
+        :param credentials_dir: name of the credentials directory under the secrets dir.
+            defaults to what the output class declares (for entry points),
+            or credentials_KEY.
+        :param loader: callable returning the output class.
+            defaults to importing target.
+        """
+        self.key = key
+        self.target = target
+        self._credentials_dir = credentials_dir
+        self._loader = loader
+
+    @property
+    def credentials_dir(self) -> str:
+        """
+        Name of the credentials directory under the secrets dir.
+        Output classes from entry points can declare their own with a credentials_dir attribute,
+        which means importing them to find out.
+        Otherwise it's credentials_KEY.
+        """
+        if self._credentials_dir is None:
+            credentials_dir = None
+            if self._loader is not None:
+                try:
+                    credentials_dir = getattr(self.load(), "credentials_dir", None)
+                except ImportError:
+                    # can't be set up anyway, and complains properly if it's active.
+                    pass
+
+            self._credentials_dir = credentials_dir or f"credentials_{self.key}"
+
+        return self._credentials_dir
+
+    def __repr__(self) -> str:
+        """repr object."""
+        return f"OutputEntry(key={self.key!r}, target={self.target!r})"
+
+    def load(self) -> Any:
+        """
+        Import the output class.
+        This is the point where heavy client libraries get imported.
+
+        :returns: the OutputSkeleton subclass.
+        """
+        if self._loader is not None:
+            return self._loader()
+
+        module_name, _, class_name = self.target.partition(":")
+        module = importlib.import_module(module_name)
+        return getattr(module, class_name)
+
+    def instantiate(self) -> Any:
+        """
+        Import and construct the output.
+
+        :returns: a new OutputSkeleton.
+        """
+        return self.load()()
+
+
+BUILTIN_OUTPUTS: List[OutputEntry] = [
+    OutputEntry(key="birdsite", target="botskeleton.outputs.output_birdsite:BirdsiteSkeleton"),
+    OutputEntry(key="mastodon", target="botskeleton.outputs.output_mastodon:MastodonSkeleton"),
+    OutputEntry(key="loopback", target="botskeleton.outputs.output_loopback:LoopbackSkeleton"),
+]
+
+_registered: Dict[str, OutputEntry] = {}
+
+# outputs from entry points, read once per process.
+_entry_points: Optional[List[OutputEntry]] = None
+
+
+def register_output(
+        *,
+        key: str,
+        target: str,
+        credentials_dir: str=None,
+) -> OutputEntry:
+    """
+    Register an output in-process.
+    Registered outputs take priority over built-in and entry point ones with the same key.
+
+    :param key: key of the output.
+    :param target: "module:Class" path to the OutputSkeleton subclass.
+    :param credentials_dir: name of the credentials directory under the secrets dir.
+    :returns: the new entry.
+    """
+    entry = OutputEntry(key=key, target=target, credentials_dir=credentials_dir)
+    _registered[key] = entry
+    return entry
+
+
+def discover_outputs() -> Dict[str, OutputEntry]:
+    """
+    Find all available outputs.
+    Nothing is imported,
+    entry points are only read (once per process).
+
+    :returns: dict of output key to entry, built-ins first.
+    """
+    entries = {entry.key: entry for entry in BUILTIN_OUTPUTS}
+
+    for entry in _entry_point_outputs():
+        existing = entries.get(entry.key)
+        if existing is not None and existing.target == entry.target:
+            continue
+
+        entries[entry.key] = entry
+
+    entries.update(_registered)
+    return entries
+
+
+def _entry_point_outputs() -> List[OutputEntry]:
+    """Get outputs registered under the entry point group, scanning installed packages once."""
+    global _entry_points
+    if _entry_points is None:
+        _entry_points = [
+            OutputEntry(key=entry_point.name,
+                        target=f"{entry_point.module_name}:{'.'.join(entry_point.attrs)}",
+                        loader=entry_point.load)
+            for entry_point in pkg_resources.iter_entry_points(ENTRY_POINT_GROUP)
+        ]
+
+    return _entry_points
+
+
+def get_output(key: str) -> Optional[OutputEntry]:
+    """
+    Look up one output by key.
+
+    :param key: key of the output.
+    :returns: entry for the output, or None if there isn't one.
+    """
+    return discover_outputs().get(key)
@@ -1,10 +1,77 @@
 """Stuff used by output classes."""
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime
 from logging import Logger
-from typing import Any, Callable, Dict, List
+from os import path
+from typing import Any, Callable, Dict, Iterator, List, Optional, Set, Tuple, TypeVar
+
+from ..metrics import Metrics, Timer
+from ..records import SlottedRecord
+from ..scheduling import RateLimit
+
+# credentials files read so far, by path, size and mtime,
+# so several bots (or outputs) in one process don't keep rereading the same files.
+_credentials: Dict[Tuple[str, int, int], str] = {}
+_credentials_lock = threading.Lock()
+
+T = TypeVar("T")
+
+
+def newest_id(current: Any, candidate: Any) -> Any:
+    """
+    Get the newer of two post or notification ids,
+    comparing them as numbers (some APIs give them as strings).
+
+    :param current: newest id so far, or None.
+    :param candidate: id to compare it to.
+    :returns: the newer id.
+    """
+    if current is None:
+        return candidate
+
+    try:
+        return candidate if int(candidate) > int(current) else current
+    except (TypeError, ValueError):
+        return candidate
+
+
+def read_credential(filename: str) -> Optional[str]:
+    """
+    Read a credentials file, stripped,
+    reading it again only if it changes.
+
+    :param filename: path to file.
+    :returns: contents of file, or None if it doesn't exist.
+    """
+    try:
+        stat = os.stat(filename)
+    except OSError:
+        return None
+
+    key = (path.abspath(filename), stat.st_size, stat.st_mtime_ns)
+    with _credentials_lock:
+        value = _credentials.get(key)
+    if value is not None:
+        return value
+
+    with open(filename) as f:
+        value = f.read().strip()
+
+    with _credentials_lock:
+        _credentials[key] = value
+    return value
+
 
 class OutputSkeleton:
     """Common stuff for output skeletons."""
+    # like "BIRDSITE", set by each output when it's constructed.
+    name: str
+    # newest mention handled, on outputs that reply to mentions.
+    mention_since_id: Any
+
     def __init__(
             self,
             *,
@@ -12,6 +79,10 @@ class OutputSkeleton:
             log: Logger,
             bot_name: str,
     ) -> None:
+        # outputs name themselves before cred_init gets here.
+        if getattr(self, "name", None) is None:
+            self.name = self.__class__.__name__.upper()
+
         self.log = log
         self.secrets_dir = secrets_dir
 
@@ -20,6 +91,30 @@ class OutputSkeleton:
 
         self.default_caption_message = "No caption provided for image."
 
+        # BotSkeleton hands us its metrics before cred_init,
+        # but outputs used on their own still get somewhere to count.
+        if getattr(self, "metrics", None) is None:
+            self.metrics = Metrics()
+
+        # same for the clock, which is simulated in dry-run mode.
+        if getattr(self, "clock", None) is None:
+            self.clock = self.metrics.clock
+
+        # with defer_clients, API clients are built on first use instead of in cred_init,
+        # since some contact their instance when built.
+        if getattr(self, "defer_clients", None) is None:
+            self.defer_clients = False
+
+        # seconds any one request may take, or None for the client library's default.
+        if getattr(self, "timeout", None) is None:
+            self.timeout: Optional[float] = None
+        # mentions replied to out of order, past mention_since_id.
+        self._mentions_replied: Set[Any] = set()
+
+        self._api: Any = None
+        self._api_factory: Optional[Callable[[], Any]] = None
+        self._api_lock = threading.Lock()
+
         # Output skeletons must implement these.
         # mypy doesn't let us express a function taking only keyword arguments,
         # as best I can tell.
@@ -28,6 +123,63 @@ class OutputSkeleton:
         self.send_with_media: Callable[..., List[OutputRecord]]
         self.perform_batch_reply: Callable[..., List[OutputRecord]]
 
+    @property
+    def api(self) -> Any:
+        """API client, built now if it was deferred."""
+        if self._api is None and self._api_factory is not None:
+            with self._api_lock:
+                if self._api is None:
+                    self.ldebug("Building API client...")
+                    self._api = self._api_factory()
+
+        return self._api
+
+    @api.setter
+    def api(self, api: Any) -> None:
+        self._api = api
+
+    def set_api_factory(self, factory: Callable[[], Any]) -> None:
+        """
+        Say how to build this output's API client,
+        building it now unless clients are deferred.
+
+        :param factory: function building the client.
+        :returns: None
+        """
+        self._api = None
+        self._api_factory = factory
+        if not self.defer_clients:
+            self._api = factory()
+
+    def read_credential(self, name: str, *, required: bool=True) -> Optional[str]:
+        """
+        Read a file from the credentials dir,
+        cached until it changes.
+
+        :param name: name of file, like "ACCESS_TOKEN".
+        :param required: whether the file must exist.
+        :returns: contents of file, stripped,
+            or None if it's optional and doesn't exist.
+        :raises FileNotFoundError: if the file is required and doesn't exist.
+        """
+        self.ldebug(f"Retrieving {name}...")
+        filename = path.join(self.secrets_dir, name)
+        value = read_credential(filename)
+        if value is None and required:
+            raise FileNotFoundError(f"Credentials file {filename} is missing.")
+
+        return value
+
+    def rate_limit(self) -> Optional[RateLimit]:
+        """
+        Get what the API said was left of our rate limit, on the latest call.
+        Outputs that can't tell return None.
+        Never builds a deferred client.
+
+        :returns: latest rate limit, or None if unknown.
+        """
+        return None
+
     def linfo(self, message: str) -> None:
         """Wrapped debug log with prefix key."""
         self.log.info(f"{self.bot_name}: {message}")
@@ -40,36 +192,210 @@ class OutputSkeleton:
         """Wrapped error log with prefix key."""
         self.log.error(f"{self.bot_name}: {message}")
 
-class OutputRecord:
+    def timed(self, operation: str) -> Timer:
+        """
+        Time an operation against this output,
+        like "media_upload" or "status_post".
+
+        :param operation: name of operation.
+        :returns: Timer context manager,
+            holding elapsed time once the block ends.
+        """
+        return self.metrics.time("operation_seconds", output=self.name.lower(),
+                                 operation=operation)
+
+    def count(self, name: str, amount: float=1, **labels: Any) -> None:
+        """
+        Increment a counter labelled with this output.
+
+        :param name: name of counter.
+        :param amount: amount to increment by.
+        :param labels: any other labels.
+        :returns: None
+        """
+        self.metrics.inc(name, amount, output=self.name.lower(), **labels)
+
+    def phase_timings(self) -> "PhaseTimings":
+        """
+        Start timing the phases of one post,
+        to be stored in its record.
+
+        :returns: new PhaseTimings, started now.
+        """
+        return PhaseTimings(self)
+
+    def count_upload(self, file: str) -> None:
+        """
+        Count a media upload and its size.
+
+        :param file: file that was uploaded.
+        :returns: None
+        """
+        self.count("uploads_total")
+        try:
+            self.count("upload_bytes_total", path.getsize(file))
+        except OSError:
+            pass
+
+    def reply_all(
+            self,
+            statuses: List[Any],
+            reply: Callable[[Any], T],
+            *,
+            concurrency: int=1,
+    ) -> List[T]:
+        """
+        Reply to statuses,
+        up to concurrency at a time.
+
+        :param statuses: statuses to reply to, in order.
+        :param reply: function replying to one status, returning its record.
+        :param concurrency: most replies in flight at once.
+        :returns: records, in the order of statuses.
+        """
+        if concurrency <= 1 or len(statuses) <= 1:
+            return [reply(status) for status in statuses]
+
+        with ThreadPoolExecutor(max_workers=min(concurrency, len(statuses)),
+                                thread_name_prefix=f"{self.name.lower()}-reply") as executor:
+            return list(executor.map(reply, statuses))
+
+    def reply_to_mentions(
+            self,
+            mentions: List[Any],
+            reply: Callable[[Any], Optional["OutputRecord"]],
+            *,
+            mention_id: Callable[[Any], Any],
+            concurrency: int=1,
+    ) -> List["OutputRecord"]:
+        """
+        Reply to mentions, oldest first,
+        moving mention_since_id past each one once it and every older one are handled.
+        A mention whose reply raises (the callback failing, say) isn't skipped:
+        mention_since_id stops short of it, so the next poll tries it again,
+        and mentions after it that haven't started yet wait for that poll too.
+        Mentions after it that were replied to meanwhile aren't replied to again.
+
+        :param mentions: mentions to reply to, oldest first.
+        :param reply: function replying to one mention,
+            returning its record, or None if there was nothing to reply to.
+        :param mention_id: function getting the id mention_since_id is kept in.
+        :param concurrency: most replies in flight at once.
+        :returns: records of replies made, in the order of mentions.
+        """
+        replied = self._mentions_replied
+        failed = threading.Event()
+
+        def attempt(mention: Any) -> Tuple[bool, Optional[OutputRecord]]:
+            """Reply to one mention, returning whether it was handled, and its record."""
+            if mention_id(mention) in replied:
+                return True, None
+            if failed.is_set():
+                return False, None
+
+            try:
+                return True, reply(mention)
+            except Exception as e:
+                failed.set()
+                self.lerror(f"Replying to mention {mention_id(mention)} failed, "
+                            f"it will be tried again on the next poll: {e}")
+                return False, None
+
+        outcomes = self.reply_all(mentions, attempt, concurrency=concurrency)
+
+        records = []
+        in_order = True
+        for mention, (handled, record) in zip(mentions, outcomes):
+            if record is not None:
+                records.append(record)
+
+            in_order = in_order and handled
+            if in_order:
+                self.mention_since_id = newest_id(self.mention_since_id, mention_id(mention))
+                replied.discard(mention_id(mention))
+            elif handled:
+                replied.add(mention_id(mention))
+
+        return records
+
+class PhaseTimings:
+    """
+    Timings for the phases of a single post (uploads, status post...),
+    stored in the record of that post.
+    Each phase maps to a list of durations in seconds,
+    one per time the phase happened,
+    and "total" is the seconds since the timings were started.
+    """
+    def __init__(self, output: OutputSkeleton) -> None:
+        self.output = output
+        self.phases: Dict[str, List[float]] = {}
+        self.start = self.output.clock.perf_counter()
+
+    @contextmanager
+    def phase(self, operation: str) -> Iterator[None]:
+        """
+        Time one phase of the post.
+        Also recorded in the output's metrics.
+
+        :param operation: name of phase, like "media_upload".
+        """
+        timer = self.output.timed(operation)
+        try:
+            with timer:
+                yield
+        finally:
+            self.phases.setdefault(operation, []).append(timer.elapsed)
+
+    def to_dict(self) -> Dict[str, Any]:
+        """Get timings in the form they're stored in records."""
+        timings: Dict[str, Any] = {key: list(value) for key, value in self.phases.items()}
+        timings["total"] = self.output.clock.perf_counter() - self.start
+        return timings
+
+
+class OutputRecord(SlottedRecord):
     """Record for an output occurrence."""
+    # timings are per-phase timings, present on records from outputs that track them.
+    __slots__ = ("_type", "timestamp", "timings")
+
+    timings: Dict[str, Any]
+
     def __init__(self) -> None:
         """Create tweet record object."""
+        super().__init__()
         self._type = self.__class__.__name__
         self.timestamp = datetime.now().isoformat()
 
-    def __str__(self) -> str:
-        """Print object."""
-        return str(self.__dict__)
 
-    def __repr__(self) -> str:
-        """repr object"""
-        return str(self)
+class SkippedRecord(OutputRecord):
+    """Record of a post that was never attempted on an output, and why."""
+    __slots__ = ("reason", "fingerprint")
+
+    def __init__(self, reason: str="", fingerprint: str=None) -> None:
+        """
+        Create skipped record.
+
+        :param reason: why the post was skipped, like "duplicate".
+        :param fingerprint: fingerprint of the post, if it has one.
+        """
+        super().__init__()
+        self.reason = reason
+        if fingerprint is not None:
+            self.fingerprint = fingerprint
 
-    def __eq__(self, other:Any) -> bool:
-        """Overrides the default implementation"""
-        if isinstance(other, OutputRecord):
-            for key, value in self.__dict__.items():
-                if value != other.__dict__[key]:
-                    return False
 
-                return True
-        return False
+class TimedOutRecord(OutputRecord):
+    """Record of an output call abandoned at the iteration deadline, still unfinished."""
+    __slots__ = ("method", "error", "error_code")
 
-    @classmethod
-    def from_dict(cls, obj_dict: Dict[str, Any]) -> "OutputRecord":
-        """Get object back from dict."""
-        obj = cls()
-        for key, item in obj_dict.items():
-            obj.__dict__[key] = item
+    def __init__(self, method: str="", deadline: float=0.0) -> None:
+        """
+        Create timed-out record.
 
-        return obj
+        :param method: output method that was called, like "send".
+        :param deadline: seconds the iteration was allowed.
+        """
+        super().__init__()
+        self.method = method
+        self.error = f"{method} didn't finish within the {deadline} second deadline."
+        self.error_code = "deadline"
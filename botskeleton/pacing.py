@@ -0,0 +1,49 @@
+"""Spacing out calls to outputs, to stay inside their rate limits."""
+import threading
+from typing import Dict
+
+from .simulation import Clock
+
+
+class Pacer:
+    """
+    Keeps calls to each output at least some seconds apart,
+    for any number of threads.
+    Each caller reserves the next free slot for its output and sleeps until it,
+    so calls start in the order they were reserved.
+    """
+    def __init__(self, intervals: Dict[str, float]=None, *, clock: Clock=None) -> None:
+        """
+        Create pacer.
+
+        :param intervals: seconds between calls, by output key.
+            outputs not given aren't paced.
+        :param clock: clock to tell the time and sleep with (default real time).
+        """
+        self.intervals = dict(intervals or {})
+        self.clock = clock if clock is not None else Clock()
+
+        self._lock = threading.Lock()
+        self._next: Dict[str, float] = {}
+
+    def wait(self, key: str) -> float:
+        """
+        Wait for the next slot to call an output in.
+
+        :param key: key of output.
+        :returns: seconds waited.
+        """
+        interval = self.intervals.get(key, 0.0)
+        if interval <= 0:
+            return 0.0
+
+        with self._lock:
+            now = self.clock.perf_counter()
+            start = max(now, self._next.get(key, now))
+            self._next[key] = start + interval
+
+        wait = start - now
+        if wait > 0:
+            self.clock.sleep(wait)
+
+        return wait
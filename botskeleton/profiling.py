@@ -0,0 +1,117 @@
+"""Optional profiling of bot iterations."""
+import cProfile
+import functools
+import os
+import random
+import threading
+from datetime import datetime
+from logging import Logger
+from os import path
+from typing import Any, Callable, List, Optional, TypeVar
+
+T = TypeVar("T")
+
+
+class IterationProfiler:
+    """
+    Profiles calls with cProfile,
+    writing one stats file per profiled call and keeping only the newest few.
+    Stats files can be read with pstats or any tool that understands them (snakeviz, etc).
+    """
+    def __init__(
+            self,
+            *,
+            directory: str,
+            sample_rate: float=1.0,
+            keep: int=20,
+            log: Logger=None,
+    ) -> None:
+        """
+        Create profiler.
+
+        :param directory: directory to write stats files in.
+            created if it doesn't exist.
+        :param sample_rate: fraction (0 to 1) of calls to profile.
+        :param keep: number of stats files to keep.
+            older ones are deleted.
+        :param log: logger to report stats files to (optional).
+        """
+        self.directory = directory
+        self.sample_rate = sample_rate
+        self.keep = keep
+        self.log = log
+
+        self._random = random.Random()
+        self._lock = threading.Lock()
+        self._counter = 0
+
+        os.makedirs(self.directory, exist_ok=True)
+
+    def run(self, name: str, func: Callable[..., T], *args: Any, **kwargs: Any) -> T:
+        """
+        Call a function, profiling it if this call is sampled.
+
+        :param name: name to use in the stats filename.
+        :param func: function to call.
+        :param args: positional arguments for function.
+        :param kwargs: keyword arguments for function.
+        :returns: whatever the function returns.
+        """
+        if self.sample_rate < 1 and self._random.random() >= self.sample_rate:
+            return func(*args, **kwargs)
+
+        profile = cProfile.Profile()
+        try:
+            return profile.runcall(func, *args, **kwargs)
+        finally:
+            stats_filename = self._stats_filename(name)
+            profile.dump_stats(stats_filename)
+            if self.log is not None:
+                self.log.debug(f"Wrote profile of {name} to {stats_filename}.")
+
+            self._rotate()
+
+    def stats_files(self) -> List[str]:
+        """
+        Get stats files written so far, oldest first.
+
+        :returns: list of paths.
+        """
+        files = [path.join(self.directory, file) for file in os.listdir(self.directory)
+                 if file.endswith(".prof")]
+        return sorted(files)
+
+    def _stats_filename(self, name: str) -> str:
+        """Get a new, sortable stats filename."""
+        with self._lock:
+            self._counter += 1
+            counter = self._counter
+
+        timestamp = datetime.now().strftime("%Y%m%dT%H%M%S.%f")
+        return path.join(self.directory, f"{timestamp}-{os.getpid()}-{counter:06d}-{name}.prof")
+
+    def _rotate(self) -> None:
+        """Delete the oldest stats files beyond the number we keep."""
+        with self._lock:
+            files = self.stats_files()
+            for old_file in files[:max(0, len(files) - self.keep)]:
+                try:
+                    os.remove(old_file)
+                except OSError:
+                    pass
+
+
+def profiled(method: Callable[..., T]) -> Callable[..., T]:
+    """
+    Decorate a BotSkeleton method,
+    so the whole call (user callbacks included) is profiled when the bot has a profiler.
+    """
+    @functools.wraps(method)
+    def wrapper(self: Any, *args: Any, **kwargs: Any) -> T:
+        profiler: Optional[IterationProfiler] = getattr(self, "profiler", None)
+        if profiler is None:
+            return method(self, *args, **kwargs)
+
+        return profiler.run(method.__name__, method, self, *args, **kwargs)
+
+    return wrapper
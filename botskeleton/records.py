@@ -0,0 +1,152 @@
+"""Compact base for history records."""
+from typing import Any, Dict, FrozenSet, Optional, Tuple, Type
+
+_FIELDS: Dict[type, Tuple[str, ...]] = {}
+_FIELD_SETS: Dict[type, FrozenSet[str]] = {}
+
+# record classes by name (their _type), filled in as they're defined.
+_CLASSES: Dict[str, type] = {}
+
+
+class SlottedRecord:
+    """
+    Base for records kept in history.
+    Fields are __slots__, so records don't each carry a __dict__,
+    and keys we don't know about (old or foreign records) are kept aside in _extra,
+    so they survive a load/save round trip.
+    """
+    __slots__ = ("_extra",)
+
+    def __init_subclass__(cls, **kwargs: Any) -> None:
+        super().__init_subclass__(**kwargs)  # type: ignore
+        _CLASSES[cls.__name__] = cls
+
+    def __init__(self) -> None:
+        self._extra: Optional[Dict[str, Any]] = None
+
+    def __eq__(self, other: Any) -> bool:
+        """Records are equal if they're the same kind of record, with the same fields."""
+        if isinstance(other, SlottedRecord):
+            return type(self) is type(other) and self.to_dict() == other.to_dict()
+        return False
+
+    @classmethod
+    def fields(cls) -> Tuple[str, ...]:
+        """
+        Get all field names of this record class.
+
+        :returns: tuple of field names, in declaration order.
+        """
+        fields = _FIELDS.get(cls)
+        if fields is None:
+            collected = []
+            for klass in reversed(cls.__mro__):
+                for name in klass.__dict__.get("__slots__", ()):
+                    if name != "_extra" and name not in collected:
+                        collected.append(name)
+
+            fields = tuple(collected)
+            _FIELDS[cls] = fields
+
+        return fields
+
+    def to_dict(self) -> Dict[str, Any]:
+        """
+        Get record as a dict, ready for JSON.
+        Only fields that have been set are included,
+        exactly like the __dict__ records used to have.
+
+        :returns: dict of record.
+        """
+        obj_dict = {}
+        for name in self.fields():
+            try:
+                obj_dict[name] = object.__getattribute__(self, name)
+            except AttributeError:
+                continue
+
+        if self._extra:
+            obj_dict.update(self._extra)
+
+        return obj_dict
+
+    @classmethod
+    def from_dict(cls: Type[Any], obj_dict: Dict[str, Any], *, defaults: bool=True) -> Any:
+        """
+        Get object back from dict.
+
+        :param obj_dict: dict as produced by to_dict.
+        :param defaults: whether fields missing from obj_dict get a new record's defaults.
+            without, they're left unset, so the record turns back into exactly obj_dict.
+        :returns: new record.
+        """
+        if defaults:
+            obj = cls()
+        else:
+            obj = object.__new__(cls)
+            obj._extra = None
+
+        fields = _FIELD_SETS.get(cls)
+        if fields is None:
+            fields = _FIELD_SETS[cls] = frozenset(cls.fields())
+
+        extra: Optional[Dict[str, Any]] = None
+        for key, item in obj_dict.items():
+            if key in fields:
+                setattr(obj, key, item)
+            else:
+                if extra is None:
+                    extra = obj._extra = {}
+                extra[key] = item
+
+        return obj
+
+    @property
+    def __dict__(self) -> Dict[str, Any]:  # type: ignore
+        """Read-only view of fields, for code written before records had slots."""
+        return self.to_dict()
+
+    def __getattr__(self, name: str) -> Any:
+        """Look up keys kept aside from old or foreign records."""
+        try:
+            extra = object.__getattribute__(self, "_extra")
+        except AttributeError:
+            extra = None
+
+        if extra is not None and name in extra:
+            return extra[name]
+
+        raise AttributeError(f"{type(self).__name__!r} object has no attribute {name!r}")
+
+    def __str__(self) -> str:
+        """Print object."""
+        return str(self.to_dict())
+
+    def __repr__(self) -> str:
+        """repr object."""
+        return str(self)
+
+
+def record_from_dict(obj_dict: Dict[str, Any]) -> Any:
+    """
+    Get a record back from its dict,
+    as the record class its _type names.
+    Fields missing from the dict are left unset, so it saves back unchanged.
+    Dicts of classes that haven't been imported (outputs that aren't active) stay dicts.
+
+    :param obj_dict: dict as produced by to_dict.
+    :returns: new record, or obj_dict.
+    """
+    klass: Any = _CLASSES.get(obj_dict.get("_type", ""))
+    if klass is None:
+        return obj_dict
+
+    return klass.from_dict(obj_dict, defaults=False)
+
+
+def json_default(obj: Any) -> Any:
+    """json.dump default hook, for records nested in places json doesn't expect them."""
+    if isinstance(obj, SlottedRecord):
+        return obj.to_dict()
+
+    return obj.__dict__.copy()
@@ -0,0 +1,122 @@
+"""Adaptive naps, stretching or shrinking the delay between iterations as conditions change."""
+import random
+from typing import Mapping, NamedTuple, Optional
+
+from .simulation import Clock
+
+
+class RateLimit(NamedTuple):
+    """What an output's API said was left of its rate limit."""
+    remaining: int
+    limit: int
+    # when the window resets, in seconds since the epoch.
+    reset: float
+
+
+class AdaptiveDelay:
+    """
+    Works out how long a bot should nap before its next iteration.
+
+    Starts from the bot's delay, less the time the iteration itself took,
+    so iterations keep to the delay instead of drifting later by their own length.
+    The delay is stretched while outputs are failing (tracked as a moving error rate)
+    and while the outbox has a backlog to work through,
+    and is jittered, so bots started together don't all wake up at the same second.
+    The jittered delay is kept between min_delay and max_delay,
+    and is never shorter than it takes to spread an output's remaining rate-limit budget
+    evenly over the rest of its window.
+    """
+    def __init__(
+            self,
+            *,
+            delay: float,
+            min_delay: float=None,
+            max_delay: float=None,
+            jitter: float=0.1,
+            error_weight: float=4.0,
+            error_smoothing: float=0.3,
+            backlog_weight: float=0.25,
+            seed: int=None,
+            clock: Clock=None,
+    ) -> None:
+        """
+        Create delay policy.
+
+        :param delay: seconds between iterations when all is well.
+        :param min_delay: fewest seconds to nap (default 0).
+        :param max_delay: most seconds to nap (default 10 times delay),
+            except when waiting for an exhausted rate limit to reset.
+        :param jitter: fraction of the delay to randomly add or take away.
+        :param error_weight: how much longer to nap when every call is failing,
+            as a multiple of the delay.
+        :param error_smoothing: weight of the latest iteration in the moving error rate.
+        :param backlog_weight: how much longer to nap per post waiting in the outbox,
+            as a multiple of the delay.
+        :param seed: seed for jitter (optional).
+        :param clock: clock to tell the time with (default real time).
+        """
+        self.delay = delay
+        self.min_delay = min_delay if min_delay is not None else 0.0
+        self.max_delay = max_delay if max_delay is not None else 10 * delay
+        self.jitter = jitter
+        self.error_weight = error_weight
+        self.error_smoothing = error_smoothing
+        self.backlog_weight = backlog_weight
+        self.clock = clock if clock is not None else Clock()
+
+        self.error_rate = 0.0
+        self._random = random.Random(seed)
+
+    def next_delay(
+            self,
+            *,
+            elapsed: float=0.0,
+            posts: int=0,
+            errors: int=0,
+            backlog: int=0,
+            rate_limits: Mapping[str, Optional[RateLimit]]=None,
+    ) -> float:
+        """
+        Work out the next nap.
+
+        :param elapsed: seconds since the last nap ended.
+        :param posts: successful output calls since the last nap.
+        :param errors: failed output calls since the last nap.
+        :param backlog: posts waiting in the outbox.
+        :param rate_limits: latest rate limit of each output, if known.
+        :returns: seconds to nap.
+        """
+        if posts + errors > 0:
+            latest = errors / (posts + errors)
+            self.error_rate += self.error_smoothing * (latest - self.error_rate)
+
+        delay = self.delay * (1 + self.error_weight * self.error_rate
+                              + self.backlog_weight * backlog)
+        delay += self.delay * self.jitter * self._random.uniform(-1, 1)
+        delay = min(max(delay - elapsed, self.min_delay), self.max_delay)
+
+        # rate limits are hard limits, even past max_delay.
+        delay = max(delay, self.budget_delay(rate_limits or {}))
+        return max(0.0, delay)
+
+    def budget_delay(self, rate_limits: Mapping[str, Optional[RateLimit]]) -> float:
+        """
+        Get the shortest nap that keeps every output within its rate limit,
+        spending what's left evenly until the window resets.
+
+        :param rate_limits: latest rate limit of each output, if known.
+        :returns: seconds.
+        """
+        now = self.clock.now().timestamp()
+        delay = 0.0
+        for rate_limit in rate_limits.values():
+            if rate_limit is None:
+                continue
+
+            until_reset = max(0.0, rate_limit.reset - now)
+            if rate_limit.remaining <= 0:
+                delay = max(delay, until_reset)
+            else:
+                delay = max(delay, until_reset / rate_limit.remaining)
+
+        return delay
@@ -0,0 +1,297 @@
+"""History shared between several processes, through a lock file and an append-only journal."""
+import json
+import os
+import threading
+from contextlib import contextmanager
+from os import path
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from .error import BotSkeletonException
+from .history import read_history, replace_durably, uncompressed_filename
+from .records import json_default
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None  # type: ignore
+
+Changes = Tuple[int, List[Dict[str, Any]]]
+
+
+class SharedHistory:
+    """
+    Keeps one process's in-memory history in step with other processes sharing the history file.
+
+    Records get sequence numbers, in the order processes add them.
+    New records are appended to HISTORY.journal, one JSON line each,
+    under an exclusive lock on HISTORY.lock,
+    and every process reads the journal from where it left off,
+    so picking up other processes' records never means rereading everything.
+    Now and then a process compacts:
+    it writes the new history file beside the live one (archiving first, if there's a policy),
+    notes in HISTORY.state which sequence numbers it holds,
+    and where in it the records from the journal start,
+    then replaces the live history file with it and starts the journal over,
+    so the others can tell what they missed,
+    and usually read it from there rather than from the beginning.
+    A compaction cut short by a crash is finished by the next process to take the lock
+    exclusively, and until then readers read the new history file from beside the live one.
+
+    Every process using the history file must be using it this way.
+    """
+    def __init__(self, history_filename: str) -> None:
+        """
+        Set up shared history.
+
+        :param history_filename: history file being shared.
+        :raises BotSkeletonException: if the platform has no file locking.
+        """
+        if fcntl is None:
+            raise BotSkeletonException(desc="Shared history needs fcntl file locking, "
+                                            "which this platform doesn't have.")
+
+        self.history_filename = history_filename
+        self.journal_filename = f"{history_filename}.journal"
+        self.state_filename = f"{history_filename}.state"
+
+        # compression goes by extension, so keep it last.
+        base = uncompressed_filename(history_filename)
+        self.staged_filename = f"{base}.compacting{history_filename[len(base):]}"
+
+        # sequence number of the first record in memory, and of the next record to come.
+        self.start = 0
+        self.seen = 0
+        # journal records since the last compaction.
+        self.journal_records = 0
+
+        self._generation: Optional[int] = None
+        self._offset = 0
+
+        self._lock = threading.RLock()
+        self._depth = 0
+        self._lock_file = open(f"{history_filename}.lock", "a")
+
+    @contextmanager
+    def locked(self, *, exclusive: bool) -> Iterator[None]:
+        """
+        Hold the cross-process lock.
+        Reentrant within a process;
+        the outermost holder decides whether it is exclusive.
+        Taking it exclusively finishes any compaction a crash cut short.
+
+        :param exclusive: lock exclusively (for writing) rather than shared (for reading).
+        :returns: context manager.
+        """
+        with self._lock:
+            if self._depth == 0:
+                fcntl.flock(self._lock_file, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            self._depth += 1
+            try:
+                if self._depth == 1 and exclusive:
+                    state = self._read_state()
+                    if state.get("pending"):
+                        self._finish_compaction(state)
+                yield
+            finally:
+                self._depth -= 1
+                if self._depth == 0:
+                    fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+
+    def reset(self) -> None:
+        """
+        Forget what's been read,
+        so the next catch_up starts from the history file again.
+
+        :returns: None
+        """
+        with self._lock:
+            self.start = self.seen = self.journal_records = 0
+            self._generation = None
+            self._offset = 0
+
+    def catch_up(self) -> Changes:
+        """
+        Get what other processes changed since we last looked.
+        Must be called holding the lock.
+
+        :returns: number of oldest in-memory records that were archived and should be dropped,
+            and record dicts added since, oldest first.
+        """
+        drop = 0
+        new: List[Dict[str, Any]] = []
+
+        state = self._read_state()
+        if state["generation"] != self._generation:
+            # someone compacted.
+            # records before the history file's first one have been archived,
+            # and the ones we hadn't seen yet moved from the journal into the history file.
+            drop = min(max(0, state["start"] - self.start), self.seen - self.start)
+            self.start += drop
+            if self.seen < state["start"]:
+                self.start = self.seen = state["start"]
+
+            # a compaction cut short before replacing the live history file
+            # left the file the state describes beside it.
+            history_filename = self.history_filename
+            if state.get("pending") and path.isfile(self.staged_filename):
+                history_filename = self.staged_filename
+
+            # records before the tail (the ones compacted from the journal) are usually seen.
+            skip = self.seen - state["start"]
+            first, offset = 0, 0
+            if state.get("tail_offset") is not None and skip >= state["tail"]:
+                first, offset = state["tail"], state["tail_offset"]
+
+            count = first
+            if path.isfile(history_filename):
+                records = read_history(history_filename, stream=True, offset=offset)
+                for index, record in enumerate(records, first):
+                    if index >= skip:
+                        new.append(record)
+                    count += 1
+
+            self.seen = state["start"] + count
+            self._generation = state["generation"]
+            self._offset = 0
+            self.journal_records = 0
+
+        for seq, record in self._read_journal():
+            self.journal_records += 1
+            if seq >= self.seen:
+                new.append(record)
+                self.seen = seq + 1
+
+        return drop, new
+
+    def append(self, record: Dict[str, Any]) -> Changes:
+        """
+        Add a record to the journal, durably,
+        after catching up with other processes.
+
+        :param record: record dict to add.
+        :returns: changes made by other processes before this record,
+            as catch_up returns them.
+        """
+        with self.locked(exclusive=True):
+            changes = self.catch_up()
+
+            line = json.dumps({"seq": self.seen, "record": record}, sort_keys=True,
+                              default=json_default)
+            with open(self.journal_filename, "a+") as f:
+                # a writer that crashed mid-line leaves a partial line.
+                # keep it on its own line, where readers skip it.
+                f.seek(0, os.SEEK_END)
+                if f.tell() > 0:
+                    f.seek(f.tell() - 1)
+                    if f.read(1) != "\n":
+                        f.write("\n")
+
+                f.write(line)
+                f.write("\n")
+                f.flush()
+                os.fsync(f.fileno())
+                self._offset = f.tell()
+
+            self.seen += 1
+            self.journal_records += 1
+            return changes
+
+    def tail(self, count: int) -> int:
+        """
+        Get where the records from the journal will start in a new history file,
+        the ones other processes may not have read yet.
+        Must be called holding the exclusive lock, after catch_up.
+
+        :param count: number of records the new history file will hold.
+        :returns: index of the first of them.
+        """
+        return max(0, count - self.journal_records)
+
+    def compacted(self, *, count: int, tail: int=0, tail_offset: int=None) -> None:
+        """
+        Record that the new history file was just written to staged_filename,
+        holding the records from self.start on,
+        then make it the live history file and start the journal over.
+        Must be called holding the exclusive lock, after catch_up.
+
+        :param count: number of records in the new history file.
+        :param tail: index of the first record from the journal, see tail.
+        :param tail_offset: where that record starts, as write_history returned it.
+            without it, other processes read the whole file to catch up.
+        :returns: None
+        """
+        state = {"generation": (self._generation or 0) + 1, "start": self.start,
+                 "count": count, "tail": tail, "tail_offset": tail_offset, "pending": True}
+        # the state goes first, so a crash from here on leaves it describing the new file.
+        self._write_state(state)
+        self._generation = self._finish_compaction(state)
+        self._offset = 0
+        self.journal_records = 0
+
+    def _finish_compaction(self, state: Dict[str, Any]) -> int:
+        """
+        Replace the live history file with the staged one and start the journal over,
+        for a compaction whose state is written.
+        Returns the generation it finishes as.
+        Must be called holding the exclusive lock.
+        """
+        if path.isfile(self.staged_filename):
+            replace_durably(self.staged_filename, self.history_filename)
+
+        temp_filename = f"{self.journal_filename}.tmp"
+        open(temp_filename, "w").close()
+        replace_durably(temp_filename, self.journal_filename)
+
+        # a new generation again,
+        # so anyone who read the old journal while the compaction was pending starts over.
+        generation = state["generation"] + 1
+        finished = dict(state, generation=generation)
+        del finished["pending"]
+        self._write_state(finished)
+        return generation
+
+    def close(self) -> None:
+        """
+        Close the lock file.
+
+        :returns: None
+        """
+        self._lock_file.close()
+
+    def _read_state(self) -> Dict[str, Any]:
+        """Read where the history file's records start, and which compaction wrote it."""
+        if not path.isfile(self.state_filename):
+            return {"generation": 0, "start": 0, "count": None}
+
+        with open(self.state_filename) as f:
+            state: Dict[str, Any] = json.load(f)
+
+        return state
+
+    def _write_state(self, state: Dict[str, Any]) -> None:
+        """Replace the state file durably."""
+        temp_filename = f"{self.state_filename}.tmp"
+        with open(temp_filename, "w") as f:
+            json.dump(state, f)
+        replace_durably(temp_filename, self.state_filename)
+
+    def _read_journal(self) -> Iterator[Tuple[int, Dict[str, Any]]]:
+        """Read complete journal lines past our offset."""
+        if not path.isfile(self.journal_filename):
+            return
+
+        with open(self.journal_filename) as f:
+            f.seek(self._offset)
+            text = f.read()
+
+        # only whole lines. a line still being written is left for next time.
+        end = text.rfind("\n") + 1
+        self._offset += len(text[:end].encode("utf-8"))
+
+        for line in text[:end].splitlines():
+            try:
+                entry = json.loads(line)
+            except json.decoder.JSONDecodeError:
+                continue
+
+            yield entry["seq"], entry["record"]
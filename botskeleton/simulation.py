@@ -0,0 +1,143 @@
+"""Clocks and latency models, for running bots without the network or real time."""
+import math
+import random
+import threading
+import time
+from datetime import datetime, timedelta
+from typing import Any, Dict, Optional
+
+from .error import BotSkeletonException
+
+# (distribution, parameters...) per operation, in seconds.
+# lognormal takes the median and the spread (sigma of the underlying normal),
+# which is how API latencies tend to look: mostly quick, with a long tail.
+DEFAULT_LATENCIES: Dict[str, Any] = {
+    "status_post": ("lognormal", 0.35, 0.5),
+    "media_upload": ("lognormal", 1.5, 0.6),
+    "timeline_fetch": ("lognormal", 0.4, 0.5),
+}
+
+DISTRIBUTIONS = {
+    "constant": 1,
+    "uniform": 2,
+    "normal": 2,
+    "lognormal": 2,
+    "exponential": 1,
+}
+
+
+class Clock:
+    """Real time. Bots and outputs ask this for the time instead of the time module."""
+    def now(self) -> datetime:
+        """Get the current date and time."""
+        return datetime.now()
+
+    def perf_counter(self) -> float:
+        """Get seconds from an arbitrary start, for measuring durations."""
+        return time.perf_counter()
+
+    def sleep(self, seconds: float) -> None:
+        """Wait some seconds."""
+        time.sleep(seconds)
+
+
+class SimulatedClock(Clock):
+    """
+    Time that only passes when something sleeps,
+    and then passes instantly.
+    Safe to use from several threads.
+    """
+    def __init__(self, start: datetime=None) -> None:
+        """
+        Create clock.
+
+        :param start: date and time the clock starts at (default now).
+        """
+        self.start = start if start is not None else datetime.now()
+        self.elapsed = 0.0
+        self._lock = threading.Lock()
+
+    def now(self) -> datetime:
+        with self._lock:
+            return self.start + timedelta(seconds=self.elapsed)
+
+    def perf_counter(self) -> float:
+        with self._lock:
+            return self.elapsed
+
+    def sleep(self, seconds: float) -> None:
+        with self._lock:
+            self.elapsed += max(0.0, seconds)
+
+
+class LatencyModel:
+    """
+    Random latencies per operation ("status_post", "media_upload"...),
+    drawn from configurable distributions.
+
+    Each operation maps to a number of seconds (constant),
+    or a tuple of distribution name and parameters:
+    ("constant", seconds),
+    ("uniform", low, high),
+    ("normal", mean, stddev) (never below zero),
+    ("lognormal", median, sigma),
+    or ("exponential", mean).
+    """
+    def __init__(self, latencies: Dict[str, Any]=None, *, seed: Any=None) -> None:
+        """
+        Create latency model.
+
+        :param latencies: distributions per operation,
+            overriding DEFAULT_LATENCIES.
+            operations with no distribution take no time.
+        :param seed: random seed, for repeatable runs (optional).
+        :raises BotSkeletonException: if a distribution isn't understood.
+        """
+        self.latencies = dict(DEFAULT_LATENCIES, **(latencies or {}))
+        for operation, distribution in self.latencies.items():
+            _check(operation, distribution)
+
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def sample(self, operation: str) -> float:
+        """
+        Draw a latency for an operation.
+
+        :param operation: name of operation.
+        :returns: seconds.
+        """
+        distribution = self.latencies.get(operation)
+        if distribution is None:
+            return 0.0
+
+        if isinstance(distribution, (int, float)):
+            return float(distribution)
+
+        kind, *params = distribution
+        with self._lock:
+            if kind == "constant":
+                return float(params[0])
+            elif kind == "uniform":
+                return self._random.uniform(params[0], params[1])
+            elif kind == "normal":
+                return max(0.0, self._random.gauss(params[0], params[1]))
+            elif kind == "lognormal":
+                return params[0] * math.exp(params[1] * self._random.gauss(0.0, 1.0))
+            else:
+                return self._random.expovariate(1.0 / params[0])
+
+
+def _check(operation: str, distribution: Any) -> None:
+    """Make sure a latency distribution is one we can draw from."""
+    if isinstance(distribution, (int, float)):
+        return
+
+    kind: Optional[str] = None
+    if isinstance(distribution, (list, tuple)) and distribution:
+        kind = distribution[0]
+
+    if kind not in DISTRIBUTIONS or len(distribution) - 1 != DISTRIBUTIONS[kind]:
+        raise BotSkeletonException(desc=(f"Latency for {operation} should be seconds or one of "
+                                         f"{sorted(DISTRIBUTIONS)} with its parameters, "
+                                         f"not {distribution!r}."))
@@ -0,0 +1,225 @@
+"""SOS messages to a bot's owner, sent in the background, deduplicated and rate-limited."""
+import atexit
+import threading
+import time
+from collections import OrderedDict
+from logging import Logger
+from typing import Callable, Dict, List, Optional
+
+# seconds between messages to the owner.
+MIN_INTERVAL = 300.0
+
+# seconds an error is only counted, not resent, after it was last reported.
+DEDUPE_WINDOW = 3600.0
+
+# most characters in one message (birdsite DMs allow 10000).
+MAX_MESSAGE_LENGTH = 10000
+
+# seconds to spend sending waiting messages at exit.
+EXIT_TIMEOUT = 10.0
+
+
+class SosNotifier:
+    """
+    Sends SOS messages from a background thread,
+    so reporting an error never holds up the call that failed.
+
+    Errors are grouped by signature (what kind of error it is).
+    A signature reported within the dedupe window is only counted,
+    and the count is reported once the window passes.
+    At most one message goes out every min_interval seconds;
+    errors arriving meanwhile are sent together as a digest.
+    Whatever is still waiting at exit is sent then,
+    for up to exit_timeout seconds.
+    """
+    def __init__(
+            self,
+            *,
+            send: Callable[[str], None],
+            min_interval: float=MIN_INTERVAL,
+            dedupe_window: float=DEDUPE_WINDOW,
+            exit_timeout: float=EXIT_TIMEOUT,
+            log: Logger=None,
+    ) -> None:
+        """
+        Create notifier. The worker starts with the first notification.
+
+        :param send: function sending one message to the owner.
+            exceptions it raises are logged and the message dropped.
+        :param min_interval: seconds between messages.
+        :param dedupe_window: seconds an error signature is only counted after being reported.
+        :param exit_timeout: seconds to spend sending waiting messages at exit.
+        :param log: logger to use (optional).
+        """
+        self.send = send
+        self.min_interval = min_interval
+        self.dedupe_window = dedupe_window
+        self.exit_timeout = exit_timeout
+        self.log = log
+
+        # messages sent, and notifications that didn't get a message of their own.
+        self.sent = 0
+        self.suppressed = 0
+
+        self._condition = threading.Condition()
+        # signature: first message and count, waiting to be reported.
+        self._pending: "OrderedDict[str, List]" = OrderedDict()
+        # signature: when last reported, and how many times it happened since.
+        self._reported: Dict[str, List] = {}
+        self._last_send: Optional[float] = None
+        self._busy = False
+        self._stopping = False
+        self._thread: Optional[threading.Thread] = None
+
+    def notify(self, message: str, *, signature: str=None) -> None:
+        """
+        Queue an SOS message. Returns straight away.
+
+        :param message: message describing the error.
+        :param signature: what kind of error it is,
+            for recognizing repeats (default the message itself).
+        :returns: None
+        """
+        signature = signature if signature is not None else message
+        with self._condition:
+            if self._stopping:
+                return
+
+            if signature in self._pending:
+                self._pending[signature][1] += 1
+                self.suppressed += 1
+            elif signature in self._reported \
+                    and time.monotonic() - self._reported[signature][0] < self.dedupe_window:
+                self._reported[signature][1] += 1
+                self.suppressed += 1
+            else:
+                self._pending[signature] = [message, 1]
+
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="botskeleton-sos",
+                                                daemon=True)
+                self._thread.start()
+                # once, for the worker, and undone by stop.
+                atexit.register(self._stop_at_exit)
+            self._condition.notify_all()
+
+    def flush(self, timeout: float=None) -> bool:
+        """
+        Send whatever is waiting now, without waiting for the rate limit,
+        and wait for it to go out.
+
+        :param timeout: most seconds to wait (optional).
+        :returns: whether everything waiting was sent.
+        """
+        with self._condition:
+            self._last_send = None
+            self._condition.notify_all()
+            return self._condition.wait_for(lambda: not self._due() and not self._busy,
+                                            timeout)
+
+    def stop(self, timeout: float=None) -> None:
+        """
+        Flush, then stop the worker.
+
+        :param timeout: most seconds to wait for each (optional).
+        :returns: None
+        """
+        atexit.unregister(self._stop_at_exit)
+
+        self.flush(timeout)
+        with self._condition:
+            self._stopping = True
+            self._condition.notify_all()
+
+        thread = self._thread
+        if thread is not None:
+            thread.join(timeout)
+
+    def _stop_at_exit(self) -> None:
+        """Send what's waiting and stop, at exit."""
+        self.stop(self.exit_timeout)
+
+    def _run(self) -> None:
+        """Worker loop, sending messages as the rate limit allows."""
+        while True:
+            with self._condition:
+                while True:
+                    if self._stopping:
+                        return
+
+                    wait = self._wait_time()
+                    if wait is not None and wait <= 0:
+                        break
+                    self._condition.wait(wait)
+
+                message = self._compose()
+                self._busy = True
+                self._last_send = time.monotonic()
+
+            try:
+                self.send(message)
+                self.sent += 1
+            except Exception as e:
+                if self.log is not None:
+                    self.log.error(f"Error trying to send SOS: {e}")
+            finally:
+                with self._condition:
+                    self._busy = False
+                    self._condition.notify_all()
+
+    def _wait_time(self) -> Optional[float]:
+        """
+        Seconds until there's something to send that the rate limit allows,
+        or None if nothing is waiting. Must be called holding the lock.
+        """
+        now = time.monotonic()
+        if self._pending:
+            due = now
+        else:
+            repeats = [when + self.dedupe_window for when, count in self._reported.values()
+                       if count > 0]
+            if not repeats:
+                return None
+            due = min(repeats)
+
+        if self._last_send is not None:
+            due = max(due, self._last_send + self.min_interval)
+
+        return due - now
+
+    def _due(self) -> bool:
+        """Whether anything is waiting to be reported. Must be called holding the lock."""
+        now = time.monotonic()
+        return bool(self._pending) or any(count > 0 and now - when >= self.dedupe_window
+                                          for when, count in self._reported.values())
+
+    def _compose(self) -> str:
+        """Take everything due and make one message of it. Must be called holding the lock."""
+        now = time.monotonic()
+        lines = []
+        for signature, (message, count) in self._pending.items():
+            # repeats since it was last reported, if that was a while ago.
+            count += self._reported.get(signature, [now, 0])[1]
+            lines.append(message if count == 1 else f"({count} times) {message}")
+            self._reported[signature] = [now, 0]
+        self._pending.clear()
+
+        for signature, reported in self._reported.items():
+            when, count = reported
+            if count > 0 and now - when >= self.dedupe_window:
+                lines.append(f"({count} more times since it was last reported) {signature}")
+                reported[:] = [now, 0]
+
+        # forget signatures quiet for a whole window.
+        for signature in [signature for signature, (when, count) in self._reported.items()
+                          if count == 0 and now - when >= self.dedupe_window]:
+            del self._reported[signature]
+
+        if len(lines) == 1:
+            message = lines[0]
+        else:
+            message = f"{len(lines)} kinds of error:\n" + "\n".join(f"- {line}" for line in lines)
+
+        if len(message) > MAX_MESSAGE_LENGTH:
+            message = message[:MAX_MESSAGE_LENGTH - 3] + "..."
+        return message
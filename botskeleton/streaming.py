@@ -0,0 +1,190 @@
+"""Server-sent event streams, kept connected in the background."""
+import socket
+import threading
+import urllib.request
+from logging import Logger
+from typing import Any, Callable, Dict, Iterable, Iterator, List, NamedTuple, Optional
+
+
+class Event(NamedTuple):
+    """One server-sent event."""
+    event: str
+    data: str
+    id: Optional[str]
+
+
+def iter_events(lines: Iterable[str]) -> Iterator[Event]:
+    """
+    Parse server-sent events.
+    Comments (like the heartbeats mastodon sends) are skipped.
+
+    :param lines: lines of the stream, with or without line endings.
+    :returns: iterator of events.
+    """
+    event = "message"
+    data: List[str] = []
+    event_id: Optional[str] = None
+    for line in lines:
+        line = line.rstrip("\r\n")
+        if line == "":
+            if data:
+                yield Event(event=event, data="\n".join(data), id=event_id)
+            event = "message"
+            data = []
+            continue
+
+        if line.startswith(":"):
+            continue
+
+        name, _, value = line.partition(":")
+        if value.startswith(" "):
+            value = value[1:]
+
+        if name == "event":
+            event = value
+        elif name == "data":
+            data.append(value)
+        elif name == "id":
+            event_id = value
+
+
+class EventStream:
+    """
+    Keeps a server-sent event stream open in a background thread,
+    handing events to a callback as they arrive.
+    Dropped connections are retried with exponential backoff,
+    and on_connect is called every time the stream (re)connects,
+    to fetch whatever was missed while disconnected.
+    """
+    def __init__(
+            self,
+            *,
+            url: str,
+            on_event: Callable[[Event], None],
+            on_connect: Callable[[], None]=None,
+            headers: Dict[str, str]=None,
+            backoff: float=1.0,
+            max_backoff: float=300.0,
+            timeout: float=300.0,
+            log: Logger=None,
+    ) -> None:
+        """
+        Create stream. Nothing connects until start.
+
+        :param url: URL of event stream.
+        :param on_event: callback for each event.
+        :param on_connect: callback after each successful (re)connection (optional).
+        :param headers: HTTP headers to send (optional).
+        :param backoff: seconds to wait before the first reconnection,
+            doubling with every failure after that.
+        :param max_backoff: most seconds to wait between reconnections.
+        :param timeout: seconds without any data (heartbeats included)
+            before the connection counts as dropped.
+        :param log: logger to use (optional).
+        """
+        self.url = url
+        self.on_event = on_event
+        self.on_connect = on_connect
+        self.headers = dict(headers or {})
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+        self.log = log
+
+        # times connected, including the first.
+        self.connections = 0
+        self.connected = threading.Event()
+
+        self._stopping = threading.Event()
+        self._response: Any = None
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> None:
+        """
+        Start streaming in a background thread.
+
+        :returns: None
+        """
+        if self._thread is not None:
+            return
+
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self.run, name="botskeleton-stream", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float=None) -> None:
+        """
+        Disconnect and stop the background thread.
+
+        :param timeout: seconds to wait for the thread (optional).
+        :returns: None
+        """
+        self._stopping.set()
+        _close(self._response)
+
+        thread = self._thread
+        if thread is not None:
+            thread.join(timeout)
+        self._thread = None
+
+    def run(self) -> None:
+        """
+        Stream in this thread until stopped.
+
+        :returns: None
+        """
+        delay = self.backoff
+        while not self._stopping.is_set():
+            try:
+                request = urllib.request.Request(self.url, headers=self.headers)
+                self._response = urllib.request.urlopen(request, timeout=self.timeout)
+                self.connections += 1
+                self.connected.set()
+                delay = self.backoff
+
+                if self.on_connect is not None:
+                    self.on_connect()
+
+                lines = (line.decode("utf-8") for line in self._response)
+                for event in iter_events(lines):
+                    if self._stopping.is_set():
+                        break
+                    self.on_event(event)
+
+                if not self._stopping.is_set():
+                    self._warn(f"Stream {self.url} ended, reconnecting in {delay} seconds.")
+
+            except Exception as e:
+                if not self._stopping.is_set():
+                    self._warn(f"Stream {self.url} failed ({e}), reconnecting in {delay} seconds.")
+
+            finally:
+                self.connected.clear()
+                _close(self._response)
+                self._response = None
+
+            if self._stopping.wait(delay):
+                break
+            delay = min(delay * 2, self.max_backoff)
+
+    def _warn(self, message: str) -> None:
+        """Log a warning, if there's a log."""
+        if self.log is not None:
+            self.log.warning(message)
+
+
+def _close(response: Any) -> None:
+    """Close a streaming response, interrupting a read blocked on it if possible."""
+    if response is None:
+        return
+
+    # closing alone doesn't wake a thread blocked reading the socket, shutting it down does.
+    try:
+        response.fp.raw._sock.shutdown(socket.SHUT_RDWR)
+    except Exception:
+        pass
+
+    try:
+        response.close()
+    except Exception:
+        pass
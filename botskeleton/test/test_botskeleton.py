@@ -1,11 +1,20 @@
 """Tests for base botskeleton."""
+import gzip
+import json
 import os
+import threading
+import time
+from datetime import datetime, timedelta
 from shutil import copyfile
-from typing import Generator
+from types import SimpleNamespace
+from typing import Any, Generator, Iterable, List
 
 import pytest
 
 import botskeleton
+import botskeleton.migrate
+from botskeleton.scheduling import AdaptiveDelay, RateLimit
+from botskeleton.simulation import SimulatedClock
 
 HERE = os.path.abspath(os.path.dirname(__file__))
 JSON = os.path.join(HERE, "json")
@@ -27,6 +36,58 @@ def test_outputs_start_inactive(testdir: str, log: str) -> None:
         assert not output["active"]
 
 
+def test_inactive_outputs_not_constructed(testdir: str, log: str) -> None:
+    bs = botskeleton.BotSkeleton(secrets_dir=testdir, log_filename=log)
+
+    for _, output in bs.outputs.items():
+        assert output["obj"] is None
+
+
+def test_registered_output_activates(testdir: str, log: str) -> None:
+    botskeleton.register_output(key="inhouse",
+                                target="botskeleton.outputs.output_loopback:LoopbackSkeleton")
+    credentials_dir = os.path.join(testdir, "credentials_inhouse")
+    os.mkdir(credentials_dir)
+
+    bs = botskeleton.BotSkeleton(secrets_dir=testdir, log_filename=log)
+    assert bs.outputs["inhouse"]["active"]
+    assert bs.outputs["inhouse"]["obj"].name == "LOOPBACK"
+    assert not bs.outputs["mastodon"]["active"]
+
+    os.rmdir(credentials_dir)
+
+
+def test_entry_point_output(testdir: str, log: str, monkeypatch: Any) -> None:
+    from botskeleton.outputs import output_registry
+    from botskeleton.outputs.output_loopback import LoopbackSkeleton
+
+    class PluginSkeleton(LoopbackSkeleton):
+        credentials_dir = "plugin_secrets"
+
+    entry_point = SimpleNamespace(name="plugin", module_name="plugin.output",
+                                  attrs=("PluginSkeleton",), load=lambda: PluginSkeleton)
+    scans: List[str] = []
+
+    def iter_entry_points(group: str) -> List[Any]:
+        scans.append(group)
+        return [entry_point]
+
+    monkeypatch.setattr(output_registry, "_entry_points", None)
+    monkeypatch.setattr(output_registry.pkg_resources, "iter_entry_points", iter_entry_points)
+
+    # the class's own credentials dir, not credentials_plugin.
+    credentials_dir = os.path.join(testdir, "plugin_secrets")
+    os.mkdir(credentials_dir)
+    bs = botskeleton.BotSkeleton(secrets_dir=testdir, log_filename=log)
+    assert bs.outputs["plugin"]["active"]
+    assert isinstance(bs.outputs["plugin"]["obj"], PluginSkeleton)
+    os.rmdir(credentials_dir)
+
+    # installed packages are only scanned once.
+    botskeleton.BotSkeleton(secrets_dir=testdir, log_filename=log)
+    assert scans == [output_registry.ENTRY_POINT_GROUP]
+
+
 def test_load_null_history(testdir: str, log: str) -> None:
     name = "foobot"
     bs = botskeleton.BotSkeleton(bot_name=name, secrets_dir=testdir, log_filename=log)
@@ -66,6 +127,26 @@ def test_convert_legacy_history(testdir: str, legacyhist: str, hoistedhist: str,
         assert elem == melem
 
 
+def test_record_equality() -> None:
+    from botskeleton.outputs.output_loopback import LoopbackRecord
+
+    record = botskeleton.botskeleton.IterationRecord(extra_keys={"foo": "bar"})
+    record.output_records["loopback"] = [LoopbackRecord(record_data={"post_id": 1, "text": "foo"})]
+
+    loaded = botskeleton.botskeleton.IterationRecord.from_dict(record.to_dict())
+    assert isinstance(loaded.output_records["loopback"][0], LoopbackRecord)
+    assert loaded.to_dict() == record.to_dict()
+    assert loaded == record
+
+    # same type, timestamp and id, but not the same record.
+    loaded.output_records["loopback"][0].text = "bar"
+    assert loaded != record
+
+    loaded = botskeleton.botskeleton.IterationRecord.from_dict(record.to_dict())
+    loaded.extra_keys = {"foo": "baz"}
+    assert loaded != record
+
+
 # regression test for the history corruption snafu.
 def test_repair_corrupted_history(testdir: str, corruptedhist: str, repairedcorruptedhist: str,
                                   log: str
@@ -90,6 +171,32 @@ def test_repair_corrupted_history(testdir: str, corruptedhist: str, repairedcorr
             assert str(item) == str(melem.__dict__[key])
 
 
+def test_migrate_history(testdir: str, corruptedhist: str, log: str, monkeypatch: Any) -> None:
+    repaired = [item.to_dict() for item in
+                botskeleton.BotSkeleton(secrets_dir=testdir, history_filename=corruptedhist,
+                                        log_filename=log).history]
+
+    count = botskeleton.migrate.migrate_history(corruptedhist, workers=2, chunk_size=1)
+    assert count == len(repaired)
+    assert botskeleton.history.is_migrated(corruptedhist)
+
+    # migrated files are loaded without upgrading or repairing anything.
+    def no_upgrade(*args: Any, **kwargs: Any) -> Any:
+        raise AssertionError("migrated history was upgraded again")
+
+    monkeypatch.setattr(botskeleton.botskeleton, "upgrade_record", no_upgrade)
+    bs = botskeleton.BotSkeleton(secrets_dir=testdir, history_filename=corruptedhist,
+                                 log_filename=log)
+    assert [item.to_dict() for item in bs.history] == repaired
+
+    # and stop counting as migrated once something else changes them.
+    with open(corruptedhist, "a") as f:
+        f.write("\n")
+    assert not botskeleton.history.is_migrated(corruptedhist)
+
+    os.remove(f"{corruptedhist}.bak")
+
+
 def test_idempotency(testdir: str, testhist: str, log: str) -> None:
     bs = botskeleton.BotSkeleton(secrets_dir=testdir, history_filename=testhist, log_filename=log)
     bs.load_history()
@@ -111,6 +218,584 @@ def test_idempotency(testdir: str, testhist: str, log: str) -> None:
         pytest.fail("Test history changed when it shouldn't have been.")
 
 
+def test_compressed_history(testdir: str, testhist: str, log: str) -> None:
+    compressed = f"{testhist}.gz"
+    bs = botskeleton.BotSkeleton(secrets_dir=testdir, history_filename=compressed,
+                                 log_filename=log)
+
+    # picked up from the uncompressed file.
+    assert len(bs.history) == 2
+    bs.update_history()
+
+    with gzip.open(compressed, "rt") as f1, open(testhist, "r") as f2:
+        assert f1.read() == f2.read()
+
+    mbs = botskeleton.BotSkeleton(secrets_dir=testdir, history_filename=compressed,
+                                  log_filename=log)
+    assert len(mbs.history) == 2
+
+    os.remove(compressed)
+
+
+def test_corrupt_compressed_history(testdir: str, testhist: str, log: str) -> None:
+    compressed = f"{testhist}.gz"
+    with open(testhist, "rb") as f, gzip.open(compressed, "wb") as g:
+        g.write(f.read())
+
+    # damage the CRC at the end, so reading fails only once everything is decompressed.
+    with open(compressed, "r+b") as f:
+        f.seek(-8, os.SEEK_END)
+        f.write(b"\0\0\0\0")
+
+    bs = botskeleton.BotSkeleton(secrets_dir=testdir, history_filename=compressed,
+                                 log_filename=log)
+    assert bs.history == []
+    assert os.path.isfile(f"{compressed}.bak")
+
+    os.remove(compressed)
+    os.remove(f"{compressed}.bak")
+
+
+def test_archive_history(testdir: str, testhist: str, log: str) -> None:
+    bs = botskeleton.BotSkeleton(secrets_dir=testdir, history_filename=testhist, log_filename=log,
+                                 history_max_records=1)
+    full_history = list(bs.history)
+    bs.update_history()
+
+    assert len(bs.history) == 1
+    archives = botskeleton.history.archive_filenames(testhist)
+    assert len(archives) == 1
+
+    mbs = botskeleton.BotSkeleton(secrets_dir=testdir, history_filename=testhist, log_filename=log)
+    assert len(mbs.history) == 1
+    assert [item.timestamp for item in mbs.iter_full_history()] == \
+        [item.timestamp for item in full_history]
+
+    for archive in archives:
+        os.remove(archive)
+
+
+def test_history_window(testdir: str, testhist: str, log: str) -> None:
+    timestamps = [item.timestamp for item in
+                  botskeleton.BotSkeleton(secrets_dir=testdir, history_filename=testhist,
+                                          log_filename=log).history]
+
+    bs = botskeleton.BotSkeleton(secrets_dir=testdir, history_filename=testhist, log_filename=log,
+                                 history_window_records=1, history_window_batch=1)
+    assert [item.timestamp for item in bs.history] == timestamps[1:]
+
+    record = bs.send(text="foo")
+    assert bs.history == [record]
+    assert len(bs.full_history) == 3
+    assert [item.timestamp for item in bs.full_history[:2]] == timestamps
+    assert bs.full_history[-1] == record
+
+    # nothing lives in both the archive and the live file.
+    mbs = botskeleton.BotSkeleton(secrets_dir=testdir, history_filename=testhist, log_filename=log)
+    assert mbs.history == [record]
+    assert len(mbs.full_history) == 3
+
+    for archive in botskeleton.history.archive_filenames(testhist):
+        os.remove(archive)
+
+
+def test_history_read_from_mark(testdir: str) -> None:
+    records = [{"n": i, "text": "caf\u00e9"} for i in range(5)]
+    for name in ("marked.json", "marked.json.gz"):
+        filename = os.path.join(testdir, name)
+        offset = botskeleton.history.write_history(filename, records, mark=3)
+        assert offset is not None
+        assert list(botskeleton.history.read_history(filename, offset=offset)) == records[3:]
+        assert list(botskeleton.history.read_history(filename)) == records
+
+        assert botskeleton.history.write_history(filename, records, mark=5) is None
+        os.remove(filename)
+
+
+def test_history_write_is_atomic(testdir: str, testhist: str, log: str, monkeypatch: Any) -> None:
+    bs = botskeleton.BotSkeleton(secrets_dir=testdir, history_filename=testhist, log_filename=log)
+    with open(testhist) as f:
+        before = f.read()
+
+    def broken_encode(*args: Any, **kwargs: Any) -> str:
+        raise RuntimeError("disk on fire")
+
+    monkeypatch.setattr(botskeleton.history, "encode_record", broken_encode)
+    with pytest.raises(RuntimeError):
+        bs.update_history()
+
+    with open(testhist) as f:
+        assert f.read() == before
+    assert not os.path.exists(f"{testhist}.tmp")
+
+
+def test_dry_run(testdir: str, log: str) -> None:
+    start = datetime(2020, 1, 1)
+    history_filename = os.path.join(testdir, "dry.json")
+    bs = botskeleton.BotSkeleton(secrets_dir=testdir, log_filename=log,
+                                 history_filename=history_filename, delay=3600, dry_run=True,
+                                 dry_run_outputs=["birdsite", "mastodon"],
+                                 dry_run_latencies={"status_post": 2.0}, dry_run_start=start)
+
+    # a day of hourly posts, to two outputs taking two seconds each.
+    for _ in range(24):
+        bs.send(text="foo")
+        bs.nap()
+
+    assert bs.clock.now() == start + timedelta(hours=24, seconds=24 * 2 * 2)
+
+    record = bs.history[-1]
+    tweet = record.output_records["birdsite"][0]
+    assert tweet._type == "TweetRecord"
+    assert tweet.timings["status_post"] == [2.0]
+    assert record.output_records["mastodon"][0]._type == "TootRecord"
+    assert record.timestamp.startswith("2020-01-01T23:")
+
+    status_post = bs.metrics.histogram("operation_seconds", output="mastodon",
+                                       operation="status_post")
+    assert status_post is not None and status_post["count"] == 24
+
+    with pytest.raises(botskeleton.BotSkeletonException):
+        botskeleton.BotSkeleton(secrets_dir=testdir, log_filename=log,
+                                history_filename=history_filename, dry_run=True,
+                                dry_run_latencies={"status_post": ("gaussian", 1, 2)})
+
+    os.remove(history_filename)
+
+
+def test_dry_run_group_commit(testdir: str, log: str) -> None:
+    history_filename = os.path.join(testdir, "dry_commit.json")
+    bs = botskeleton.BotSkeleton(secrets_dir=testdir, log_filename=log,
+                                 history_filename=history_filename, delay=3600, dry_run=True,
+                                 dry_run_outputs=["mastodon"], history_commit_interval=7200)
+
+    # the commit interval goes by simulated time: every other hourly post is written.
+    for _ in range(6):
+        bs.send(text="foo")
+        bs.nap()
+
+    history_write = bs.metrics.histogram("history_write_seconds")
+    assert history_write is not None and history_write["count"] == 3
+
+    bs.flush_history()
+    assert len(botskeleton.BotSkeleton(secrets_dir=testdir, log_filename=log,
+                                       history_filename=history_filename).history) == 6
+    os.remove(history_filename)
+
+
+def test_adaptive_delay(testdir: str, log: str) -> None:
+    history_filename = os.path.join(testdir, "adaptive.json")
+    bs = botskeleton.BotSkeleton(secrets_dir=testdir, log_filename=log,
+                                 history_filename=history_filename, delay=3600, dry_run=True,
+                                 dry_run_outputs=["mastodon"], dry_run_seed=1,
+                                 adaptive_delay=True, delay_jitter=0.1)
+
+    # jittered around the delay, so bots started together drift apart.
+    naps = []
+    for _ in range(5):
+        bs.send(text="foo")
+        naps.append(bs.next_delay())
+    assert all(3600 * 0.9 <= nap <= 3600 * 1.1 for nap in naps)
+    assert len(set(naps)) == len(naps)
+    os.remove(history_filename)
+
+    clock = SimulatedClock(start=datetime(2020, 1, 1))
+    scheduler = AdaptiveDelay(delay=100, jitter=0, clock=clock)
+    assert scheduler.next_delay(posts=1) == 100
+    # time spent in the iteration comes off the nap.
+    assert scheduler.next_delay(elapsed=30) == 70
+
+    # failures and backlog stretch it.
+    assert scheduler.next_delay(errors=1) > 100
+    scheduler.error_rate = 0
+    assert scheduler.next_delay(backlog=4) == 200
+
+    # budget is spread over what's left of the window,
+    # and an exhausted one waits for the reset however long that is.
+    reset = clock.now().timestamp() + 600
+    limits = {"mastodon": RateLimit(remaining=2, limit=300, reset=reset)}
+    assert scheduler.next_delay(rate_limits=limits) == 300
+    limits = {"mastodon": RateLimit(remaining=0, limit=300, reset=reset + 9400)}
+    assert scheduler.next_delay(rate_limits=limits) == 10000
+
+    # jitter stays within min_delay and max_delay.
+    scheduler = AdaptiveDelay(delay=100, min_delay=90, max_delay=100, jitter=0.5, seed=1,
+                              clock=clock)
+    assert all(90 <= scheduler.next_delay() <= 100 for _ in range(20))
+
+
+def test_query_history(testdir: str, testhist: str, log: str) -> None:
+    bs = botskeleton.BotSkeleton(secrets_dir=testdir, history_filename=testhist, log_filename=log)
+
+    assert bs.query_history(post_id=1038492406465740800) == bs.history[:1]
+    assert bs.query_history(output="mastodon", since="2018-09-08T12:00:00") == bs.history[1:]
+    assert bs.query_history(error_code="unknown") == []
+
+
+def test_metrics(testdir: str, loopback: str, history_file: str, log: str) -> None:
+    bs = botskeleton.BotSkeleton(secrets_dir=testdir, log_filename=log,
+                                 history_filename=history_file)
+
+    bs.send(text="foo")
+    bs.send_with_one_media(text="bar", file="a.png")
+
+    assert bs.metrics.counter("posts_total", output="loopback") == 2
+    assert bs.metrics.counter("uploads_total", output="loopback") == 1
+    status_post = bs.metrics.histogram("operation_seconds", output="loopback",
+                                       operation="status_post")
+    assert status_post is not None and status_post["count"] == 2
+
+    rendered = bs.metrics.render_prometheus()
+    assert 'botskeleton_posts_total{output="loopback"} 2' in rendered
+    assert 'operation="media_upload",output="loopback",le="+Inf"} 1' in rendered
+
+
+def test_profiling(testdir: str, loopback: str, history_file: str, log: str) -> None:
+    bs = botskeleton.BotSkeleton(secrets_dir=testdir, log_filename=log,
+                                 history_filename=history_file, profile=True, profile_keep=2)
+
+    for i in range(3):
+        bs.send(text=f"foo {i}")
+
+    profiler: Any = bs.profiler
+    stats_files = profiler.stats_files()
+    assert len(stats_files) == 2
+    assert all(file.endswith("-send.prof") for file in stats_files)
+
+    for file in stats_files:
+        os.remove(file)
+    os.rmdir(profiler.directory)
+
+
+def test_query_history_incremental(testdir: str, loopback: str, history_file: str,
+                                   log: str) -> None:
+    bs = botskeleton.BotSkeleton(secrets_dir=testdir, log_filename=log,
+                                 history_filename=history_file)
+    loopback_obj: Any = bs.outputs["loopback"]["obj"]
+    status = loopback_obj.add_status(handle="@someone", text="hello")
+
+    bs.store_extra_info("mood", "happy")
+    first = bs.send(text="foo")
+    post_id = first.output_records["loopback"][0].id
+
+    def callback(*, message_id: Any, message: str, extra_keys: Any) -> str:
+        return message.upper()
+
+    bs.store_extra_keys({"mood": "grumpy"})
+    reply = bs.perform_batch_reply(callback=callback, target_handles={"loopback": "@someone"})
+
+    assert bs.query_history(post_id=post_id) == [first]
+    assert bs.query_history(post_id=str(post_id), output="loopback") == [first]
+    assert bs.query_history(post_id=post_id, output="birdsite") == []
+    assert bs.query_history(in_reply_to_id=status["id"]) == [reply]
+    assert bs.query_history(extra_keys={"mood": "grumpy"}) == [reply]
+    assert bs.query_history(since=reply.timestamp) == [reply]
+    assert bs.query_history(until=reply.timestamp)[-1] == first
+
+    # new records are picked up, and trimmed ones dropped.
+    loopback_obj.failure_rate = 1.0
+    failed = bs.send(text="bar")
+    assert bs.query_history(error_code="unknown") == [failed]
+
+    bs.history_max_records = 1
+    bs.archive_history()
+    assert bs.query_history(post_id=post_id) == []
+    assert bs.query_history(output="loopback") == [failed]
+
+
+def test_group_commit(testdir: str, loopback: str, history_file: str, log: str) -> None:
+    bs = botskeleton.BotSkeleton(secrets_dir=testdir, log_filename=log,
+                                 history_filename=history_file, history_commit_interval=3600)
+
+    for i in range(3):
+        bs.send(text=f"foo {i}")
+
+    # first iteration is written straight away, the rest wait for the next commit.
+    assert len(botskeleton.BotSkeleton(secrets_dir=testdir, log_filename=log,
+                                       history_filename=history_file).history) == 1
+
+    bs.flush_history()
+    assert len(botskeleton.BotSkeleton(secrets_dir=testdir, log_filename=log,
+                                       history_filename=history_file).history) == 3
+
+    history_write = bs.metrics.histogram("history_write_seconds")
+    assert history_write is not None and history_write["count"] == 2
+
+
+def test_shared_history(testdir: str, loopback: str, history_file: str, log: str,
+                        monkeypatch: Any) -> None:
+    poster = botskeleton.BotSkeleton(secrets_dir=testdir, log_filename=log,
+                                     history_filename=history_file, shared_history=True,
+                                     shared_history_compact=5, history_max_records=8)
+    replier = botskeleton.BotSkeleton(secrets_dir=testdir, log_filename=log,
+                                      history_filename=history_file, shared_history=True,
+                                      shared_history_compact=5, history_max_records=8)
+
+    for i in range(6):
+        poster.send(text=f"post {i}")
+        replier.send(text=f"reply {i}")
+
+    # after someone compacts, the others only read the records compacted from the journal.
+    offsets: List[int] = []
+    read_history = botskeleton.shared_history.read_history
+    def recording_read_history(filename: str, **kwargs: Any) -> Any:
+        offsets.append(kwargs.get("offset", 0))
+        return read_history(filename, **kwargs)
+
+    monkeypatch.setattr(botskeleton.shared_history, "read_history", recording_read_history)
+    poster.update_history()
+    replier.sync_history()
+    assert len(offsets) == 1 and offsets[0] > 0
+    monkeypatch.undo()
+
+    # neither clobbers the other, and each sees the other's records.
+    texts = [f"{kind} {i}" for i in range(6) for kind in ("post", "reply")]
+    for bs in (poster, replier):
+        bs.sync_history()
+        assert _texts(bs.full_history) == texts
+        assert len(bs.query_history(output="loopback")) == len(bs.history)
+
+    # a newcomer gets everything from the history file and journal.
+    newcomer = botskeleton.BotSkeleton(secrets_dir=testdir, log_filename=log,
+                                       history_filename=history_file, shared_history=True)
+    assert _texts(newcomer.full_history) == texts
+
+    for bs in (poster, replier, newcomer):
+        shared_history: Any = bs.shared_history
+        shared_history.close()
+
+
+def test_shared_history_compaction_crash(testdir: str, loopback: str, history_file: str,
+                                         log: str, monkeypatch: Any) -> None:
+    poster = botskeleton.BotSkeleton(secrets_dir=testdir, log_filename=log,
+                                     history_filename=history_file, shared_history=True,
+                                     shared_history_compact=100, history_max_records=3)
+    for i in range(5):
+        poster.send(text=f"post {i}")
+
+    # crash after archiving and writing the state, before replacing the live history file.
+    replace_durably = botskeleton.shared_history.replace_durably
+    def crash(temp_filename: str, filename: str) -> None:
+        if filename == history_file:
+            raise OSError("crashed")
+        replace_durably(temp_filename, filename)
+
+    monkeypatch.setattr(botskeleton.shared_history, "replace_durably", crash)
+    with pytest.raises(OSError):
+        poster.archive_history()
+    monkeypatch.undo()
+
+    # readers go by the new history file until someone finishes the compaction.
+    reader = botskeleton.BotSkeleton(secrets_dir=testdir, log_filename=log,
+                                     history_filename=history_file, shared_history=True)
+    assert _texts(reader.history) == [f"post {i}" for i in range(2, 5)]
+
+    writer = botskeleton.BotSkeleton(secrets_dir=testdir, log_filename=log,
+                                     history_filename=history_file, shared_history=True)
+    writer.send(text="post 5")
+    shared_history: Any = writer.shared_history
+    assert not os.path.isfile(shared_history.staged_filename)
+
+    expected = [f"post {i}" for i in range(2, 6)]
+    for bs in (reader, writer):
+        bs.sync_history()
+        assert _texts(bs.history) == expected
+
+    newcomer = botskeleton.BotSkeleton(secrets_dir=testdir, log_filename=log,
+                                       history_filename=history_file, shared_history=True)
+    assert _texts(newcomer.history) == expected
+    assert len(list(newcomer.iter_full_history())) == 6
+
+    for bs in (poster, reader, writer, newcomer):
+        shared_history = bs.shared_history
+        shared_history.close()
+
+
+def test_duplicate_posts(testdir: str, loopback: str, history_file: str, log: str) -> None:
+    bs = botskeleton.BotSkeleton(secrets_dir=testdir, log_filename=log,
+                                 history_filename=history_file, duplicate_window=3600)
+    loopback_obj: Any = bs.outputs["loopback"]["obj"]
+
+    bs.send(text="Foo  bar")
+    record = bs.send(text="foo bar")
+    assert len(loopback_obj.posts) == 1
+    assert record.output_records["loopback"][0].reason == "duplicate"
+    assert bs.metrics.counter("skipped_total", output="loopback", reason="duplicate") == 1
+
+    # same text with different media is a different post.
+    bs.send_with_one_media(text="foo bar", file=os.path.join(HERE, "test_botskeleton.py"))
+    assert len(loopback_obj.posts) == 2
+
+    # recent posts are remembered across restarts.
+    bs = botskeleton.BotSkeleton(secrets_dir=testdir, log_filename=log,
+                                 history_filename=history_file, duplicate_window=3600,
+                                 duplicate_policy="regenerate",
+                                 duplicate_regenerate=lambda text: {"text": text + "!"})
+    loopback_obj = bs.outputs["loopback"]["obj"]
+    bs.send(text="foo bar")
+    assert loopback_obj.posts[0]["text"] == "foo bar!"
+
+    bs.duplicate_policy = "force"
+    bs.send(text="foo bar")
+    assert loopback_obj.posts[1]["text"] == "foo bar"
+
+    # of the same post made from several threads at once, only one goes out.
+    bs.duplicate_policy = "skip"
+    loopback_obj.latency = 0.05
+    threads = [threading.Thread(target=bs.send, kwargs={"text": "at once"}) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert [post["text"] for post in loopback_obj.posts].count("at once") == 1
+
+    # a post that failed everywhere can be tried again.
+    loopback_obj.latency = 0.0
+    loopback_obj.failure_rate = 1.0
+    bs.send(text="try again")
+    loopback_obj.failure_rate = 0.0
+    bs.send(text="try again")
+    assert loopback_obj.posts[-1]["text"] == "try again"
+
+
+def test_send_batch(testdir: str, loopback: str, history_file: str, log: str) -> None:
+    bs = botskeleton.BotSkeleton(secrets_dir=testdir, log_filename=log,
+                                 history_filename=history_file, duplicate_window=3600)
+    loopback_obj: Any = bs.outputs["loopback"]["obj"]
+
+    posts = [{"text": f"foo {i}"} for i in range(9)] + [{"text": "foo 0"}]
+    records = bs.send_batch(posts, concurrency=1, pace={"loopback": 0.001}, history_group=4)
+
+    assert [post["text"] for post in loopback_obj.posts] == [f"foo {i}" for i in range(9)]
+    assert records[-1].output_records["loopback"][0].reason == "duplicate"
+    assert bs.history[-len(posts):] == records
+
+    # one history write per group, not per post.
+    history_write = bs.metrics.histogram("history_write_seconds")
+    assert history_write is not None and history_write["count"] == 3
+
+
+def test_send_batch_captions_without_files(testdir: str, loopback: str, history_file: str,
+                                           log: str) -> None:
+    posts = [{"text": "foo", "captions": ["a caption"]},
+             {"text": "bar", "files": [], "captions": []}]
+
+    for outbox in (False, True):
+        bs = botskeleton.BotSkeleton(secrets_dir=testdir, log_filename=log,
+                                     history_filename=history_file, outbox=outbox)
+        loopback_obj: Any = bs.outputs["loopback"]["obj"]
+
+        records = bs.send_batch(posts)
+        if outbox:
+            assert bs.flush_outbox(timeout=10)
+            outbox_obj: Any = bs.outbox
+            outbox_obj.stop()
+            os.rmdir(outbox_obj.directory)
+
+        assert [post["text"] for post in loopback_obj.posts] == ["foo", "bar"]
+        assert all(getattr(record.output_records["loopback"][0], "error", None) is None
+                   for record in records)
+
+
+def test_circuit_breaker(testdir: str, loopback: str, history_file: str, log: str) -> None:
+    bs = botskeleton.BotSkeleton(secrets_dir=testdir, log_filename=log,
+                                 history_filename=history_file,
+                                 circuit_breaker_threshold=2, circuit_breaker_cooldown=0.05)
+    loopback_obj: Any = bs.outputs["loopback"]["obj"]
+
+    loopback_obj.failure_rate = 1.0
+    for _ in range(2):
+        assert bs.send(text="foo").output_records["loopback"][0].error is not None
+
+    # open: skipped without trying.
+    record = bs.send(text="foo")
+    assert record.output_records["loopback"][0].reason == "circuit_open"
+    assert bs.metrics.counter("circuit_opened_total", output="loopback") == 1
+    assert bs.metrics.counter("skipped_total", output="loopback", reason="circuit_open") == 1
+
+    # half-open after the cooldown: a failed probe opens it again, a good one closes it.
+    time.sleep(0.06)
+    assert bs.send(text="foo").output_records["loopback"][0].error is not None
+    assert bs.send(text="foo").output_records["loopback"][0].reason == "circuit_open"
+    loopback_obj.failure_rate = 0.0
+    time.sleep(0.06)
+    assert bs.send(text="bar").output_records["loopback"][0].text == "bar"
+    assert bs.send(text="baz").output_records["loopback"][0].text == "baz"
+    assert [post["text"] for post in loopback_obj.posts] == ["bar", "baz"]
+
+
+def test_outbox(testdir: str, loopback: str, history_file: str, log: str) -> None:
+    bs = botskeleton.BotSkeleton(secrets_dir=testdir, log_filename=log,
+                                 history_filename=history_file, outbox=True)
+    loopback_obj: Any = bs.outputs["loopback"]["obj"]
+
+    record = bs.send(text="foo")
+    assert bs.flush_outbox(timeout=10)
+    assert loopback_obj.posts[0]["text"] == "foo"
+    assert record.output_records["loopback"][0].text == "foo"
+    assert bs.history[-1] is record
+
+    # failures are retried, and kept in the record after the last attempt.
+    outbox: Any = bs.outbox
+    loopback_obj.failure_rate = 1.0
+    outbox.max_attempts = 3
+    outbox.retry_delay = 0
+    record = bs.send(text="bar")
+    assert bs.flush_outbox(timeout=10)
+    assert bs.metrics.counter("retries_total", output="loopback") == 2
+    assert record.output_records["loopback"][0].error is not None
+    assert bs.history[-1] is record
+
+    # posts queued when the process goes away are delivered after a restart.
+    outbox.stop()
+    bs.send(text="baz")
+    assert len(outbox.pending()) == 1
+
+    mbs = botskeleton.BotSkeleton(secrets_dir=testdir, log_filename=log,
+                                  history_filename=history_file, outbox=True)
+    assert mbs.flush_outbox(timeout=10)
+    assert mbs.history[-1].output_records["loopback"][0].text == "baz"
+    outbox = mbs.outbox
+    outbox.stop()
+
+    os.rmdir(outbox.directory)
+
+
+def test_concurrent_sends(testdir: str, loopback: str, history_file: str, log: str) -> None:
+    TESTFILE = os.path.join(loopback, "LATENCY")
+    with open(TESTFILE, "w") as f:
+        f.write("0.01")
+
+    bs = botskeleton.BotSkeleton(secrets_dir=testdir, log_filename=log,
+                                 history_filename=history_file)
+
+    def poster(number: int) -> None:
+        for i in range(10):
+            bs.store_extra_info(f"poster {number}", i)
+            bs.send(text=f"{number} {i}")
+
+    threads = [threading.Thread(target=poster, args=(number,)) for number in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    texts = sorted(item.output_records["loopback"][0].text for item in bs.history)
+    assert texts == sorted(f"{number} {i}" for number in range(8) for i in range(10))
+
+    with open(history_file) as f:
+        assert len(json.load(f)) == 80
+
+    # records keep the extra keys they were sent with.
+    first = [item for item in bs.history if item.output_records["loopback"][0].text == "0 0"]
+    assert first[0].extra_keys["poster 0"] == 0
+
+
+def _texts(history: Iterable[Any]) -> List[str]:
+    """Get the text each record posted to loopback."""
+    return [record.to_dict()["output_records"]["loopback"][0]["text"] for record in history]
+
+
 @pytest.fixture(scope="function")
 def testhist(testdir: str) -> Generator[str, str, None]:
     hist_source = os.path.join(JSON, "test_entries.json")
@@ -156,6 +841,34 @@ def repairedcorruptedhist(testdir: str) -> Generator[str, str, None]:
     os.remove(hist_file)
 
 
+@pytest.fixture(scope="function")
+def loopback(testdir: str) -> Generator[str, str, None]:
+    credentials_loopback = os.path.join(testdir, "credentials_loopback")
+    os.mkdir(credentials_loopback)
+
+    yield credentials_loopback
+
+    for file in os.listdir(credentials_loopback):
+        os.remove(os.path.join(credentials_loopback, file))
+
+    os.rmdir(credentials_loopback)
+
+
+@pytest.fixture(scope="function")
+def history_file(testdir: str, request: Any) -> Generator[str, str, None]:
+    hist_file = os.path.join(testdir, f"{request.node.name}.json")
+    with open(hist_file, "w") as f:
+        f.write("[]\n")
+
+    yield hist_file
+
+    # along with its journal, lock, state, archives and so on.
+    name = os.path.basename(hist_file)
+    for file in os.listdir(testdir):
+        if file.startswith(name):
+            os.remove(os.path.join(testdir, file))
+
+
 @pytest.fixture(scope="module")
 def log(testdir: str) -> Generator[str, str, None]:
     log = os.path.join(testdir, "log")
@@ -168,5 +881,11 @@ def log(testdir: str) -> Generator[str, str, None]:
 def testdir() -> Generator[str, str, None]:
     directory = os.path.join(HERE, "testing_playground")
     os.mkdir(directory)
+
     yield directory
+
+    # make sure we clean up if the tests forgot.
+    for file in os.listdir(directory):
+        os.remove(os.path.join(directory, file))
+
     os.rmdir(directory)
@@ -1,10 +1,16 @@
+import atexit
 import os
+import time
 from shutil import copyfile
-from typing import Any, Generator
+from types import SimpleNamespace
+from typing import Any, Dict, Generator, List
+
+import tweepy
 
 import pytest
 
 import botskeleton
+from botskeleton.sos import SosNotifier
 
 HERE = os.path.abspath(os.path.dirname(__file__))
 
@@ -35,6 +41,89 @@ def test_birdsite_activates_with_owner_id_correctly(testdir: str, credentials: s
 
     os.remove(TESTFILE)
 
+def test_birdsite_output_timeout(testdir: str, credentials: str, log: str,
+                                 monkeypatch: Any) -> None:
+    clients: List[Dict[str, Any]] = []
+
+    def client(auth: Any, **kwargs: Any) -> Any:
+        clients.append(kwargs)
+        return SimpleNamespace()
+
+    monkeypatch.setattr(tweepy, "API", client)
+
+    botskeleton.BotSkeleton(secrets_dir=testdir, log_filename=log, output_timeout=5)
+    assert(clients[-1]["timeout"] == 5)
+
+    # the library's own default otherwise.
+    botskeleton.BotSkeleton(secrets_dir=testdir, log_filename=log)
+    assert("timeout" not in clients[-1])
+
+def test_birdsite_sos(testdir: str, credentials: str, log: str) -> None:
+    TESTFILE = os.path.join(credentials, "OWNER_HANDLE")
+    with open(TESTFILE, "w") as f:
+        f.write("owner")
+
+    bs = botskeleton.BotSkeleton(secrets_dir=testdir, log_filename=log)
+    birdsite_obj: Any = bs.outputs["birdsite"]["obj"]
+
+    lookups: List[str] = []
+    sent: List[str] = []
+
+    class SlowApi:
+        def get_user(self, screen_name: str) -> Any:
+            lookups.append(screen_name)
+            time.sleep(0.2)
+            return SimpleNamespace(id=42)
+
+    birdsite_obj.api = SlowApi()
+    birdsite_obj._send_direct_message_new = lambda event: sent.append(
+        event["event"]["message_create"]["message_data"]["text"])
+    birdsite_obj.sos.min_interval = 0.1
+
+    # an error storm doesn't wait on DMs.
+    start = time.monotonic()
+    for _ in range(20):
+        record = birdsite_obj.handle_error(message="storm",
+                                           error=tweepy.TweepError("x", api_code=1))
+        assert(record.error is not None)
+    assert(time.monotonic() - start < 0.1)
+
+    birdsite_obj.handle_error(message="other", error=tweepy.TweepError("y", api_code=2))
+    birdsite_obj.handle_error(message="another", error=tweepy.TweepError("z", api_code=3))
+    assert(birdsite_obj.sos.flush(timeout=5))
+
+    # one lookup, the storm deduplicated, and the rest as a digest.
+    sent_text = "\n".join(sent)
+    assert(lookups == ["owner"])
+    assert(len(sent) <= 3)
+    assert(sent_text.count("storm") == 1)
+    assert("other" in sent_text and "another" in sent_text)
+
+    birdsite_obj.sos.stop(timeout=5)
+    os.remove(TESTFILE)
+
+def test_sos_exit_handler(monkeypatch: Any) -> None:
+    registered: List[Any] = []
+
+    def unregister(func: Any) -> None:
+        if func in registered:
+            registered.remove(func)
+
+    monkeypatch.setattr(atexit, "register", registered.append)
+    monkeypatch.setattr(atexit, "unregister", unregister)
+
+    # registered once the worker starts, once, and gone after stop.
+    sent: List[str] = []
+    notifier = SosNotifier(send=sent.append, min_interval=0)
+    assert(registered == [])
+    notifier.notify("foo")
+    notifier.notify("bar")
+    assert(len(registered) == 1)
+
+    notifier.stop(timeout=5)
+    assert(registered == [])
+    assert("foo" in "\n".join(sent))
+
 
 @pytest.fixture(scope="function")
 def credentials(testdir: str) -> Generator[str, str, None]:
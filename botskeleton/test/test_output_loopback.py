@@ -0,0 +1,189 @@
+import os
+import threading
+from typing import Any, Dict, Generator, List
+
+import pytest
+
+import botskeleton
+
+HERE = os.path.abspath(os.path.dirname(__file__))
+
+def test_loopback_activates_correctly(testdir: str, credentials: str, log: str) -> None:
+    bs = botskeleton.BotSkeleton(secrets_dir=testdir, log_filename=log)
+
+    assert(bs.outputs["loopback"]["active"])
+
+def test_loopback_send_records_posts(testdir: str, credentials: str, log: str) -> None:
+    bs = botskeleton.BotSkeleton(secrets_dir=testdir, log_filename=log)
+    loopback_obj: Any = bs.outputs["loopback"]["obj"]
+    history_length = len(bs.history)
+
+    record = bs.send(text="foo")
+    bs.send_with_many_media(text="bar", files=["a.png", "b.png"], captions=["a"])
+
+    assert([post["text"] for post in loopback_obj.posts] == ["foo", "bar"])
+    assert(len(loopback_obj.posts[1]["media_ids"]) == 2)
+    assert(record.output_records["loopback"][0].text == "foo")
+    assert(len(bs.history) == history_length + 2)
+
+def test_loopback_timings(testdir: str, credentials: str, log: str) -> None:
+    bs = botskeleton.BotSkeleton(secrets_dir=testdir, log_filename=log)
+
+    record = bs.send_with_many_media(text="bar", files=["a.png", "b.png"])
+    timings = record.output_records["loopback"][0].timings
+    assert(len(timings["media_upload"]) == 2)
+    assert(len(timings["status_post"]) == 1)
+    assert(timings["total"] >= timings["status_post"][0])
+
+    # survives a round trip through the history file.
+    mbs = botskeleton.BotSkeleton(secrets_dir=testdir, log_filename=log)
+    summary = mbs.aggregate_timings(output="loopback")
+    assert(summary["media_upload"]["count"] >= 2)
+    assert(summary["total"]["max"] >= summary["total"]["p50"])
+
+def test_loopback_failure_rate(testdir: str, credentials: str, log: str) -> None:
+    TESTFILE = os.path.join(credentials, "FAILURE_RATE")
+    with open(TESTFILE, "w") as f:
+        f.write("1.0")
+
+    bs = botskeleton.BotSkeleton(secrets_dir=testdir, log_filename=log)
+    loopback_obj: Any = bs.outputs["loopback"]["obj"]
+
+    record = bs.send(text="foo")
+    assert(loopback_obj.posts == [])
+    assert(record.output_records["loopback"][0].error_message.startswith("Simulated failure"))
+    assert(bs.metrics.counter("errors_total", output="loopback", code="unknown") == 1)
+
+    os.remove(TESTFILE)
+
+def test_loopback_batch_reply(testdir: str, credentials: str, log: str) -> None:
+    bs = botskeleton.BotSkeleton(secrets_dir=testdir, log_filename=log)
+    loopback_obj: Any = bs.outputs["loopback"]["obj"]
+
+    loopback_obj.add_status(handle="@someone", text="hello")
+    loopback_obj.add_status(handle="@someone", text="goodbye")
+
+    def callback(*, message_id: Any, message: str, extra_keys: Any) -> str:
+        return message.upper()
+
+    bs.perform_batch_reply(callback=callback, target_handles={"loopback": "@someone"})
+    assert(sorted(post["text"] for post in loopback_obj.posts) == ["GOODBYE", "HELLO"])
+
+    # second run should find we already replied.
+    bs.perform_batch_reply(callback=callback, target_handles={"loopback": "@someone"})
+    assert(len(loopback_obj.posts) == 2)
+
+def test_loopback_mention_replies(testdir: str, credentials: str, log: str) -> None:
+    history_filename = os.path.join(testdir, "mentions.json")
+    bs = botskeleton.BotSkeleton(secrets_dir=testdir, log_filename=log,
+                                 history_filename=history_filename)
+    loopback_obj: Any = bs.outputs["loopback"]["obj"]
+
+    loopback_obj.add_status(handle="@someone", text="@loopback hi")
+    loopback_obj.add_status(handle="@someone", text="not talking to you")
+    loopback_obj.add_status(handle="@someone", text="@loopbackfan hi")
+    loopback_obj.add_status(handle="@other", text="hello @loopback")
+
+    callback = lambda message_id, message, extra_keys: f"re {message}"
+    record = bs.perform_mention_replies(callback=callback, limit=2, concurrency=2)
+    texts = [output_record.text for output_record in record.output_records["loopback"]]
+    assert(texts == ["re @loopback hi", "re hello @loopback"])
+
+    # nothing new, nothing replied to, one request.
+    record = bs.perform_mention_replies(callback=callback)
+    assert(record.output_records["loopback"] == [])
+    fetch = bs.metrics.histogram("operation_seconds", output="loopback",
+                                 operation="timeline_fetch")
+    assert(fetch is not None and fetch["count"] == 2)
+
+    # where we got to is remembered across restarts.
+    loopback_obj.add_status(handle="@other", text="@loopback again")
+    mbs = botskeleton.BotSkeleton(secrets_dir=testdir, log_filename=log,
+                                  history_filename=history_filename)
+    mbs.outputs["loopback"]["obj"].timelines = loopback_obj.timelines
+    record = mbs.perform_mention_replies(callback=callback)
+    texts = [output_record.text for output_record in record.output_records["loopback"]]
+    assert(texts == ["re @loopback again"])
+
+    # a mention whose callback fails is tried again on the next poll,
+    # and so are the ones after it, but nothing is replied to twice.
+    for text in ("@loopback one", "@loopback two", "@loopback three"):
+        loopback_obj.add_status(handle="@other", text=text)
+
+    def flaky(message_id: Any, message: str, extra_keys: Dict[str, Any]) -> str:
+        if message == "@loopback two" and not failed:
+            failed.append(message_id)
+            raise ValueError("callback broke")
+        return f"re {message}"
+
+    failed: List[Any] = []
+    record = mbs.perform_mention_replies(callback=flaky, concurrency=1)
+    texts = [output_record.text for output_record in record.output_records["loopback"]]
+    assert(texts == ["re @loopback one"])
+    assert(mbs.mention_since_ids["loopback"] == failed[0] - 1)
+
+    record = mbs.perform_mention_replies(callback=flaky, concurrency=1)
+    texts = [output_record.text for output_record in record.output_records["loopback"]]
+    assert(texts == ["re @loopback two", "re @loopback three"])
+
+    # replies finishing after an older one failed aren't made again.
+    output: Any = mbs.outputs["loopback"]["obj"]
+    output.mention_since_id = None
+    newer_done = threading.Event()
+
+    def reply(mention: Dict[str, Any]) -> Any:
+        if mention["id"] == 1 and not failed:
+            newer_done.wait(10)
+            failed.append(mention["id"])
+            raise ValueError("callback broke")
+        if mention["id"] == 2:
+            newer_done.set()
+        return mention["id"]
+
+    failed = []
+    mentions = [{"id": 1}, {"id": 2}]
+    assert(output.reply_to_mentions(mentions, reply, mention_id=lambda mention: mention["id"],
+                                    concurrency=2) == [2])
+    assert(output.mention_since_id is None)
+    assert(output.reply_to_mentions(mentions, reply, mention_id=lambda mention: mention["id"],
+                                    concurrency=2) == [1])
+    assert(output.mention_since_id == 2)
+
+    os.remove(f"{history_filename}.mentions")
+    os.remove(history_filename)
+
+
+@pytest.fixture(scope="function")
+def credentials(testdir: str) -> Generator[str, str, None]:
+    credentials_loopback = os.path.join(testdir, "credentials_loopback")
+    os.mkdir(credentials_loopback)
+
+    yield credentials_loopback
+
+    for file in os.listdir(credentials_loopback):
+        os.remove(os.path.join(credentials_loopback, file))
+
+    os.rmdir(credentials_loopback)
+
+
+@pytest.fixture(scope="module")
+def log(testdir: str) -> Generator[str, str, None]:
+    log = os.path.join(testdir, "log")
+    open(log, "a").close()
+    yield log
+    os.remove(log)
+
+
+@pytest.fixture(scope="module")
+def testdir() -> Generator[str, str, None]:
+    directory = os.path.join(HERE, "testing_playground")
+    os.mkdir(directory)
+
+    yield directory
+
+    # make sure we clean up if the tests forgot.
+    files = os.listdir(directory)
+    for file in files:
+        os.remove(os.path.join(directory, file))
+
+    os.rmdir(directory)
@@ -1,7 +1,13 @@
+import json
 import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from shutil import copyfile
-from typing import Any, Generator
+from types import SimpleNamespace
+from typing import Any, Dict, Generator, List
 
+import mastodon
 import pytest
 
 import botskeleton
@@ -35,6 +41,173 @@ def test_mastodon_activates_with_instance_id_correctly(testdir: str, credentials
 
     os.remove(TESTFILE)
 
+def test_mastodon_defers_client(testdir: str, credentials: str, log: str) -> None:
+    bs = botskeleton.BotSkeleton(secrets_dir=testdir, log_filename=log, defer_clients=True)
+    mastodon_obj: Any = bs.outputs["mastodon"]["obj"]
+
+    # nothing built until the client is first used.
+    assert(mastodon_obj._api is None)
+    assert(mastodon_obj.api is not None)
+    assert(mastodon_obj.api is mastodon_obj.api)
+
+    setup = bs.metrics.histogram("output_setup_seconds", output="mastodon")
+    assert(setup is not None and setup["count"] == 1)
+
+def test_mastodon_streams_replies(testdir: str, credentials: str, log: str) -> None:
+    def mention(notification_id: int, status_id: int) -> Dict[str, Any]:
+        return {"id": str(notification_id), "type": "mention", "status": {
+            "id": str(status_id), "content": "<p>hi bot</p>",
+            "account": {"id": "1", "acct": "someone"}}}
+
+    hold = threading.Event()
+    connections: List[int] = []
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self) -> None:
+            connections.append(1)
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.end_headers()
+            if len(connections) == 1:
+                # one mention, then drop the connection.
+                events = [("notification", mention(10, 100))]
+            else:
+                events = [
+                    ("update", {"id": "102", "content": "<p>news</p>",
+                                "account": {"id": "2", "acct": "friend@example.com"}}),
+                    # already caught up on, not replied to again.
+                    ("notification", mention(11, 101)),
+                ]
+
+            self.wfile.write(b":thump\n\n")
+            for event, data in events:
+                self.wfile.write(f"event: {event}\ndata: {json.dumps(data)}\n\n".encode())
+            self.wfile.flush()
+            if len(connections) > 1:
+                hold.wait(5)
+
+        def log_message(self, *args: Any) -> None:
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    posted: List[Any] = []
+    since_ids: List[Any] = []
+
+    class FakeApi:
+        def instance(self) -> Dict[str, Any]:
+            return {"urls": {"streaming_api": f"ws://127.0.0.1:{server.server_address[1]}"}}
+
+        def notifications(self, since_id: Any=None, limit: int=None) -> List[Dict[str, Any]]:
+            since_ids.append(since_id)
+            if limit is not None:
+                # the newest from before the stream started, not to be replied to.
+                return [mention(9, 99)]
+            return [notification for notification in [mention(11, 101), mention(10, 100)]
+                    if since_id is None or int(notification["id"]) > int(since_id)]
+
+        def status_post(self, status: str, in_reply_to_id: Any) -> Any:
+            posted.append(in_reply_to_id)
+            return SimpleNamespace(id=f"reply-{in_reply_to_id}")
+
+    bs = botskeleton.BotSkeleton(secrets_dir=testdir, log_filename=log)
+    mastodon_obj: Any = bs.outputs["mastodon"]["obj"]
+    mastodon_obj.api = FakeApi()
+
+    # the first reply to the first mention fails.
+    failed: List[Any] = []
+    def callback(message_id: Any, message: str, extra_keys: Dict[str, Any]) -> str:
+        if not failed:
+            failed.append(message_id)
+            raise RuntimeError("callback failed")
+        return "hello"
+
+    streams = bs.start_streaming_replies(callback=callback,
+                                         target_handles={"mastodon": ["@friend@example.com"]},
+                                         backoff=0.01)
+    try:
+        deadline = time.monotonic() + 5
+        while len(bs.history) < 3 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        time.sleep(0.1)
+    finally:
+        hold.set()
+        bs.stop_streaming_replies(timeout=5)
+        server.shutdown()
+        server.server_close()
+
+    assert(streams["mastodon"].connections == 2)
+    # the failed mention and the one missed while disconnected were caught up on,
+    # and nothing replied to twice.
+    assert(failed == ["100"])
+    assert(since_ids == [None, "9"])
+    assert(posted == ["100", "101", "102"])
+    assert(len(bs.history) == 3)
+    assert(bs.history[-1].output_records["mastodon"][0].toot_id == "reply-102")
+    assert(bs.metrics.counter("posts_total", output="mastodon") == 3)
+
+def test_mastodon_deadline(testdir: str, credentials: str, credentials_loopback: str, log: str,
+                           monkeypatch: Any) -> None:
+    clients: List[Dict[str, Any]] = []
+
+    def client(**kwargs: Any) -> Any:
+        clients.append(kwargs)
+        return SimpleNamespace()
+
+    monkeypatch.setattr(mastodon, "Mastodon", client)
+
+    history_filename = os.path.join(testdir, "deadline.json")
+    bs = botskeleton.BotSkeleton(secrets_dir=testdir, log_filename=log,
+                                 history_filename=history_filename, output_timeout=5,
+                                 iteration_deadline=0.1, circuit_breaker_threshold=3,
+                                 duplicate_window=3600)
+    mastodon_obj: Any = bs.outputs["mastodon"]["obj"]
+    assert(clients[0]["request_timeout"] == 5)
+
+    release = threading.Event()
+
+    class HungApi:
+        def status_post(self, status: str, media_ids: Any=None) -> Any:
+            release.wait(5)
+            return {"id": 1}
+
+    mastodon_obj.api = HungApi()
+    try:
+        start = time.monotonic()
+        record = bs.send(text="foo")
+
+        # the healthy output's post is kept, the hung one is left behind.
+        assert(time.monotonic() - start < 0.4)
+        assert(record.output_records["loopback"][0].text == "foo")
+        assert(record.output_records["mastodon"][0].error_code == "deadline")
+        assert(bs.metrics.counter("deadline_exceeded_total", output="mastodon") == 1)
+        assert(bs.history[-1] is record)
+
+        # the hung output is skipped while its call is left behind,
+        # rather than holding up the healthy one, and its circuit opens.
+        for i in range(12):
+            later = bs.send(text=f"foo {i}")
+            assert(later.output_records["loopback"][0].text == f"foo {i}")
+            assert(later.output_records["mastodon"][0]._type == "SkippedRecord")
+        assert(bs.metrics.counter("skipped_total", output="mastodon", reason="busy") == 12)
+        assert(bs.metrics.counter("circuit_opened_total", output="mastodon") == 1)
+
+        # what the call left behind finally did goes in its record.
+        release.set()
+        deadline = time.monotonic() + 5
+        while record.output_records["mastodon"][0]._type != "TootRecord" \
+                and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert(record.output_records["mastodon"][0].toot_id == 1)
+        assert(bs.query_history(output="mastodon", post_id=1) == [record])
+    finally:
+        release.set()
+        time.sleep(0.1)
+        if os.path.exists(history_filename):
+            os.remove(history_filename)
+
 
 @pytest.fixture(scope="function")
 def credentials(testdir: str) -> Generator[str, str, None]:
@@ -53,6 +226,14 @@ def credentials(testdir: str) -> Generator[str, str, None]:
     os.rmdir(credentials_mastodon)
 
 
+@pytest.fixture(scope="function")
+def credentials_loopback(testdir: str) -> Generator[str, str, None]:
+    credentials_loopback = os.path.join(testdir, "credentials_loopback")
+    os.mkdir(credentials_loopback)
+    yield credentials_loopback
+    os.rmdir(credentials_loopback)
+
+
 @pytest.fixture(scope="module")
 def log(testdir: str) -> Generator[str, str, None]:
     log = os.path.join(testdir, "log")
@@ -11,6 +11,11 @@ INSTALL_REQUIRES = [
     "Mastodon.py>=1.4.2, <2.0",
 ]
 
+EXTRAS_REQUIRE = {
+    "fast": ["orjson>=2.0.0"],
+    "zstd": ["zstandard>=0.11.0, <1.0.0"],
+}
+
 TESTS_REQUIRE = [
     "coveralls>=1.7.0, <2.0.0",
     "pytest>=4.5.0, <5.0.0",
@@ -46,8 +51,18 @@ setup(author="Andrew Michaud",
           "Typing :: Typed",
       ],
 
-      entry_points={},
-
+      entry_points={
+          "console_scripts": [
+              "botskeleton-migrate = botskeleton.migrate:main",
+          ],
+          "botskeleton.outputs": [
+              "birdsite = botskeleton.outputs.output_birdsite:BirdsiteSkeleton",
+              "mastodon = botskeleton.outputs.output_mastodon:MastodonSkeleton",
+              "loopback = botskeleton.outputs.output_loopback:LoopbackSkeleton",
+          ],
+      },
+
+      extras_require=EXTRAS_REQUIRE,
       install_requires=INSTALL_REQUIRES,
       python_requires=">=3.6",
       setup_requires=SETUP_REQUIRES,